@@ -0,0 +1,119 @@
+""" Benchmark of loading the model inputs of a finalised dataset from the csv
+    against the typed columnar feature store, using synthetic rows with every
+    column of the final datasets.
+
+Usage:
+    python -m benchmarks.bench_feature_store --sizes 10000 1000000
+"""
+from argparse import ArgumentParser
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import save_results, time_call
+from deltapro.feature_store import (
+    CATEGORICAL_COLUMNS, INT8_COLUMNS, get_feature_store_path, write_feature_store
+)
+from deltapro.finalise_input import FINAL_COLUMNS
+from deltapro.train_model import load_model_inputs
+
+SUITE = 'featureStore'
+AMINO_ACIDS = list('ACDEFGHIKLMNPQRSTVWY')
+
+
+def make_final_df(size, seed=42):
+    """ Function to generate a random finalised dataset with all columns.
+    """
+    rng = np.random.default_rng(seed)
+    final_df = pd.DataFrame(
+        rng.uniform(0, 1, size=(size, len(FINAL_COLUMNS))), columns=FINAL_COLUMNS
+    )
+    peptides = [''.join(rng.choice(AMINO_ACIDS, size=12)) for _ in range(max(size//5, 1))]
+    final_df['peptide'] = rng.choice(peptides, size=size)
+    final_df['source'] = rng.choice([f'source{idx}' for idx in range(10)], size=size)
+    for column in CATEGORICAL_COLUMNS[2:]:
+        final_df[column] = rng.choice(AMINO_ACIDS, size=size)
+    for column in INT8_COLUMNS:
+        final_df[column] = rng.integers(0, 2 if 'Oxidation' in column else 12, size=size)
+    final_df['flipInd'] += 1
+    return final_df
+
+def measure_load(csv_path, repeats):
+    """ Function to time load_model_inputs and measure its peak allocation.
+
+    Returns
+    -------
+    seconds : float
+        The fastest load time of all repeats.
+    peak_mb : float
+        The peak memory allocated by a load.
+    """
+    seconds = time_call(lambda: load_model_inputs(csv_path), repeats)
+    tracemalloc.start()
+    load_model_inputs(csv_path)
+    peak_mb = tracemalloc.get_traced_memory()[1]/1024/1024
+    tracemalloc.stop()
+    return seconds, peak_mb
+
+def run_benchmark(sizes, repeats):
+    """ Function to load the model inputs of datasets of several sizes from
+        the csv and from the feature store.
+
+    Returns
+    -------
+    results : list of dict
+        The load time and peak memory of each source and size.
+    """
+    results = []
+    folder = tempfile.mkdtemp(prefix='deltaproBench')
+    try:
+        for size in sizes:
+            csv_path = f'{folder}/trainData{size}.csv'
+            make_final_df(size, seed=size).to_csv(csv_path, index=False)
+            csv_inputs = load_model_inputs(csv_path)
+            csv_seconds, csv_peak_mb = measure_load(csv_path, repeats)
+
+            write_seconds = time_call(lambda: write_feature_store(csv_path, 100_000), 1)
+            store_inputs = load_model_inputs(csv_path)
+            assert np.allclose(store_inputs[0], csv_inputs[0], rtol=1e-6, atol=1e-6)
+            assert np.allclose(store_inputs[1], csv_inputs[1], rtol=1e-6, atol=1e-6)
+            store_seconds, store_peak_mb = measure_load(csv_path, repeats)
+            shutil.rmtree(get_feature_store_path(csv_path))
+
+            for name, seconds, peak_mb in (
+                ('loadCsv', csv_seconds, csv_peak_mb),
+                ('loadStore', store_seconds, store_peak_mb),
+                ('writeStore', write_seconds, None),
+            ):
+                results.append({
+                    'benchmark': name, 'size': size, 'seconds': seconds, 'peakMb': peak_mb,
+                })
+                peak = '' if peak_mb is None else f'{peak_mb:10.1f} MB'
+                print(f'{name:>10} size={size:<10} {seconds*1000:10.1f} ms {peak}')
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='Benchmark of the csv and feature store data formats.')
+    parser.add_argument(
+        '--sizes', nargs='+', type=int, default=[10_000, 1_000_000],
+        help='The numbers of rows of the datasets loaded.',
+    )
+    parser.add_argument('--repeats', type=int, default=3, help='The number of repeats of each timing.')
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmark and save the results.
+    """
+    args = get_arguments()
+    results = run_benchmark(args.sizes, args.repeats)
+    save_results(SUITE, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+""" Micro-benchmarks of the hot functions of the deltapro pipelines on
+    synthetic data of increasing size.
+
+Usage:
+    python -m benchmarks.bench_functions --sizes 100 1000 --compare <commit>
+"""
+from argparse import ArgumentParser
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import compare_results, save_results, time_call
+from benchmarks.synthetic_data import (
+    generate_psms,
+    make_observed_spectrum,
+    make_spectral_df,
+    write_mgf_files,
+    write_msp,
+)
+from deltapro.calculate_features import create_features
+from deltapro.constants import FEATURE_SET, TARGET_VARIABLE
+from deltapro.finalise_input import finalise_input
+from deltapro.mgf import process_mgf_file
+from deltapro.msp import msp_to_df
+from deltapro.spectral_data import calculate_spectral_angle
+from deltapro.spectral_match import get_ion_mzs, get_matches, match_prosit_to_observed
+from deltapro import train_model
+
+DEFAULT_SIZES = [100, 1000]
+SUITE = 'functions'
+
+
+def setup_msp_to_df(size, folder):
+    psm_df = generate_psms(size)
+    msp_file = f'{folder}/predictions.msp'
+    write_msp(psm_df['peptide'], psm_df['charge'], [33]*size, msp_file)
+    return lambda: msp_to_df(msp_file, with_ce=True)
+
+def setup_process_mgf_file(size, folder):
+    psm_df = generate_psms(size)
+    mgf_file = write_mgf_files(psm_df, folder)[0]
+    scan_ids = set(psm_df['scan'].tolist())
+    return lambda: process_mgf_file(mgf_file, scan_ids)
+
+def _matching_inputs(size):
+    spec_df = make_spectral_df(size)
+    spectra = [
+        make_observed_spectrum(pep, charge, seed=idx)
+        for idx, (pep, charge) in enumerate(zip(spec_df['peptide'], spec_df['charge']))
+    ]
+    spec_df['MZs'] = [spectrum[0] for spectrum in spectra]
+    spec_df['Intensities'] = [spectrum[1] for spectrum in spectra]
+    return spec_df
+
+def setup_get_matches(size, folder):
+    spec_df = _matching_inputs(size)
+    ion_mzs = [get_ion_mzs(pep, {0: 0.0})[0] for pep in spec_df['peptide']]
+
+    def run():
+        for row_ion_mzs, prosit_ions, mzs, intensities in zip(
+            ion_mzs, spec_df['prositIons'], spec_df['MZs'], spec_df['Intensities']
+        ):
+            get_matches(row_ion_mzs, prosit_ions, mzs, intensities, 0.03)
+    return run
+
+def setup_match_prosit_to_observed(size, folder):
+    spec_df = _matching_inputs(size)
+    return lambda: spec_df.apply(
+        lambda x : match_prosit_to_observed(x, 'flip1', 'prositIons', 0.03, 'Da'),
+        axis=1,
+    )
+
+def setup_calculate_spectral_angle(size, folder):
+    spec_df = make_spectral_df(size)
+    pairs = list(zip(spec_df['prositMatchedIons'], spec_df['prositIons']))
+    return lambda: [calculate_spectral_angle(true, pred) for true, pred in pairs]
+
+def setup_create_features(size, folder):
+    spec_df = make_spectral_df(size)
+    return lambda: spec_df.apply(lambda x : create_features(x, 1), axis=1)
+
+def setup_finalise_input(size, folder):
+    spec_df = make_spectral_df(size)
+    for idx in range(1, 6):
+        feated_df = spec_df.apply(lambda x : create_features(x, idx), axis=1)
+        feated_df = feated_df[feated_df['nFlip'] != 'x'].drop(
+            ['prositIons', 'prositMatchedIons'], axis=1
+        )
+        for tt in ('train', 'test'):
+            feated_df.to_csv(f'{folder}/{tt}FeatedData{idx}.csv', index=False)
+    return lambda: finalise_input(folder)
+
+def make_training_df(size, seed=42):
+    """ Function to generate a random training dataset with all features.
+    """
+    rng = np.random.default_rng(seed)
+    train_df = pd.DataFrame(
+        rng.uniform(0, 1, size=(size, len(FEATURE_SET))), columns=FEATURE_SET
+    )
+    train_df[TARGET_VARIABLE] = (
+        train_df['spectralAngle']*train_df['yIntesAtLoc'] - train_df['bErrsAtLoc'] +
+        rng.normal(0, 0.05, size=size)
+    )
+    return train_df
+
+def setup_run_training(size, folder):
+    train_df = make_training_df(size)
+    settings = {
+        'Default': {
+            'min_child_weight': 2,
+            'max_depth': 16,
+            'learning_rate': 0.15,
+            'gamma': 0.1,
+            'colsample_bytree': 0.9,
+        }
+    }
+    return lambda: train_model.run_training(train_df, 'Default', settings)
+
+BENCHMARKS = {
+    'msp_to_df': setup_msp_to_df,
+    'process_mgf_file': setup_process_mgf_file,
+    'get_matches': setup_get_matches,
+    'match_prosit_to_observed': setup_match_prosit_to_observed,
+    'calculate_spectral_angle': setup_calculate_spectral_angle,
+    'create_features': setup_create_features,
+    'finalise_input': setup_finalise_input,
+    'run_training': setup_run_training,
+}
+
+def run_benchmarks(names, sizes, repeats):
+    """ Function to run the selected benchmarks at each size.
+
+    Returns
+    -------
+    results : list of dict
+        The time and throughput of each benchmark.
+    """
+    results = []
+    for name in names:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as folder:
+                bench_func = BENCHMARKS[name](size, folder)
+                seconds = time_call(bench_func, repeats)
+            results.append({
+                'benchmark': name,
+                'size': size,
+                'seconds': seconds,
+                'rowsPerSecond': size/seconds,
+            })
+            print(f'{name:>26} n={size:<8} {seconds:10.4f}s {size/seconds:12.1f} rows/s')
+    return results
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='Micro-benchmarks of deltapro hot functions.')
+    parser.add_argument(
+        '--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+        help='The benchmarks to run.',
+    )
+    parser.add_argument(
+        '--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+        help='The number of rows at which each benchmark is run.',
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=3,
+        help='The number of repeats, the fastest is recorded.',
+    )
+    parser.add_argument(
+        '--compare', help='A commit whose saved results are compared against.',
+    )
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmarks and save the results.
+    """
+    args = get_arguments()
+    results = run_benchmarks(args.benchmarks, args.sizes, args.repeats)
+    results_file = save_results(SUITE, results)
+    print(f'Results appended to {results_file}')
+    if args.compare:
+        compare_results(SUITE, results, args.compare)
+
+if __name__ == '__main__':
+    main()
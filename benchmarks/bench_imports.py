@@ -0,0 +1,126 @@
+""" Benchmark of the startup time of the command line interface and of each
+    pipeline module, each imported in a fresh process. Fails if importing
+    deltapro.run loads any of the heavy libraries only needed by some
+    pipelines, or if the import of deltapro.run exceeds --max-seconds.
+
+Usage:
+    python -m benchmarks.bench_imports --repeats 5 --max-seconds 1.0
+"""
+from argparse import ArgumentParser
+import json
+import subprocess
+import sys
+
+from benchmarks.bench_pipeline import REPO_FOLDER
+from benchmarks.common import save_results
+
+SUITE = 'imports'
+HEAVY_MODULES = [
+    'logomaker',
+    'matplotlib',
+    'plotly',
+    'pyteomics',
+    'scipy',
+    'sklearn',
+    'tkinter',
+    'xgboost',
+]
+IMPORTED_MODULES = {
+    'cli': 'deltapro.run',
+    'flipSequences': 'deltapro.flip_residues',
+    'preprocess': 'deltapro.preprocess',
+    'train': 'deltapro.train_model',
+    'analyse': 'deltapro.analyse',
+    'predict': 'deltapro.predict',
+    'serve': 'deltapro.server',
+    'updateModel': 'deltapro.update_model',
+    'compact': 'deltapro.compact_model',
+    'evaluate': 'deltapro.evaluate_model',
+    'runShards': 'deltapro.shards',
+}
+IMPORT_SCRIPT = '''
+import importlib, json, sys, time
+start_time = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start_time
+heavy = sorted({name.split('.')[0] for name in sys.modules} & set(sys.argv[2:]))
+print(json.dumps({'seconds': seconds, 'heavyModules': heavy}))
+'''
+
+
+def time_import(module, repeats):
+    """ Function to time importing a module in a fresh process.
+
+    Returns
+    -------
+    seconds : float
+        The fastest import time of all repeats.
+    heavy_modules : list of str
+        The heavy libraries loaded by the import.
+    """
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT, module, *HEAVY_MODULES],
+            cwd=REPO_FOLDER, capture_output=True, text=True, check=True,
+        ).stdout
+        import_stats = json.loads(output.strip().splitlines()[-1])
+        timings.append(import_stats['seconds'])
+    return min(timings), import_stats['heavyModules']
+
+def run_benchmark(pipelines, repeats):
+    """ Function to time the import of the command line interface and of the
+        module of each pipeline.
+
+    Returns
+    -------
+    results : list of dict
+        The import time and heavy libraries loaded for each module.
+    """
+    results = []
+    for pipeline in pipelines:
+        seconds, heavy_modules = time_import(IMPORTED_MODULES[pipeline], repeats)
+        results.append({
+            'benchmark': pipeline,
+            'module': IMPORTED_MODULES[pipeline],
+            'seconds': seconds,
+            'heavyModules': heavy_modules,
+        })
+        print(f'{pipeline:>14} {seconds*1000:10.1f} ms  {", ".join(heavy_modules)}')
+    return results
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='Benchmark of the import time of deltapro.')
+    parser.add_argument(
+        '--pipelines', nargs='+', choices=list(IMPORTED_MODULES), default=list(IMPORTED_MODULES),
+        help='The modules imported, cli for deltapro.run.',
+    )
+    parser.add_argument('--repeats', type=int, default=5, help='The number of repeats of each timing.')
+    parser.add_argument(
+        '--max-seconds', type=float, default=None,
+        help='Fail if importing deltapro.run takes longer than this.',
+    )
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmark, save the results and check that the
+        command line interface stays light.
+    """
+    args = get_arguments()
+    pipelines = ['cli'] + [pipeline for pipeline in args.pipelines if pipeline != 'cli']
+    results = run_benchmark(pipelines, args.repeats)
+    save_results(SUITE, results)
+
+    cli_result = results[0]
+    if cli_result['heavyModules']:
+        sys.exit(f'Importing deltapro.run loads {", ".join(cli_result["heavyModules"])}.')
+    if args.max_seconds is not None and cli_result['seconds'] > args.max_seconds:
+        sys.exit(
+            f'Importing deltapro.run took {cli_result["seconds"]:.2f}s, '
+            f'more than {args.max_seconds:.2f}s.'
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+""" Benchmark of loading and predicting with models saved in the native XGBoost
+    format against the pickle format, using a depth 16 model trained on
+    synthetic features.
+
+Usage:
+    python -m benchmarks.bench_model_format --train-rows 100000 --sizes 1 1000 100000
+"""
+from argparse import ArgumentParser
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+from benchmarks.bench_functions import make_training_df
+from benchmarks.common import save_results, time_call
+from deltapro.constants import FEATURE_SET
+from deltapro.model_io import get_model_path, load_booster, predict_features, save_model
+from deltapro import train_model
+
+SUITE = 'modelFormat'
+SETTINGS = {
+    'Default': {
+        'min_child_weight': 2,
+        'max_depth': 16,
+        'learning_rate': 0.15,
+        'gamma': 0.1,
+        'colsample_bytree': 0.9,
+    }
+}
+
+
+def load_pickle(folder):
+    """ Function to load a pickled model as train_model previously did.
+    """
+    with open(get_model_path(folder, 'Default', 'pickle'), 'rb') as model_file:
+        return pickle.load(model_file)
+
+def run_benchmark(train_rows, sizes, repeats):
+    """ Function to save a model in both formats and time loading and
+        prediction with each.
+
+    Returns
+    -------
+    results : list of dict
+        The load times, model sizes and prediction throughputs.
+    """
+    train_df = make_training_df(train_rows)
+    model = train_model.run_training(train_df, 'Default', SETTINGS)
+    folder = tempfile.mkdtemp(prefix='deltaproBench')
+    try:
+        native_folder = f'{folder}/native'
+        pickle_folder = f'{folder}/pickle'
+        for format_folder in (native_folder, pickle_folder):
+            os.makedirs(f'{format_folder}/model')
+        native_size = save_model(model, native_folder, 'Default', 'native')
+        pickle_size = save_model(model, pickle_folder, 'Default', 'pickle')
+
+        results = [
+            {
+                'benchmark': 'loadNative',
+                'size': native_size,
+                'seconds': time_call(lambda: load_booster(native_folder, 'Default'), repeats),
+            },
+            {
+                'benchmark': 'loadPickle',
+                'size': pickle_size,
+                'seconds': time_call(lambda: load_pickle(pickle_folder), repeats),
+            },
+        ]
+
+        booster = load_booster(native_folder, 'Default')
+        pickled_model = load_pickle(pickle_folder)
+        for size in sizes:
+            features_df = make_training_df(size, seed=size)[FEATURE_SET]
+            expected = pickled_model.predict(features_df.values)
+            assert np.allclose(predict_features(booster, features_df.values), expected, atol=1e-5)
+            for name, func in (
+                ('predictPickle', lambda: pickled_model.predict(features_df.values)),
+                ('predictInplace', lambda: predict_features(booster, features_df.values)),
+            ):
+                seconds = time_call(func, repeats)
+                results.append({
+                    'benchmark': name,
+                    'size': size,
+                    'seconds': seconds,
+                    'rowsPerSecond': size/seconds,
+                })
+    finally:
+        shutil.rmtree(folder)
+
+    for result in results:
+        print(f'{result["benchmark"]:>15} size={result["size"]:<10} {result["seconds"]*1000:10.2f} ms')
+    return results
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='Benchmark of the native and pickle model formats.')
+    parser.add_argument(
+        '--train-rows', type=int, default=100_000, help='The number of rows the model is trained on.',
+    )
+    parser.add_argument(
+        '--sizes', nargs='+', type=int, default=[1, 1000, 100_000],
+        help='The numbers of rows predicted.',
+    )
+    parser.add_argument('--repeats', type=int, default=5, help='The number of repeats of each timing.')
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmark and save the results.
+    """
+    args = get_arguments()
+    results = run_benchmark(args.train_rows, args.sizes, args.repeats)
+    save_results(SUITE, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+""" End-to-end throughput benchmark of the flipSequences, preprocess and train
+    pipelines on the example dataset replicated to several scales.
+
+The example search results are copied once per scale factor, each copy
+assigned to its own raw file. As the example scan files are not shipped,
+spectra for every PSM are generated with benchmarks.synthetic_data and the
+Prosit predictions for the flipped sequences are synthesised between the
+flipSequences and preprocess pipelines.
+
+Usage:
+    python -m benchmarks.bench_pipeline --scales 1 10 --n-cores 1 4 --compare <commit>
+"""
+from argparse import ArgumentParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import yaml
+
+from benchmarks.common import RESULTS_FOLDER, load_results, save_results
+from benchmarks.synthetic_data import write_mgf_files, write_prosit_predictions
+from deltapro.cache import hash_file
+from deltapro.profiling import RSS_UNIT
+
+EXAMPLE_CONFIG = 'example/config.yml'
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGE_OUTPUTS = {
+    'flipSequences': ['flippedSeqs.csv'] + [f'prositInput{idx}.csv' for idx in range(6)],
+    'preprocess': ['spectralData.csv', 'trainData.csv', 'testData.csv'],
+    'train': ['modelPerformance.csv'],
+}
+SUITE = 'pipeline'
+
+
+def build_scaled_example(folder, scale, n_cores):
+    """ Function to replicate the example dataset scale times.
+
+    Parameters
+    ----------
+    folder : str
+        The folder where the dataset is written.
+    scale : int
+        The number of copies of the example search results.
+    n_cores : int
+        The nCores value of the config.
+
+    Returns
+    -------
+    config_file : str
+        The config file for the scaled dataset.
+    """
+    with open(f'{REPO_FOLDER}/{EXAMPLE_CONFIG}', 'r', encoding='UTF-8') as stream:
+        example_config = yaml.safe_load(stream)
+
+    os.makedirs(f'{folder}/data', exist_ok=True)
+    search_files = []
+    collision_energies = {}
+    psm_dfs = []
+    for search_file in example_config['searchFiles']:
+        search_df = pd.read_csv(f'{REPO_FOLDER}/{search_file}')
+        original_sources = search_df['Source File'].str.replace(
+            '.raw', '', regex=False
+        ).str.replace('.mgf', '', regex=False).str.replace('.mzML', '', regex=False)
+        for copy_idx in range(scale):
+            sources = original_sources + f'_x{copy_idx}'
+            copy_df = search_df.copy()
+            copy_df['Source File'] = sources + '.raw'
+            copy_file = f'{folder}/data/search_x{copy_idx}_{os.path.basename(search_file)}'
+            copy_df.to_csv(copy_file, index=False)
+            search_files.append(copy_file)
+
+            for original, source in zip(original_sources, sources):
+                collision_energies[source] = example_config['collisionEnergies'][original]
+            psm_dfs.append(pd.DataFrame({
+                'source': sources,
+                'scan': search_df['Scan'].apply(lambda x : int(str(x).split(':')[-1])),
+                'peptide': search_df['Peptide'].str.replace(
+                    'M(+15.99)', 'm', regex=False
+                ).str.replace('C(+57.02)', 'C', regex=False),
+                'charge': search_df['Z'],
+            }))
+
+    psm_df = pd.concat(psm_dfs).drop_duplicates(subset=['source', 'scan'])
+    scan_files = write_mgf_files(psm_df, f'{folder}/data')
+
+    config_file = f'{folder}/config.yml'
+    with open(config_file, 'w', encoding='UTF-8') as out_file:
+        yaml.safe_dump(
+            {
+                'searchFiles': search_files,
+                'collisionEnergies': collision_energies,
+                'nFlips': example_config['nFlips'],
+                'nCores': n_cores,
+                'outputFolder': f'{folder}/output',
+                'scanFiles': scan_files,
+                'bestModel': example_config['bestModel'],
+                'useStageCache': False,
+            },
+            out_file,
+        )
+    return config_file
+
+def run_stage(config_file, pipeline):
+    """ Function to run a pipeline through deltapro.run.main in a subprocess.
+
+    Returns
+    -------
+    seconds : float
+        The wall time of the pipeline.
+    peak_rss_mb : float
+        The peak resident set size of the subprocess.
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable, '-c',
+            'import sys; from deltapro.run import main; sys.argv = sys.argv[1:]; main()',
+            'deltapro', '--config_file', config_file, '--pipeline', pipeline,
+        ],
+        cwd=REPO_FOLDER,
+    )
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f'Pipeline {pipeline} failed.')
+    return seconds, usage.ru_maxrss*RSS_UNIT/1_048_576
+
+def run_benchmark(scale, n_cores, keep_folder=None):
+    """ Function to run all pipelines on the example dataset at one scale.
+
+    Returns
+    -------
+    results : list of dict
+        The throughput, peak memory and output checksums of each pipeline.
+    """
+    folder = keep_folder or tempfile.mkdtemp(prefix='deltaproBench')
+    try:
+        config_file = build_scaled_example(folder, scale, n_cores)
+        output_folder = f'{folder}/output'
+        results = []
+        n_psms = None
+        for pipeline in ('flipSequences', 'preprocess', 'train'):
+            if pipeline == 'preprocess':
+                write_prosit_predictions(output_folder)
+            seconds, peak_rss_mb = run_stage(config_file, pipeline)
+            if n_psms is None:
+                n_psms = pd.read_csv(f'{output_folder}/flippedSeqs.csv', usecols=['peptide']).shape[0]
+            results.append({
+                'benchmark': pipeline,
+                'size': scale,
+                'nCores': n_cores,
+                'psms': n_psms,
+                'seconds': seconds,
+                'psmsPerSecond': n_psms/seconds,
+                'peakRssMb': peak_rss_mb,
+                'checksums': {
+                    out_file: hash_file(f'{output_folder}/{out_file}')
+                    for out_file in STAGE_OUTPUTS[pipeline]
+                },
+            })
+            print(
+                f'{pipeline:>14} scale={scale:<4} nCores={n_cores:<3} {seconds:9.2f}s '
+                f'{n_psms/seconds:10.1f} PSMs/s {peak_rss_mb:9.1f} MB'
+            )
+    finally:
+        if keep_folder is None:
+            shutil.rmtree(folder)
+    return results
+
+def compare_checksums(results, baseline_commit):
+    """ Function to check whether the outputs of each pipeline are identical to
+        those recorded for a baseline commit at the same scale.
+    """
+    baseline = {}
+    for result in load_results(SUITE):
+        if result['commit'].startswith(baseline_commit):
+            baseline[(result['benchmark'], result['size'], result['nCores'])] = result
+
+    print(f'\nComparison with {baseline_commit}:')
+    for result in results:
+        key = (result['benchmark'], result['size'], result['nCores'])
+        if key not in baseline:
+            print(f'\t{key[0]} (scale={key[1]}, nCores={key[2]}): no baseline')
+            continue
+        speed_up = result['psmsPerSecond']/baseline[key]['psmsPerSecond']
+        changed = [
+            out_file for out_file, checksum in result['checksums'].items()
+            if baseline[key]['checksums'].get(out_file) != checksum
+        ]
+        status = f'outputs changed: {", ".join(changed)}' if changed else 'outputs identical'
+        print(f'\t{key[0]} (scale={key[1]}, nCores={key[2]}): {speed_up:.2f}x, {status}')
+
+def plot_scaling():
+    """ Function to plot PSMs per second against dataset size for each
+        pipeline and nCores value in the recorded history.
+    """
+    import plotly.graph_objects as go
+
+    history_df = pd.DataFrame(load_results(SUITE))
+    fig = go.Figure()
+    for (pipeline, n_cores), group_df in history_df.groupby(['benchmark', 'nCores']):
+        group_df = group_df.groupby('psms', as_index=False)['psmsPerSecond'].max()
+        fig.add_trace(go.Scatter(
+            x=group_df['psms'],
+            y=group_df['psmsPerSecond'],
+            mode='lines+markers',
+            name=f'{pipeline} (nCores={n_cores})',
+        ))
+    fig.update_layout(
+        xaxis={'title_text': 'PSMs', 'type': 'log'},
+        yaxis={'title_text': 'PSMs per second'},
+    )
+    fig.write_html(f'{RESULTS_FOLDER}/pipelineScaling.html')
+    print(f'Scaling plot written to {RESULTS_FOLDER}/pipelineScaling.html')
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='End-to-end benchmark of the deltapro pipelines.')
+    parser.add_argument(
+        '--scales', nargs='+', type=int, default=[1],
+        help='The number of copies of the example dataset.',
+    )
+    parser.add_argument(
+        '--n-cores', nargs='+', type=int, default=[1],
+        help='The nCores values to benchmark.',
+    )
+    parser.add_argument(
+        '--keep-folder', help='Write the data to this folder and do not delete it.',
+    )
+    parser.add_argument(
+        '--compare', help='A commit whose saved results are compared against.',
+    )
+    parser.add_argument(
+        '--plot', action='store_true', help='Plot scaling curves from the saved history.',
+    )
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmark and save the results.
+    """
+    args = get_arguments()
+    results = []
+    for n_cores in args.n_cores:
+        for scale in args.scales:
+            keep_folder = None
+            if args.keep_folder is not None:
+                keep_folder = f'{args.keep_folder}/scale{scale}_cores{n_cores}'
+            results.extend(run_benchmark(scale, n_cores, keep_folder))
+    results_file = save_results(SUITE, results)
+    print(f'Results appended to {results_file}')
+    if args.compare:
+        compare_checksums(results, args.compare)
+    if args.plot:
+        plot_scaling()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+""" Latency benchmark of the local prediction server under concurrent load,
+    using a model trained on synthetic features.
+
+Usage:
+    python -m benchmarks.bench_server --clients 16 --requests 200 --rows 1
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.bench_functions import make_training_df
+from benchmarks.common import save_results
+from deltapro.constants import FEATURE_SET
+from deltapro.model_io import predict_features
+from deltapro.server import create_server, request_predictions
+from deltapro import train_model
+
+SUITE = 'server'
+SETTINGS = {'Default': {'max_depth': 8}}
+
+
+def run_benchmark(n_clients, n_requests, n_rows, max_batch_rows, max_wait_ms):
+    """ Function to start a server on a free port and send requests from
+        several concurrent clients.
+
+    Returns
+    -------
+    result : dict
+        The throughput and latency percentiles observed by the clients and
+        the batching statistics of the server.
+    """
+    train_df = make_training_df(10_000)
+    model = train_model.run_training(train_df, 'Default', SETTINGS)
+    booster = model.get_booster()
+    server = create_server(
+        lambda features : predict_features(booster, features), 0, max_batch_rows, max_wait_ms
+    )
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rows = train_df[FEATURE_SET].head(n_rows).to_dict(orient='records')
+    expected = model.predict(train_df[FEATURE_SET].head(n_rows).values)
+
+    def client(_):
+        latencies = []
+        for _ in range(n_requests):
+            start_time = time.perf_counter()
+            predictions = request_predictions(rows, port)
+            latencies.append((time.perf_counter() - start_time)*1000)
+        assert np.allclose(predictions, expected, atol=1e-5)
+        return latencies
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(n_clients) as executor:
+        latencies = np.concatenate(list(executor.map(client, range(n_clients))))
+    total_time = time.perf_counter() - start_time
+    server_stats = server.batcher.stats()
+    server.shutdown()
+    server.server_close()
+
+    return {
+        'benchmark': 'server',
+        'size': n_rows,
+        'clients': n_clients,
+        'requestsPerSecond': latencies.size/total_time,
+        'clientLatencyMs': {
+            f'p{pct}': float(np.percentile(latencies, pct)) for pct in (50, 90, 99)
+        },
+        'server': server_stats,
+    }
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='Latency benchmark of the deltapro prediction server.')
+    parser.add_argument('--clients', type=int, default=16, help='The number of concurrent clients.')
+    parser.add_argument('--requests', type=int, default=200, help='The number of requests per client.')
+    parser.add_argument('--rows', type=int, default=1, help='The number of rows per request.')
+    parser.add_argument('--max-batch-rows', type=int, default=4096, help='The server batch limit.')
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='The server batch wait.')
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmark and save the results.
+    """
+    args = get_arguments()
+    result = run_benchmark(
+        args.clients, args.requests, args.rows, args.max_batch_rows, args.max_wait_ms
+    )
+    print(
+        f'{result["requestsPerSecond"]:.1f} requests/s, client latency (ms): '
+        f'{result["clientLatencyMs"]}, mean batch rows: {result["server"]["meanBatchRows"]:.1f}'
+    )
+    save_results(SUITE, [result])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+""" Benchmark of the numpy tree evaluator against the native xgboost path,
+    comparing the startup time of a fresh worker process and the prediction
+    throughput at several batch sizes.
+
+Usage:
+    python -m benchmarks.bench_tree_eval --train-rows 100000 --sizes 1 1000 100000
+"""
+from argparse import ArgumentParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.bench_functions import make_training_df
+from benchmarks.bench_model_format import SETTINGS
+from benchmarks.bench_pipeline import REPO_FOLDER
+from benchmarks.common import save_results, time_call
+from deltapro.constants import FEATURE_SET
+from deltapro.model_io import export_tree_arrays, load_booster, predict_features, save_model
+from deltapro.tree_eval import load_tree_arrays, predict_tree_arrays
+from deltapro import train_model
+
+SUITE = 'treeEval'
+STARTUP_SCRIPTS = {
+    'startupNative': (
+        'import sys; from deltapro.model_io import load_booster; '
+        'load_booster(sys.argv[1], "Default")'
+    ),
+    'startupNumpy': (
+        'import sys; from deltapro.tree_eval import load_tree_arrays; '
+        'load_tree_arrays(sys.argv[1], "Default")'
+    ),
+}
+
+
+def time_startup(script, folder, repeats):
+    """ Function to time importing and loading a model in a fresh process.
+    """
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-c', script, folder], cwd=REPO_FOLDER, check=True)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+def run_benchmark(train_rows, sizes, repeats):
+    """ Function to export a model and time startup and prediction with the
+        numpy and native backends.
+
+    Returns
+    -------
+    results : list of dict
+        The startup times and prediction throughputs.
+    """
+    train_df = make_training_df(train_rows)
+    model = train_model.run_training(train_df, 'Default', SETTINGS)
+    folder = tempfile.mkdtemp(prefix='deltaproBench')
+    try:
+        os.makedirs(f'{folder}/model')
+        save_model(model, folder, 'Default')
+        export_tree_arrays(model.get_booster(), folder, 'Default')
+
+        results = [
+            {
+                'benchmark': name,
+                'size': 0,
+                'seconds': time_startup(script, folder, repeats),
+            }
+            for name, script in STARTUP_SCRIPTS.items()
+        ]
+
+        booster = load_booster(folder, 'Default')
+        tree_arrays = load_tree_arrays(folder, 'Default', FEATURE_SET)
+        for size in sizes:
+            features = make_training_df(size, seed=size)[FEATURE_SET].values
+            expected = model.predict(features)
+            assert np.allclose(predict_tree_arrays(tree_arrays, features), expected, atol=1e-4)
+            for name, func in (
+                ('predictNative', lambda: predict_features(booster, features)),
+                ('predictNumpy', lambda: predict_tree_arrays(tree_arrays, features)),
+            ):
+                seconds = time_call(func, repeats)
+                results.append({
+                    'benchmark': name,
+                    'size': size,
+                    'seconds': seconds,
+                    'rowsPerSecond': size/seconds,
+                })
+    finally:
+        shutil.rmtree(folder)
+
+    for result in results:
+        print(f'{result["benchmark"]:>14} size={result["size"]:<10} {result["seconds"]*1000:10.2f} ms')
+    return results
+
+def get_arguments():
+    """ Function to collect command line arguments.
+    """
+    parser = ArgumentParser(description='Benchmark of the numpy tree evaluator.')
+    parser.add_argument(
+        '--train-rows', type=int, default=100_000, help='The number of rows the model is trained on.',
+    )
+    parser.add_argument(
+        '--sizes', nargs='+', type=int, default=[1, 1000, 100_000],
+        help='The numbers of rows predicted.',
+    )
+    parser.add_argument('--repeats', type=int, default=5, help='The number of repeats of each timing.')
+    return parser.parse_args()
+
+def main():
+    """ Function to run the benchmark and save the results.
+    """
+    args = get_arguments()
+    results = run_benchmark(args.train_rows, args.sizes, args.repeats)
+    save_results(SUITE, results)
+
+if __name__ == '__main__':
+    main()
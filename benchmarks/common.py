@@ -0,0 +1,115 @@
+""" Helper functions shared by the benchmark scripts.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def get_commit():
+    """ Function to get the current git commit, marked dirty if the working
+        tree has uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{commit}-dirty' if dirty else commit
+
+def time_call(func, repeats=3):
+    """ Function to time a function of no arguments.
+
+    Parameters
+    ----------
+    func : function
+        The function to be timed.
+    repeats : int
+        The number of times the function is run.
+
+    Returns
+    -------
+    seconds : float
+        The fastest wall time of all repeats.
+    """
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+def save_results(suite, results):
+    """ Function to append benchmark results to the jsonl history of a suite,
+        tagged with the commit, time and machine.
+
+    Parameters
+    ----------
+    suite : str
+        The name of the benchmark suite.
+    results : list of dict
+        The benchmark results.
+
+    Returns
+    -------
+    results_file : str
+        The file the results were appended to.
+    """
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    results_file = f'{RESULTS_FOLDER}/{suite}.jsonl'
+    run_info = {
+        'commit': get_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': platform.node(),
+        'python': platform.python_version(),
+    }
+    with open(results_file, 'a', encoding='UTF-8') as out_file:
+        for result in results:
+            out_file.write(json.dumps({**run_info, **result}) + '\n')
+    return results_file
+
+def load_results(suite):
+    """ Function to load the jsonl history of a benchmark suite.
+    """
+    results_file = f'{RESULTS_FOLDER}/{suite}.jsonl'
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file, 'r', encoding='UTF-8') as in_file:
+        return [json.loads(line) for line in in_file if line.strip()]
+
+def compare_results(suite, results, baseline_commit, metric='rowsPerSecond'):
+    """ Function to print the speed up of the latest results relative to the
+        most recent results recorded for a baseline commit.
+
+    Parameters
+    ----------
+    suite : str
+        The name of the benchmark suite.
+    results : list of dict
+        The latest benchmark results.
+    baseline_commit : str
+        The commit to compare against.
+    metric : str
+        The throughput metric to compare, higher is better.
+    """
+    baseline = {}
+    for result in load_results(suite):
+        if result['commit'].startswith(baseline_commit):
+            baseline[(result['benchmark'], result['size'])] = result[metric]
+
+    print(f'\nComparison with {baseline_commit}:')
+    for result in results:
+        key = (result['benchmark'], result['size'])
+        if key in baseline and baseline[key]:
+            print(f'\t{key[0]} (n={key[1]}): {result[metric]/baseline[key]:.2f}x')
+        else:
+            print(f'\t{key[0]} (n={key[1]}): no baseline')
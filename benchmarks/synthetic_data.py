@@ -0,0 +1,315 @@
+""" Functions to generate synthetic PEAKS search results, mgf scan files and
+    Prosit msp predictions consistent with the files in example/.
+"""
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from deltapro.constants import PROTON
+from deltapro.spectral_match import get_ion_mzs
+
+AMINO_ACIDS = 'ADEFGHIKLMNPQRSTVWY'
+COLLISION_ENERGY = 33
+FRACTION = 2
+PEAKS_COLUMNS = [
+    'Peptide', '-10lgP', 'Mass', 'Length', 'ppm', 'm/z', 'Z', 'RT', 'Area',
+    'Fraction', 'Id', 'Scan', 'from Chimera', 'Source File', 'Accession', 'PTM',
+    'AScore', 'Found By',
+]
+H2O_MASS = 18.010565
+
+
+def _sequence_rng(sequence, charge):
+    """ Function to get a random generator seeded by a sequence and charge, so
+        that the same peptide always has the same fragmentation pattern.
+    """
+    return np.random.default_rng(zlib.crc32(f'{sequence}/{charge}'.encode('UTF-8')))
+
+def fragment_intensities(sequence, charge):
+    """ Function to generate a deterministic fragment intensity pattern for a
+        peptide in the deltapro sequence format (m for oxidised methionine).
+
+    Parameters
+    ----------
+    sequence : str
+        The peptide sequence.
+    charge : int
+        The precursor charge.
+
+    Returns
+    -------
+    intensities : dict
+        A dictionary mapping Prosit ion codes (e.g. y3, b4^2) to intensity.
+    """
+    rng = _sequence_rng(sequence, charge)
+    intensities = {}
+    for frag_charge in range(1, min(charge, 3) + 1):
+        suffix = '' if frag_charge == 1 else f'^{frag_charge}'
+        for ion_type in ('b', 'y'):
+            for frag_idx in range(1, len(sequence)):
+                if rng.random() < 0.6/frag_charge:
+                    intensities[f'{ion_type}{frag_idx}{suffix}'] = rng.random()
+    if intensities:
+        max_inte = max(intensities.values())
+        intensities = {ion: inte/max_inte for ion, inte in intensities.items()}
+    return intensities
+
+def precursor_mz(sequence, charge):
+    """ Function to compute the precursor m/z of a peptide.
+    """
+    _, residue_mass = get_ion_mzs(sequence, {0: 0.0})
+    return (residue_mass + H2O_MASS + charge*PROTON)/charge
+
+def generate_psms(n_psms, n_sources=1, seed=42):
+    """ Function to generate random PSMs.
+
+    Parameters
+    ----------
+    n_psms : int
+        The number of PSMs to generate.
+    n_sources : int
+        The number of raw files the PSMs are spread across.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    psm_df : pd.DataFrame
+        A DataFrame with source, scan, peptide (deltapro format) and charge columns.
+    """
+    rng = np.random.default_rng(seed)
+    peptides = []
+    for pep_len in rng.integers(8, 16, size=n_psms):
+        residues = rng.choice(list(AMINO_ACIDS), size=pep_len)
+        peptides.append(''.join(
+            'm' if res == 'M' and rng.random() < 0.3 else res for res in residues
+        ))
+    return pd.DataFrame({
+        'source': [f'synthetic{idx % n_sources}' for idx in range(n_psms)],
+        'scan': np.arange(n_psms) + 1000,
+        'peptide': peptides,
+        'charge': rng.choice([1, 2, 3], size=n_psms, p=[0.1, 0.7, 0.2]),
+    })
+
+def write_search_file(psm_df, search_file, seed=42):
+    """ Function to write PSMs as a PEAKS search result csv.
+    """
+    rng = np.random.default_rng(seed)
+    n_psms = psm_df.shape[0]
+    search_df = pd.DataFrame({
+        'Peptide': psm_df['peptide'].str.replace('m', 'M(+15.99)', regex=False),
+        '-10lgP': np.round(rng.uniform(5, 60, size=n_psms), 2),
+        'Mass': [
+            precursor_mz(pep, 1) - PROTON for pep in psm_df['peptide']
+        ],
+        'Length': psm_df['peptide'].apply(len),
+        'ppm': np.round(rng.normal(0, 2, size=n_psms), 1),
+        'm/z': [
+            precursor_mz(pep, charge) for pep, charge in zip(psm_df['peptide'], psm_df['charge'])
+        ],
+        'Z': psm_df['charge'],
+        'RT': np.round(rng.uniform(10, 90, size=n_psms), 2),
+        'Area': np.round(rng.uniform(1e4, 1e6, size=n_psms)),
+        'Fraction': FRACTION,
+        'Id': np.arange(n_psms),
+        'Scan': [f'F{FRACTION}:{scan}' for scan in psm_df['scan']],
+        'from Chimera': 'No',
+        'Source File': psm_df['source'] + '.raw',
+        'Accession': 'SYNTHETIC',
+        'PTM': psm_df['peptide'].apply(lambda x : 'Oxidation (M)' if 'm' in x else ''),
+        'AScore': '',
+        'Found By': 'PEAKS DB',
+    })
+    search_df[PEAKS_COLUMNS].to_csv(search_file, index=False)
+
+def write_mgf_files(psm_df, folder, n_noise_peaks=50, seed=42):
+    """ Function to write one mgf file per source with a spectrum for every PSM.
+        Each spectrum contains the noisy fragment pattern of the peptide and
+        random noise peaks.
+
+    Returns
+    -------
+    mgf_files : list of str
+        The mgf files written.
+    """
+    rng = np.random.default_rng(seed)
+    mgf_files = []
+    for source, source_df in psm_df.groupby('source', sort=True):
+        mgf_file = f'{folder}/{source}.mgf'
+        with open(mgf_file, 'w', encoding='UTF-8') as out_file:
+            for _, psm in source_df.iterrows():
+                ion_mzs, _ = get_ion_mzs(psm['peptide'], {0: 0.0})
+                mzs = []
+                intensities = []
+                for ion, inte in fragment_intensities(psm['peptide'], psm['charge']).items():
+                    ion_type = ion[0] + ion[ion.index('^'):] if '^' in ion else ion[0]
+                    frag_idx = int(ion.split('^')[0][1:]) - 1
+                    mzs.append(ion_mzs[ion_type][frag_idx] + rng.normal(0, 0.005))
+                    intensities.append(inte*rng.uniform(0.5, 1.5)*1e4)
+                mzs.extend(rng.uniform(100, 1500, size=n_noise_peaks))
+                intensities.extend(rng.uniform(0, 2e3, size=n_noise_peaks))
+                order = np.argsort(mzs)
+
+                out_file.write('BEGIN IONS\n')
+                out_file.write(f'TITLE={source}.{psm["scan"]}.{psm["scan"]}.{psm["charge"]}\n')
+                out_file.write(f'PEPMASS={precursor_mz(psm["peptide"], psm["charge"]):.6f}\n')
+                out_file.write(f'CHARGE={psm["charge"]}+\n')
+                out_file.write(f'SCANS={psm["scan"]}\n')
+                for peak_idx in order:
+                    out_file.write(f'{mzs[peak_idx]:.5f} {intensities[peak_idx]:.2f}\n')
+                out_file.write('END IONS\n\n')
+        mgf_files.append(mgf_file)
+    return mgf_files
+
+def write_msp(sequences, charges, collision_energies, msp_file):
+    """ Function to write synthetic Prosit predictions in msp format.
+
+    Parameters
+    ----------
+    sequences : list of str
+        Peptide sequences in the deltapro format (m for oxidised methionine).
+    charges : list of int
+        The precursor charges.
+    collision_energies : list of float
+        The collision energies.
+    msp_file : str
+        The file to be written.
+    """
+    with open(msp_file, 'w', encoding='UTF-8') as out_file:
+        for sequence, charge, collision_energy in zip(sequences, charges, collision_energies):
+            plain_seq = sequence.upper()
+            ox_positions = [idx + 1 for idx, res in enumerate(sequence) if res == 'm']
+            parent = precursor_mz(sequence, charge)
+            mod_details = ''.join(f'/{pos-1},M,Oxidation' for pos in ox_positions)
+            mod_string = '; '.join(f'Oxidation@M{pos}' for pos in ox_positions)
+            intensities = fragment_intensities(sequence, charge)
+
+            out_file.write(f'Name: {plain_seq}/{charge}\n')
+            out_file.write(f'MW: {parent}\n')
+            out_file.write(
+                f'Comment: Parent={parent} Collision_energy={float(collision_energy)} '
+                f'Mods={len(ox_positions)}{mod_details} '
+                f'ModString={plain_seq}//{mod_string}/{charge} iRT=0.0\n'
+            )
+            out_file.write(f'Num peaks: {len(intensities)}\n')
+            for ion, inte in intensities.items():
+                ion_label = f'{ion})' if '^' in ion else ion
+                out_file.write(f'0.0\t{inte}\t"{ion_label}/0.0ppm"\n')
+
+def write_msp_from_prosit_input(prosit_input_file, msp_file):
+    """ Function to write synthetic Prosit predictions for every row of a
+        prositInput csv file, in place of running Prosit.
+    """
+    prosit_df = pd.read_csv(prosit_input_file)
+    write_msp(
+        prosit_df['modified_sequence'].str.replace('M(ox)', 'm', regex=False).tolist(),
+        prosit_df['precursor_charge'].astype(int).tolist(),
+        prosit_df['collision_energy'].tolist(),
+        msp_file,
+    )
+
+def generate_dataset(folder, n_psms, n_sources=1, n_cores=1, seed=42):
+    """ Function to write a search file, mgf files and config file for a
+        synthetic dataset.
+
+    Parameters
+    ----------
+    folder : str
+        The folder where the dataset is written.
+    n_psms : int
+        The number of PSMs.
+    n_sources : int
+        The number of raw files.
+    n_cores : int
+        The nCores value of the config.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    config_file : str
+        The config file for running deltapro on the dataset. Its outputFolder
+        is folder/output.
+    """
+    os.makedirs(f'{folder}/data', exist_ok=True)
+    psm_df = generate_psms(n_psms, n_sources, seed)
+    write_search_file(psm_df, f'{folder}/data/search.csv', seed)
+    mgf_files = write_mgf_files(psm_df, f'{folder}/data', seed=seed)
+
+    config_file = f'{folder}/config.yml'
+    with open(config_file, 'w', encoding='UTF-8') as out_file:
+        yaml.safe_dump(
+            {
+                'searchFiles': [f'{folder}/data/search.csv'],
+                'collisionEnergies': {
+                    source: COLLISION_ENERGY for source in sorted(psm_df['source'].unique())
+                },
+                'nFlips': 5,
+                'nCores': n_cores,
+                'outputFolder': f'{folder}/output',
+                'scanFiles': mgf_files,
+                'bestModel': 'Default',
+            },
+            out_file,
+        )
+    return config_file
+
+def write_prosit_predictions(output_folder, n_flips=5):
+    """ Function to write synthetic prositPredictions msp files for all of the
+        prositInput files produced by flipSequences.
+    """
+    for idx in range(n_flips + 1):
+        write_msp_from_prosit_input(
+            f'{output_folder}/prositInput{idx}.csv',
+            f'{output_folder}/prositPredictions{idx}.msp',
+        )
+
+def make_spectral_df(n_rows, seed=42):
+    """ Function to generate a DataFrame in the format of spectralData.csv,
+        with the Prosit and matched ions as dictionaries.
+    """
+    rng = np.random.default_rng(seed)
+    psm_df = generate_psms(n_rows, seed=seed)
+    spec_df = psm_df.copy()
+    spec_df['collisionEnergy'] = COLLISION_ENERGY
+    spec_df['prositIons'] = [
+        fragment_intensities(pep, charge)
+        for pep, charge in zip(spec_df['peptide'], spec_df['charge'])
+    ]
+    spec_df['prositMatchedIons'] = [
+        {ion: inte*rng.uniform(0.5, 1.5) for ion, inte in ions.items() if rng.random() < 0.8}
+        for ions in spec_df['prositIons']
+    ]
+    spec_df['spectralAngle'] = rng.uniform(0.2, 1.0, size=n_rows)
+    spec_df['matchedCoverage'] = rng.uniform(0.0, 1.0, size=n_rows)
+    spec_df['nMatchedDivFrags'] = rng.uniform(0.0, 2.0, size=n_rows)
+    for idx in range(1, 6):
+        flip_inds = [rng.integers(1, len(pep)) for pep in spec_df['peptide']]
+        spec_df[f'flip{idx}'] = [
+            pep[:ind-1] + pep[ind] + pep[ind-1] + pep[ind+1:]
+            for pep, ind in zip(spec_df['peptide'], flip_inds)
+        ]
+        spec_df[f'flipInd{idx}'] = flip_inds
+        spec_df[f'flipYNewIntensity{idx}'] = rng.uniform(0.0, 0.5, size=n_rows)
+        spec_df[f'flipBNewIntensity{idx}'] = rng.uniform(0.0, 0.5, size=n_rows)
+        spec_df[f'flipSpectralAngle{idx}'] = rng.uniform(0.0, 1.0, size=n_rows)
+    return spec_df
+
+def make_observed_spectrum(sequence, charge, n_noise_peaks=50, seed=42):
+    """ Function to generate observed m/z and intensity arrays for a peptide.
+    """
+    rng = np.random.default_rng(seed)
+    ion_mzs, _ = get_ion_mzs(sequence, {0: 0.0})
+    mzs = []
+    intensities = []
+    for ion, inte in fragment_intensities(sequence, charge).items():
+        ion_type = ion[0] + ion[ion.index('^'):] if '^' in ion else ion[0]
+        mzs.append(ion_mzs[ion_type][int(ion.split('^')[0][1:]) - 1])
+        intensities.append(inte*1e4)
+    mzs.extend(rng.uniform(100, 1500, size=n_noise_peaks))
+    intensities.extend(rng.uniform(0, 2e3, size=n_noise_peaks))
+    order = np.argsort(mzs)
+    return np.array(mzs)[order], np.array(intensities)[order]
@@ -1,5 +1,7 @@
 
 from math import ceil
+import os
+
 import logomaker
 import numpy as np
 import pandas as pd
@@ -9,7 +11,12 @@ import plotly.graph_objects as go
 import plotly.figure_factory as ff
 import plotly.io as pio
 
+from deltapro.cache import hash_file, load_hash_index, save_hash_index
+from deltapro.feature_store import iter_final_chunks
+
 AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+DENSITY_BINS = 200
+SCATTER_MAX_ROWS = 50_000
 
 
 def plot_model_perf_with_depth(config):
@@ -58,32 +65,80 @@ def plot_model_perf_with_depth(config):
     )
     return [train_r2_trace, test_r2_trace, train_pearson_trace, test_pearson_trace], [model_size_trace]
 
+def compute_position_frequencies(peptides):
+    """ Function to count the amino acids at each position of the peptides of
+        every length. Peptides of one length are encoded as a 2d byte array so
+        all positions are counted at once.
+
+    Parameters
+    ----------
+    peptides : pd.Series
+        The peptide sequences, without modifications.
+
+    Returns
+    -------
+    position_counts : dict
+        A 2d array of counts of shape (peptide length, len(AMINO_ACIDS)) for
+        each peptide length.
+    """
+    aa_codes = np.full(256, -1, dtype=np.int64)
+    aa_codes[np.frombuffer(AMINO_ACIDS.encode('ascii'), dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+    pep_lens = peptides.str.len()
+
+    position_counts = {}
+    for pep_len in np.unique(pep_lens):
+        len_peptides = peptides[pep_lens == pep_len]
+        encoded = aa_codes[
+            np.frombuffer(''.join(len_peptides).encode('ascii'), dtype=np.uint8)
+        ].reshape(-1, pep_len)
+        positions = np.broadcast_to(np.arange(pep_len), encoded.shape)
+        known = encoded >= 0
+        position_counts[int(pep_len)] = np.bincount(
+            positions[known]*len(AMINO_ACIDS) + encoded[known],
+            minlength=pep_len*len(AMINO_ACIDS),
+        ).reshape(pep_len, len(AMINO_ACIDS))
+    return position_counts
+
+def load_position_frequencies(output_folder):
+    """ Function to load the position frequency matrices of the flipped
+        sequences, computing them only if flippedSeqs.csv has changed since
+        they were cached in flippedSeqsPfm.npz.
+    """
+    seqs_file = f'{output_folder}/flippedSeqs.csv'
+    pfm_file = f'{output_folder}/flippedSeqsPfm.npz'
+    hash_index = load_hash_index(output_folder)
+    seqs_hash = hash_file(seqs_file, hash_index)
+    save_hash_index(output_folder, hash_index)
+
+    if os.path.exists(pfm_file):
+        with np.load(pfm_file) as npz_file:
+            if str(npz_file['sourceHash']) == seqs_hash:
+                return {
+                    int(key[3:]): npz_file[key] for key in npz_file.files if key.startswith('len')
+                }
+
+    peptides = pd.read_csv(seqs_file, usecols=['peptide'])['peptide'].str.replace(
+        r'\.|_|\[UNIMOD:35\]|\[UNIMOD:4\]', '', regex=True
+    ).str.replace('m', 'M', regex=False)
+    position_counts = compute_position_frequencies(peptides)
+    np.savez(
+        pfm_file,
+        sourceHash=np.array(seqs_hash),
+        **{f'len{pep_len}': counts for pep_len, counts in position_counts.items()},
+    )
+    return position_counts
+
 def create_logo_plot(config):
     fig, plt_axes = plt.subplots(1, 4, figsize=(12, 3))
 
-    train_dfs = []
-    for i in range(1, 6):
-        x = pd.read_csv(f'{config.output_folder}/flippedSeqs.csv', usecols=['peptide'])
-        x['peptide'] = x['peptide'].apply(
-            lambda pep : pep.replace('.', '').replace('_', '').replace('[UNIMOD:35]', '').replace('[UNIMOD:4]', '').replace('m', 'M')
-        )
-        x['len'] = x['peptide'].apply(len)
-        train_dfs.append(x)
-    full_train_df = pd.concat(train_dfs)
+    position_counts = load_position_frequencies(config.output_folder)
     y_lim = 0.0
     for len_idx, pep_len in enumerate(range(8, 12)):
-        len_df = full_train_df[full_train_df['len'] == pep_len]
-        total = len_df.shape[0]
-        if total == 0:
+        if pep_len not in position_counts:
             continue
 
-        aa_counts = np.zeros([pep_len, len(AMINO_ACIDS)])
-        for _, df_row in len_df.iterrows():
-            for pos_idx, aa in enumerate(df_row['peptide']):
-                aa_counts[pos_idx, AMINO_ACIDS.index(aa)] += 1
-
         count_df = pd.DataFrame(
-            aa_counts,
+            position_counts[pep_len],
             columns=list(AMINO_ACIDS)
         )
 
@@ -139,13 +194,68 @@ def get_imp_trace(config):
         name='Feature Importance'
     )
 
-def plot_best_performance(config):
-    preds_df = pd.read_csv(f'{config.output_folder}/testPreds.csv')
-    preds_df['locint'] = preds_df['bIntesAtLoc'] + preds_df['yIntesAtLoc']
+def iter_best_predictions(config):
+    """ Function to stream the test data columns used in the performance plots
+        alongside the predictions of the best model.
+
+    Yields
+    ------
+    preds_df : pd.DataFrame
+        The next chunk of true and predicted deltas, intensity at location and
+        spectral angle.
+    """
+    data_chunks = iter_final_chunks(
+        f'{config.output_folder}/testData.csv',
+        config.chunk_size,
+        columns=['specAngleDiff', 'bIntesAtLoc', 'yIntesAtLoc', 'spectralAngle'],
+    )
+    pred_reader = pd.read_csv(
+        f'{config.output_folder}/testPreds{config.best_model}.csv', iterator=True
+    )
+    for data_df in data_chunks:
+        # Parts of the feature store may differ in size from chunkSize.
+        pred_df = pred_reader.get_chunk(data_df.shape[0])
+        yield pd.DataFrame({
+            'predictedDiff': pred_df[f'predictedDiff{config.best_model}'].values,
+            'specAngleDiff': data_df['specAngleDiff'].values,
+            'locint': (data_df['bIntesAtLoc'] + data_df['yIntesAtLoc']).values,
+            'spectralAngle': data_df['spectralAngle'].values,
+        })
+
+def get_density_traces(bin_counts, bin_sums):
+    """ Function to create heatmaps of the mean colour value in each bin of
+        predicted against true delta.
+    """
+    bin_centres = np.linspace(-1, 1, DENSITY_BINS + 1)[:-1] + 1/DENSITY_BINS
+    counts = bin_counts.reshape(DENSITY_BINS, DENSITY_BINS)
+    traces = []
+    for colour_col, colourbar in (
+        ('locint', {'x':0.4, 'y':0.5, 'len': 0.25, 'ticks': 'outside'}),
+        ('spectralAngle', {'y':0.5, 'len': 0.25, 'ticks': 'outside'}),
+    ):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_colour = bin_sums[colour_col].reshape(DENSITY_BINS, DENSITY_BINS)/counts
+        traces.append(go.Heatmap(
+            x=bin_centres,
+            y=bin_centres,
+            z=np.where(counts > 0, mean_colour, np.nan),
+            customdata=counts,
+            hovertemplate='Predicted: %{x:.2f}<br>True: %{y:.2f}<br>Mean: %{z:.2f}<br>Count: %{customdata}<extra></extra>',
+            colorscale='Bluered',
+            zmin=0,
+            zmax=1,
+            colorbar=colourbar,
+            name='Test Data',
+        ))
+    return traces
 
+def get_scatter_traces(preds_df):
+    """ Function to create scatter plots of predicted against true delta with
+        a marker for every row.
+    """
     return [
         go.Scatter(
-            x=preds_df[f'predictedDiff{config.best_model}'],
+            x=preds_df['predictedDiff'],
             y=preds_df['specAngleDiff'],
             mode = 'markers',
             marker_color=preds_df['locint'],
@@ -157,7 +267,7 @@ def plot_best_performance(config):
             name='Test Data',
         ),
         go.Scatter(
-            x=preds_df[f'predictedDiff{config.best_model}'],
+            x=preds_df['predictedDiff'],
             y=preds_df['specAngleDiff'],
             mode = 'markers',
             marker_color=preds_df['spectralAngle'],
@@ -170,6 +280,56 @@ def plot_best_performance(config):
         ),
     ]
 
+def plot_best_performance(config):
+    """ Function to plot predicted against true delta on the test data, coloured
+        by intensity at location and by spectral angle. The test data is read
+        in chunks and binned into 2d histograms, so the size of the figure is
+        bounded. In auto mode, datasets of at most SCATTER_MAX_ROWS rows are
+        instead plotted point by point.
+    """
+    bin_counts = np.zeros(DENSITY_BINS*DENSITY_BINS, dtype=np.int64)
+    bin_sums = {
+        colour_col: np.zeros(DENSITY_BINS*DENSITY_BINS) for colour_col in ('locint', 'spectralAngle')
+    }
+    keep_rows = config.analyse_plot_mode in ('auto', 'scatter')
+    kept_dfs = []
+    n_rows = 0
+    for preds_df in iter_best_predictions(config):
+        n_rows += preds_df.shape[0]
+        if keep_rows:
+            kept_dfs.append(preds_df)
+            if config.analyse_plot_mode == 'auto' and n_rows > SCATTER_MAX_ROWS:
+                keep_rows = False
+                kept_dfs = []
+        if config.analyse_plot_mode == 'scatter':
+            continue
+
+        x_bins, y_bins = [
+            np.clip(
+                np.floor((preds_df[col].values + 1)/2*DENSITY_BINS).astype(np.int64),
+                0,
+                DENSITY_BINS - 1,
+            )
+            for col in ('predictedDiff', 'specAngleDiff')
+        ]
+        flat_bins = y_bins*DENSITY_BINS + x_bins
+        bin_counts += np.bincount(flat_bins, minlength=DENSITY_BINS*DENSITY_BINS)
+        for colour_col, colour_sums in bin_sums.items():
+            colour_sums += np.bincount(
+                flat_bins,
+                weights=preds_df[colour_col].fillna(0).values,
+                minlength=DENSITY_BINS*DENSITY_BINS,
+            )
+
+    if keep_rows:
+        if not kept_dfs:
+            # An empty test set gives empty scatter plots.
+            kept_dfs = [
+                pd.DataFrame(columns=['predictedDiff', 'specAngleDiff', 'locint', 'spectralAngle'])
+            ]
+        return get_scatter_traces(pd.concat(kept_dfs))
+    return get_density_traces(bin_counts, bin_sums)
+
 
 def analyse(config):
     # create_logo_plot(config)
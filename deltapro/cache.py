@@ -0,0 +1,266 @@
+""" Functions for caching the outputs of pipeline stages under a key derived
+    from the content of their inputs and the config values they depend on.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from deltapro.profiling import PROFILER
+
+CACHE_FOLDER = 'stageCache'
+CACHE_REPORT_FILE = 'stageCacheReport.csv'
+CACHE_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+HASH_INDEX_FILE = 'fileHashes.json'
+MANIFEST_FILE = 'manifest.json'
+MAX_ENTRIES_PER_STAGE = 3
+
+
+def load_hash_index(output_folder):
+    """ Function to load the index of previously computed file hashes.
+
+    Parameters
+    ----------
+    output_folder : str
+        The folder where all output is written.
+
+    Returns
+    -------
+    hash_index : dict
+        A dictionary mapping absolute file paths to their size, modification
+        time and sha256 digest.
+    """
+    index_path = f'{output_folder}/{CACHE_FOLDER}/{HASH_INDEX_FILE}'
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r', encoding='UTF-8') as index_file:
+        return json.load(index_file)
+
+def save_hash_index(output_folder, hash_index):
+    """ Function to write the index of computed file hashes.
+    """
+    os.makedirs(f'{output_folder}/{CACHE_FOLDER}', exist_ok=True)
+    with open(
+        f'{output_folder}/{CACHE_FOLDER}/{HASH_INDEX_FILE}', 'w', encoding='UTF-8'
+    ) as index_file:
+        json.dump(hash_index, index_file)
+
+def hash_file(file_path, hash_index=None):
+    """ Function to compute the sha256 digest of a file's content. Digests are
+        memoised on file size and modification time so unchanged inputs are
+        only read once.
+
+    Parameters
+    ----------
+    file_path : str
+        The file to be hashed.
+    hash_index : dict or None
+        The index of previously computed hashes, updated in place.
+
+    Returns
+    -------
+    digest : str or None
+        The hex digest of the file content or None if the file does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    abs_path = os.path.abspath(file_path)
+    file_stat = os.stat(abs_path)
+    if hash_index is not None:
+        known = hash_index.get(abs_path)
+        if (
+            known is not None and
+            known['size'] == file_stat.st_size and
+            known['mtime'] == file_stat.st_mtime_ns
+        ):
+            return known['sha256']
+
+    sha = hashlib.sha256()
+    with open(abs_path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if hash_index is not None:
+        hash_index[abs_path] = {
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime_ns,
+            'sha256': digest,
+        }
+    return digest
+
+def compute_stage_key(stage_name, input_files, settings, hash_index=None):
+    """ Function to compute the cache key for a stage from the content of its
+        input files and the config values which affect its output.
+
+    Parameters
+    ----------
+    stage_name : str
+        The name of the stage.
+    input_files : list of str
+        The files read by the stage.
+    settings : dict
+        JSON serialisable config values used by the stage.
+    hash_index : dict or None
+        The index of previously computed hashes.
+
+    Returns
+    -------
+    key : str
+        The hex digest identifying this combination of inputs.
+    """
+    key_data = {
+        'version': CACHE_VERSION,
+        'stage': stage_name,
+        'inputs': [
+            [os.path.basename(in_file), hash_file(in_file, hash_index)]
+            for in_file in input_files
+        ],
+        'settings': settings,
+    }
+    return hashlib.sha256(
+        json.dumps(key_data, sort_keys=True, default=str).encode('UTF-8')
+    ).hexdigest()
+
+def _restore_outputs(entry_folder, manifest, output_files, hash_index):
+    """ Function to copy cached outputs back into place where the current file
+        is missing or differs from the cached version.
+    """
+    for out_file in output_files:
+        cached_hash = manifest['outputs'][os.path.basename(out_file)]
+        if hash_file(out_file, hash_index) != cached_hash:
+            shutil.copyfile(f'{entry_folder}/{os.path.basename(out_file)}', out_file)
+            hash_file(out_file, hash_index)
+
+def _store_outputs(stage_folder, key, output_files, hash_index):
+    """ Function to copy the outputs of a stage into the cache.
+    """
+    entry_folder = f'{stage_folder}/{key}'
+    if os.path.exists(entry_folder):
+        shutil.rmtree(entry_folder)
+    os.makedirs(entry_folder)
+
+    manifest = {'key': key, 'outputs': {}}
+    for out_file in output_files:
+        shutil.copyfile(out_file, f'{entry_folder}/{os.path.basename(out_file)}')
+        manifest['outputs'][os.path.basename(out_file)] = hash_file(out_file, hash_index)
+
+    with open(f'{entry_folder}/{MANIFEST_FILE}', 'w', encoding='UTF-8') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    entries = sorted(
+        [f'{stage_folder}/{entry}' for entry in os.listdir(stage_folder)],
+        key=os.path.getmtime,
+    )
+    for old_entry in entries[:-MAX_ENTRIES_PER_STAGE]:
+        shutil.rmtree(old_entry)
+
+def _load_manifest(entry_folder, output_files):
+    """ Function to load the manifest of a cache entry, returning None if the
+        entry is incomplete.
+    """
+    manifest_path = f'{entry_folder}/{MANIFEST_FILE}'
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='UTF-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    for out_file in output_files:
+        if (
+            os.path.basename(out_file) not in manifest['outputs'] or
+            not os.path.exists(f'{entry_folder}/{os.path.basename(out_file)}')
+        ):
+            return None
+    return manifest
+
+def run_cached_stage(
+        config, stage_name, stage_func, input_files, output_files, settings=None
+    ):
+    """ Function to run a pipeline stage, reusing its cached outputs if the
+        stage has previously been run on identical inputs and settings.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    stage_name : str
+        The name of the stage.
+    stage_func : function
+        A function of no arguments which runs the stage.
+    input_files : list of str
+        The files read by the stage.
+    output_files : list of str
+        The files written by the stage.
+    settings : dict or None
+        JSON serialisable config values used by the stage.
+
+    Returns
+    -------
+    report : dict
+        A dictionary describing whether the stage was reused or computed.
+    """
+    with PROFILER.stage(stage_name) as record:
+        report = _run_stage(
+            config, stage_name, stage_func, input_files, output_files, settings
+        )
+        record['cacheStatus'] = report['status']
+    return report
+
+def _run_stage(config, stage_name, stage_func, input_files, output_files, settings):
+    """ Function to run a stage or restore its outputs from the cache.
+    """
+    start_time = time.time()
+    if not config.use_stage_cache:
+        stage_func()
+        return {
+            'stage': stage_name,
+            'status': 'computed',
+            'key': None,
+            'seconds': time.time() - start_time,
+        }
+
+    hash_index = load_hash_index(config.output_folder)
+    key = compute_stage_key(stage_name, input_files, settings or {}, hash_index)
+    stage_folder = f'{config.output_folder}/{CACHE_FOLDER}/{stage_name}'
+    entry_folder = f'{stage_folder}/{key}'
+
+    manifest = _load_manifest(entry_folder, output_files)
+    if manifest is not None:
+        _restore_outputs(entry_folder, manifest, output_files, hash_index)
+        os.utime(entry_folder)
+        status = 'reused'
+    else:
+        stage_func()
+        _store_outputs(stage_folder, key, output_files, hash_index)
+        status = 'computed'
+
+    save_hash_index(config.output_folder, hash_index)
+    return {
+        'stage': stage_name,
+        'status': status,
+        'key': key,
+        'seconds': time.time() - start_time,
+    }
+
+def write_cache_report(output_folder, reports):
+    """ Function to print and save a report of which stages were reused.
+
+    Parameters
+    ----------
+    output_folder : str
+        The folder where all output is written.
+    reports : list of dict
+        The reports returned by run_cached_stage.
+    """
+    print('\nStage cache report:')
+    for report in reports:
+        print(f'\t{report["stage"]}: {report["status"]} ({report["seconds"]:.1f}s)')
+
+    with open(f'{output_folder}/{CACHE_REPORT_FILE}', 'w', encoding='UTF-8') as report_file:
+        report_file.write('stage,status,key,seconds\n')
+        for report in reports:
+            report_file.write(
+                f'{report["stage"]},{report["status"]},{report["key"] or ""},'
+                f'{report["seconds"]:.3f}\n'
+            )
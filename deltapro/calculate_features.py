@@ -1,4 +1,7 @@
 import json
+import os
+import zlib
+
 import numpy as np
 import pandas as pd
 
@@ -7,9 +10,14 @@ from sklearn.model_selection import GroupShuffleSplit
 import multiprocessing
 from multiprocessing import Pool
 from deltapro.constants import MZ_ACCURACY
+from deltapro.data_io import append_to_csv
 from deltapro.mgf import process_mgf_file
+from deltapro.profiling import PROFILER
 from deltapro.spectral_match import get_ion_mzs, get_matches
 
+PEPTIDE_SPLIT_FILE = 'peptideSplit.csv'
+TEST_FRACTION = 0.2
+
 
 def get_intes_at_loc(pep_len, true_ions, loc, letter):
     sum_inte = 0
@@ -116,38 +124,166 @@ def stratify(x):
         return 3
     return 4
 
+def assign_split_by_hash(peptide):
+    """ Function to deterministically assign a peptide not seen before to the
+        train or test set, independent of the other peptides in the dataset.
+
+    Parameters
+    ----------
+    peptide : str
+        The peptide sequence.
+
+    Returns
+    -------
+    split : str
+        Either 'train' or 'test'.
+    """
+    if zlib.crc32(peptide.encode('UTF-8')) % 100 < TEST_FRACTION*100:
+        return 'test'
+    return 'train'
+
+def assign_grouped_split(peptides):
+    """ Function to assign the peptides of a full dataset to the train or test
+        set with GroupShuffleSplit.
+
+    The assignment depends only on the set of distinct peptides, as
+    GroupShuffleSplit shuffles the sorted unique groups, so it is the same
+    whether computed from every PSM or from the peptides collected from
+    several shards.
+
+    Parameters
+    ----------
+    peptides : pd.Series
+        The peptide of each PSM, or the distinct peptides.
+
+    Returns
+    -------
+    split_df : pd.DataFrame
+        A DataFrame with peptide and split columns for each distinct peptide.
+    """
+    unique_peptides = np.unique(peptides.astype(str))
+    splitter = GroupShuffleSplit(test_size=TEST_FRACTION, n_splits=2, random_state=42)
+    train_inds, test_inds = next(splitter.split(unique_peptides, groups=unique_peptides))
+    return pd.concat([
+        pd.DataFrame({'peptide': unique_peptides[train_inds], 'split': 'train'}),
+        pd.DataFrame({'peptide': unique_peptides[test_inds], 'split': 'test'}),
+    ])
+
+def load_peptide_split(folder):
+    """ Function to load the train/test assignment of every peptide already
+        processed, reconstructing it from the featured data if necessary.
+
+    Parameters
+    ----------
+    folder : str
+        The output folder.
+
+    Returns
+    -------
+    split_df : pd.DataFrame
+        A DataFrame with peptide and split columns.
+    """
+    if os.path.exists(f'{folder}/{PEPTIDE_SPLIT_FILE}'):
+        return pd.read_csv(f'{folder}/{PEPTIDE_SPLIT_FILE}')
+
+    split_dfs = []
+    for tt in ('train', 'test'):
+        for idx in range(1, 6):
+            if os.path.exists(f'{folder}/{tt}FeatedData{idx}.csv'):
+                tt_df = pd.read_csv(f'{folder}/{tt}FeatedData{idx}.csv', usecols=['peptide'])
+                tt_df['split'] = tt
+                split_dfs.append(tt_df)
+    if not split_dfs:
+        return pd.DataFrame({'peptide': pd.Series(dtype=str), 'split': pd.Series(dtype=str)})
+    return pd.concat(split_dfs).drop_duplicates(subset=['peptide'])
+
+def split_by_peptide(spec_df, split_df):
+    """ Function to split PSMs into train and test sets, keeping the recorded
+        assignment of known peptides and assigning new peptides by hash.
+
+    Parameters
+    ----------
+    spec_df : pd.DataFrame
+        The spectral data to be split.
+    split_df : pd.DataFrame
+        The recorded peptide assignments.
+
+    Returns
+    -------
+    train : pd.DataFrame
+        The PSMs assigned to the training set.
+    test : pd.DataFrame
+        The PSMs assigned to the test set.
+    split_df : pd.DataFrame
+        The updated peptide assignments.
+    """
+    known_splits = dict(zip(split_df['peptide'], split_df['split']))
+    new_peptides = [
+        peptide for peptide in spec_df['peptide'].unique() if peptide not in known_splits
+    ]
+    new_split_df = pd.DataFrame({
+        'peptide': pd.Series(new_peptides, dtype=str),
+        'split': pd.Series([assign_split_by_hash(pep) for pep in new_peptides], dtype=str),
+    })
+    known_splits.update(zip(new_split_df['peptide'], new_split_df['split']))
+
+    splits = spec_df['peptide'].map(known_splits)
+    return (
+        spec_df[splits == 'train'],
+        spec_df[splits == 'test'],
+        pd.concat([split_df, new_split_df]),
+    )
+
 def calculate_features(folder, config):
     """ Function to compute all of the input feature for the deltapro predictor.
+
+    If config.incremental is set, only the rows of spectralDataIncrement.csv are
+    processed. Peptides already seen keep their train/test assignment, the
+    featured rows are written to the {tt}FeatedDataIncrement files and appended
+    to the existing featured data.
     """
-    spec_df = pd.read_csv(f'{folder}/spectralData.csv')
+    if config.incremental:
+        spec_df = pd.read_csv(f'{folder}/spectralDataIncrement.csv')
+    else:
+        spec_df = pd.read_csv(f'{folder}/spectralData.csv')
     spec_df['prositIons'] = spec_df['prositIons'].apply(json.loads)
     spec_df['prositMatchedIons'] = spec_df['prositMatchedIons'].apply(json.loads)
     spec_df['saStrata'] = spec_df['spectralAngle'].apply(stratify)
-    # train, test = train_test_split(spec_df, test_size=0.2, stratify=spec_df['saStrata'])
-    splitter = GroupShuffleSplit(test_size=.20, n_splits=2, random_state=42)
-    split = splitter.split(spec_df, groups=spec_df['peptide'])
-    train_inds, test_inds = next(split)
-    train = spec_df.iloc[train_inds]
-    test = spec_df.iloc[test_inds]
 
-    for idx in range(1, 6):
-        process_chunk(train, test, idx, folder, config.scan_files)
+    if config.incremental:
+        train, test, split_df = split_by_peptide(spec_df, load_peptide_split(folder))
+    else:
+        # train, test = train_test_split(spec_df, test_size=0.2, stratify=spec_df['saStrata'])
+        split_df = assign_grouped_split(spec_df['peptide'])
+        splits = spec_df['peptide'].map(dict(zip(split_df['peptide'], split_df['split'])))
+        train = spec_df[splits == 'train']
+        test = spec_df[splits == 'test']
+    split_df.to_csv(f'{folder}/{PEPTIDE_SPLIT_FILE}', index=False)
 
-def process_chunk(train, test, idx, folder, scan_files):
-    print(idx)
-
-    print(train.shape)
+    for idx in range(1, 6):
+        process_chunk(train, test, idx, folder, config.scan_files, config.incremental)
 
-    train = train.apply(
+def featurise(spec_df, idx):
+    """ Function to compute the features of a single flip for a set of PSMs,
+        dropping PSMs for which the features could not be computed.
+    """
+    if spec_df.shape[0] == 0:
+        return spec_df.drop(['prositIons', 'prositMatchedIons'], axis=1)
+    spec_df = spec_df.apply(
         lambda x : create_features(x, idx),
         axis=1,
     )
-    train = train[train['nFlip'] != 'x']
-    train.drop(['prositIons', 'prositMatchedIons'], axis=1).to_csv(f'{folder}/trainFeatedData{idx}.csv', index=False)
+    spec_df = spec_df[spec_df['nFlip'] != 'x']
+    return spec_df.drop(['prositIons', 'prositMatchedIons'], axis=1)
 
-    test = test.apply(
-        lambda x : create_features(x, idx),
-        axis=1,
-    )
-    test = test[test['nFlip'] != 'x']
-    test.drop(['prositIons', 'prositMatchedIons'], axis=1).to_csv(f'{folder}/testFeatedData{idx}.csv', index=False)
+def process_chunk(train, test, idx, folder, scan_files, incremental=False):
+    for tt, tt_df in (('train', train), ('test', test)):
+        with PROFILER.stage(f'features{idx}', rows_in=tt_df.shape[0], split=tt) as record:
+            tt_df = featurise(tt_df, idx)
+            record['rowsOut'] = tt_df.shape[0]
+        with PROFILER.stage(f'writeFeatures{idx}', rows_in=tt_df.shape[0], split=tt):
+            if incremental:
+                tt_df.to_csv(f'{folder}/{tt}FeatedDataIncrement{idx}.csv', index=False)
+                append_to_csv(tt_df, f'{folder}/{tt}FeatedData{idx}.csv')
+            else:
+                tt_df.to_csv(f'{folder}/{tt}FeatedData{idx}.csv', index=False)
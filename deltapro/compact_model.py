@@ -0,0 +1,169 @@
+""" Functions for producing smaller, faster variants of a trained model for
+    deployment, either by keeping only the first trees of the ensemble or by
+    distilling its predictions into a shallower model.
+"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr
+from sklearn.metrics import r2_score
+import xgboost as xgb
+
+from deltapro.constants import FEATURE_SET
+from deltapro.model_io import (
+    export_tree_arrays,
+    get_model_path,
+    get_saved_format,
+    load_booster,
+    load_metadata,
+    predict_features,
+    save_model,
+)
+from deltapro.profiling import PROFILER
+from deltapro.resources import ThreadBudget
+from deltapro.train_model import load_model_inputs
+
+N_LATENCY_CALLS = 200
+
+
+def get_saved_size(folder, identifier):
+    """ Function to get the size of a saved model in bytes, in the format it
+        was saved in, or None if the model file does not exist.
+    """
+    model_format = get_saved_format(folder, identifier, load_metadata(folder, identifier))
+    model_path = get_model_path(folder, identifier, model_format)
+    if os.path.exists(model_path):
+        return os.path.getsize(model_path)
+    return None
+
+def measure_variant(booster, test_features, test_targets):
+    """ Function to measure the single row latency, batch throughput and test
+        performance of a model.
+
+    Returns
+    -------
+    variant_stats : dict
+        The median single row latency in ms, rows per second when predicting
+        the whole test set and the test R2 and Pearson correlation.
+    """
+    single_row = np.ascontiguousarray(test_features[:1])
+    predict_features(booster, single_row)
+    latencies = []
+    for _ in range(N_LATENCY_CALLS):
+        start_time = time.perf_counter()
+        predict_features(booster, single_row)
+        latencies.append((time.perf_counter() - start_time)*1000)
+
+    start_time = time.perf_counter()
+    predictions = predict_features(booster, test_features)
+    batch_seconds = time.perf_counter() - start_time
+
+    return {
+        'nTrees': booster.num_boosted_rounds(),
+        'latencyMs': float(np.median(latencies)),
+        'rowsPerSecond': test_features.shape[0]/batch_seconds,
+        'testr2': r2_score(test_targets, predictions),
+        'testpearson': pearsonr(test_targets, predictions)[0],
+    }
+
+def get_truncated_variants(booster, tree_fractions):
+    """ Function to get variants of a model keeping the first fraction of its
+        trees.
+    """
+    n_trees = booster.num_boosted_rounds()
+    variants = {}
+    for fraction in sorted(tree_fractions):
+        n_kept = max(1, int(round(n_trees*fraction)))
+        if n_kept < n_trees:
+            variants[f'trees{n_kept}'] = booster[:n_kept]
+    return variants
+
+def distil_model(teacher_preds, params, n_rounds, train_features, max_depth, n_threads):
+    """ Function to train a shallower model on the predictions of a model for
+        the training data.
+    """
+    distil_matrix = xgb.QuantileDMatrix(
+        train_features, label=teacher_preds, feature_names=FEATURE_SET, nthread=n_threads
+    )
+    return xgb.train(
+        {**params, 'max_depth': max_depth, 'nthread': n_threads},
+        distil_matrix,
+        num_boost_round=n_rounds,
+    )
+
+def compact_model(config):
+    """ Function to produce the compacted variants of the best model, save them
+        and report their size, latency, throughput and test performance.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    identifier = config.best_model
+    with PROFILER.stage('loadModel', model=identifier):
+        booster = load_booster(config.output_folder, identifier)
+        metadata = load_metadata(config.output_folder, identifier) or {}
+    with PROFILER.stage('loadModelInputs'):
+        train_features, _ = load_model_inputs(f'{config.output_folder}/trainData.csv')
+        test_features, test_targets = load_model_inputs(f'{config.output_folder}/testData.csv')
+
+    variants = get_truncated_variants(booster, config.compact_tree_fractions)
+
+    params = {
+        key: value for key, value in metadata.get('params', {}).items()
+        if value is not None and key not in ('n_estimators', 'n_jobs', 'nthread')
+    }
+    params.setdefault('objective', 'reg:squarederror')
+    params['tree_method'] = 'hist'
+    budget = ThreadBudget(config.n_cores)
+    with budget.limit('distillation') as (_, n_threads):
+        booster.set_param('nthread', n_threads)
+        teacher_preds = predict_features(booster, train_features)
+        for max_depth in config.compact_distil_depths:
+            with PROFILER.stage('distil', rows_in=train_features.shape[0], maxDepth=max_depth):
+                variants[f'depth{max_depth}'] = distil_model(
+                    teacher_preds,
+                    params,
+                    booster.num_boosted_rounds(),
+                    train_features,
+                    max_depth,
+                    n_threads,
+                )
+
+    model_sizes = {'full': get_saved_size(config.output_folder, identifier)}
+    for variant, variant_booster in variants.items():
+        model_sizes[variant] = save_model(
+            variant_booster,
+            config.output_folder,
+            f'{identifier}_{variant}',
+            config.model_format,
+            metadata={
+                'params': params,
+                'baseModel': identifier,
+                'variant': variant,
+                'trainingDataHash': metadata.get('trainingDataHash'),
+            },
+        )
+        export_tree_arrays(variant_booster, config.output_folder, f'{identifier}_{variant}')
+
+    all_stats = []
+    # Latency and throughput are measured with one thread, as in a worker.
+    with budget.limit('measureVariants', n_tasks=budget.n_cores):
+        for variant, variant_booster in {'full': booster, **variants}.items():
+            variant_id = identifier if variant == 'full' else f'{identifier}_{variant}'
+            variant_booster.set_param('nthread', 1)
+            with PROFILER.stage('measureVariant', model=variant_id):
+                variant_stats = measure_variant(variant_booster, test_features, test_targets)
+            all_stats.append({
+                'identifier': variant_id,
+                'variant': variant,
+                'modelSize': model_sizes[variant],
+                **variant_stats,
+            })
+
+    compaction_df = pd.DataFrame(all_stats)
+    compaction_df.to_csv(f'{config.output_folder}/compaction{identifier}.csv', index=False)
+    print(compaction_df.to_string(index=False))
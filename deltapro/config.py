@@ -12,7 +12,44 @@ ALL_CONFIG_KEYS = [
     'outputFolder',
     'scanFiles',
     'nCores',
-    'tuneHyperparameters'
+    'tuneHyperparameters',
+    'useStageCache',
+    'incremental',
+    'predictionFile',
+    'chunkSize',
+    'serverPort',
+    'serverMaxBatchRows',
+    'serverMaxWaitMs',
+    'modelFormat',
+    'predictionBackend',
+    'hptSearch',
+    'hptCandidates',
+    'hptTimeBudget',
+    'hptMaxFits',
+    'outOfCore',
+    'optimisedSettings',
+    'earlyStoppingRounds',
+    'validationFraction',
+    'baseModel',
+    'additionalRounds',
+    'updateDataFile',
+    'compactTreeFractions',
+    'compactDistilDepths',
+    'evaluationFiles',
+    'evaluationGroups',
+    'spearmanMethod',
+    'spearmanBins',
+    'analysePlotMode',
+    'partitionSize',
+    'nShards',
+    'predictionStore',
+    'predictionStoreMaxMb',
+    'spectrumPredictor',
+    'predictorUrl',
+    'predictorModel',
+    'predictorBatchSize',
+    'predictorMaxConcurrency',
+    'featureStore',
 ]
 
 class Config:
@@ -28,6 +65,7 @@ class Config:
             if config_key not in ALL_CONFIG_KEYS:
                 raise ValueError(f'Unrecognised key {config_key} found in config file.')
 
+        self.config_file = config_file
         self._load_data(config_dict)
 
     def _load_data(self, config_dict):
@@ -39,8 +77,53 @@ class Config:
         self.n_flips = config_dict.get('nFlips')
         self.collision_energies = config_dict.get('collisionEnergies')
         self.best_model = config_dict.get('bestModel')
-        self.n_cores = config_dict.get('nCores', 1)
+        self.n_cores = config_dict.get('nCores')
         self.tune_hyperparameters = config_dict.get('tuneHyperparameters', False)
+        self.use_stage_cache = config_dict.get('useStageCache', True)
+        self.incremental = config_dict.get('incremental', False)
+        self.prediction_file = config_dict.get(
+            'predictionFile', f'{self.output_folder}/testData.csv'
+        )
+        self.chunk_size = config_dict.get('chunkSize', 100_000)
+        self.server_port = config_dict.get('serverPort', 8765)
+        self.server_max_batch_rows = config_dict.get('serverMaxBatchRows', 4096)
+        self.server_max_wait_ms = config_dict.get('serverMaxWaitMs', 5)
+        self.model_format = config_dict.get('modelFormat', 'native')
+        self.prediction_backend = config_dict.get('predictionBackend', 'xgboost')
+        self.hpt_search = config_dict.get('hptSearch', 'halving')
+        self.hpt_candidates = config_dict.get('hptCandidates', 50)
+        self.hpt_time_budget = config_dict.get('hptTimeBudget')
+        self.hpt_max_fits = config_dict.get('hptMaxFits')
+        self.out_of_core = config_dict.get('outOfCore', False)
+        self.early_stopping_rounds = config_dict.get('earlyStoppingRounds')
+        self.validation_fraction = config_dict.get('validationFraction', 0.1)
+        self.base_model = config_dict.get('baseModel', self.best_model)
+        self.additional_rounds = config_dict.get('additionalRounds', 20)
+        self.update_data_file = config_dict.get(
+            'updateDataFile', f'{self.output_folder}/trainDataIncrement.csv'
+        )
+        self.compact_tree_fractions = config_dict.get('compactTreeFractions', [0.25, 0.5, 0.75])
+        self.compact_distil_depths = config_dict.get('compactDistilDepths', [4, 6, 8])
+        self.evaluation_files = config_dict.get(
+            'evaluationFiles',
+            [f'{self.output_folder}/trainData.csv', f'{self.output_folder}/testData.csv'],
+        )
+        self.evaluation_groups = config_dict.get(
+            'evaluationGroups', ['charge', 'collisionEnergy', 'pepLen']
+        )
+        self.spearman_method = config_dict.get('spearmanMethod', 'sketch')
+        self.spearman_bins = config_dict.get('spearmanBins', 512)
+        self.analyse_plot_mode = config_dict.get('analysePlotMode', 'auto')
+        self.partition_size = config_dict.get('partitionSize')
+        self.n_shards = config_dict.get('nShards')
+        self.prediction_store = config_dict.get('predictionStore')
+        self.prediction_store_max_mb = config_dict.get('predictionStoreMaxMb')
+        self.spectrum_predictor = config_dict.get('spectrumPredictor')
+        self.predictor_url = config_dict.get('predictorUrl', 'https://koina.wilhelmlab.org:443')
+        self.predictor_model = config_dict.get('predictorModel', 'Prosit_2020_intensity_HCD')
+        self.predictor_batch_size = config_dict.get('predictorBatchSize', 1000)
+        self.predictor_max_concurrency = config_dict.get('predictorMaxConcurrency', 4)
+        self.feature_store = config_dict.get('featureStore', False)
         self.optimised_settings = config_dict.get(
             'optimisedSettings',
             {
@@ -60,7 +143,7 @@ class Config:
         if not os.path.exists(f'{self.output_folder}/model'):
             os.makedirs(f'{self.output_folder}/model')
 
-    def validate(self, pipeline):
+    def validate(self, pipeline, shard=None):
         """ Check that the appropriate Config values have been set for the executed pipeline.
         """
         if self.output_folder is None:
@@ -91,4 +174,52 @@ class Config:
         if self.best_model is None and pipeline == 'analyse':
             raise ValueError(
                 'You must provide a best model to analyse.'
+            )
+
+        if self.best_model is None and pipeline in ('predict', 'serve', 'compact', 'evaluate'):
+            raise ValueError(
+                'You must provide a best model to predict with.'
+            )
+
+        if self.partition_size is not None and self.incremental and pipeline == 'preprocess':
+            raise ValueError(
+                'Partitioned preprocessing cannot be combined with incremental.'
+            )
+
+        if self.n_shards is None and (
+            pipeline in ('planShards', 'mergeShards', 'runShards') or shard is not None
+        ):
+            raise ValueError(
+                'You must specify nShards in the config to run shards.'
+            )
+
+        if shard is not None and (pipeline != 'preprocess' or not 0 <= shard < self.n_shards):
+            raise ValueError(
+                '--shard must be used with the preprocess pipeline and be below nShards.'
+            )
+
+        if self.spectrum_predictor is not None and self.prediction_store is None:
+            raise ValueError(
+                'You must specify predictionStore in the config to use a spectrumPredictor.'
+            )
+
+        if self.spectrum_predictor not in (None, 'stub', 'koina'):
+            raise ValueError(
+                'spectrumPredictor must be stub or koina.'
+            )
+
+        if self.analyse_plot_mode not in ('auto', 'scatter', 'density'):
+            raise ValueError(
+                'analysePlotMode must be auto, scatter or density.'
+            )
+
+        if self.base_model is None and pipeline == 'updateModel':
+            raise ValueError(
+                'You must provide a baseModel or bestModel to update.'
+            )
+
+        if pipeline == 'updateModel' and not os.path.exists(self.update_data_file):
+            raise ValueError(
+                f'updateDataFile {self.update_data_file} does not exist. Set updateDataFile in '
+                'the config or run preprocess with incremental to create trainDataIncrement.csv.'
             )
\ No newline at end of file
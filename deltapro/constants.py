@@ -204,3 +204,31 @@ ION_OFFSET = {
     "b": N_TERMINUS - H,
     "y": C_TERMINUS + H,
 }
+
+FEATURE_SET = [
+    'spectralAngle',
+    'blosumC',
+    'blosumN',
+    'nTermDist',
+    'cTermDist',
+    'charge',
+    'cNeighbourBlosum',
+    'nNeighbourBlosum',
+    'yErrsAtLoc',
+    'bErrsAtLoc',
+    'collisionEnergy',
+    'bIntesAtC',
+    'yIntesAtN',
+    'yIntesAtLoc',
+    'bIntesAtLoc',
+    'yMatchedIntesAtN',
+    'bMatchedIntesAtC',
+    'yMatchedIntesAtLoc',
+    'bMatchedIntesAtLoc',
+    'cOxidation',
+    'nOxidation',
+    'flipYNewIntensity',
+    'flipBNewIntensity',
+    'matchedCoverage',
+]
+TARGET_VARIABLE = 'specAngleDiff'
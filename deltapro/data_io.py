@@ -0,0 +1,78 @@
+""" Helper functions for reading and writing the intermediate data files.
+"""
+import os
+
+import pandas as pd
+
+
+def append_to_csv(data_df, csv_path):
+    """ Function to append rows to a csv file, aligning the columns with the
+        existing header. The file is created if it does not yet exist.
+
+    Parameters
+    ----------
+    data_df : pd.DataFrame
+        The rows to be written.
+    csv_path : str
+        The csv file to be appended to.
+    """
+    if os.path.exists(csv_path):
+        columns = pd.read_csv(csv_path, nrows=0).columns
+        data_df.reindex(columns=columns).to_csv(
+            csv_path, mode='a', header=False, index=False
+        )
+    else:
+        data_df.to_csv(csv_path, index=False)
+
+def write_empty_like(template_path, csv_path):
+    """ Function to write a csv file with no rows and the same header as an
+        existing csv file.
+
+    Parameters
+    ----------
+    template_path : str
+        The csv file whose header is copied.
+    csv_path : str
+        The csv file to be written.
+    """
+    pd.read_csv(template_path, nrows=0).to_csv(csv_path, index=False)
+
+def get_known_sources(csv_path):
+    """ Function to get the set of source files already present in a csv file.
+
+    Parameters
+    ----------
+    csv_path : str
+        The csv file with a source column.
+
+    Returns
+    -------
+    sources : set of str
+        The sources found, empty if the file does not exist.
+    """
+    if not os.path.exists(csv_path):
+        return set()
+    return set(pd.read_csv(csv_path, usecols=['source'])['source'].astype(str))
+
+def iter_csv_chunks(csv_path, chunk_size, columns=None):
+    """ Function to read a csv file in chunks of rows.
+
+    Parameters
+    ----------
+    csv_path : str
+        The csv file to be read.
+    chunk_size : int
+        The number of rows per chunk.
+    columns : list of str or None
+        The columns to read, columns not present in the file are ignored.
+        If None all columns are read.
+
+    Yields
+    ------
+    chunk_df : pd.DataFrame
+        The next chunk of rows.
+    """
+    usecols = None
+    if columns is not None:
+        usecols = lambda col : col in columns
+    yield from pd.read_csv(csv_path, chunksize=chunk_size, usecols=usecols)
@@ -1,73 +1,267 @@
-from math import comb
-import sys
-import joblib
+""" Functions and classes for evaluating a trained model on finalised data in a
+    single streaming pass, overall and broken down by groups such as charge,
+    collision energy or peptide length.
+"""
+import numpy as np
 import pandas as pd
-from scipy.stats import pearsonr, spearmanr
-from sklearn.metrics import mean_absolute_error, r2_score
-
-FEATURE_SET = [
-    'spectralAngle',
-    'blosumC',
-    'blosumN',
-    'nTermDist',
-    'cTermDist',
-    'charge',
-    'cNeighbourBlosum',
-    'nNeighbourBlosum',
-    'yErrsAtLoc',
-    'bErrsAtLoc',
-    'collisionEnergy',
-    'bIntesAtC',
-    'yIntesAtN',
-    'yIntesAtLoc',
-    'bIntesAtLoc',
-    'yMatchedIntesAtN',
-    'bMatchedIntesAtC',
-    'yMatchedIntesAtLoc',
-    'bMatchedIntesAtLoc',
-    'cOxidation',
-    'nOxidation',
-    'flipYNewIntensity',
-    'flipBNewIntensity',
-    'matchedCoverage',
-]
-TARGET_VARIABLE = 'specAngleDiff'
-from deltapro.constants import BLOSUM6_1_VALUES
-
-def load_data(folder, title, mod_name):
-    combined_df = pd.concat([pd.read_csv(f'{folder}/{tt}Data.csv') for tt in (
-        'train', 'test'
-    )])
-    combined_df.to_csv(f'{folder}/evaluation.csv')
-
-
-    combined_df['pepLen'] = combined_df['peptide'].apply(len)
-    combined_df['nTermDist'] = combined_df['flipInd'].apply(int)
-    combined_df['cTermDist'] = combined_df['pepLen'] - combined_df['nTermDist']
-
-    combined_df['cNeighbourBlosum'] = combined_df['cNeighbour'].apply(lambda x : BLOSUM6_1_VALUES.get(x,-5.0))
-    combined_df['nNeighbourBlosum'] = combined_df['nNeighbour'].apply(lambda x : BLOSUM6_1_VALUES.get(x, -5.0))
-    # mod_name = 'reg15'
-    model = joblib.load(f'outputBig/model/{mod_name}.pkl')
-    print(mod_name)
-    if 'ip' in folder:
-        mini_df = combined_df[combined_df['peptide'] == 'RPLVGQDEF']
-        mini_df[FEATURE_SET].to_csv('temp.csv')
-    combined_df['predictedDiff'] = model.predict(combined_df[FEATURE_SET].values)
-    combined_df.to_csv(f'{folder}/predictions.csv', index=False)
-    model_stats = {
-        f'{title}mae': mean_absolute_error(combined_df[TARGET_VARIABLE], combined_df[f'predictedDiff']),
-        f'{title}r2': r2_score(combined_df[TARGET_VARIABLE], combined_df[f'predictedDiff']),
-        f'{title}pearson': pearsonr(combined_df[TARGET_VARIABLE], combined_df[f'predictedDiff'])[0],
-        f'{title}spearmanr': spearmanr(combined_df[TARGET_VARIABLE], combined_df[f'predictedDiff'])[0],
-    }
-
-    return model_stats
-
-if __name__ == '__main__':
-    mod_name = sys.argv[1]
-    evaluation_folder = sys.argv[2]
-    name = sys.argv[3]
-    eval_perf = load_data(evaluation_folder, name, mod_name)
-    print(eval_perf)
+from scipy.stats import spearmanr
 
+from deltapro.constants import FEATURE_SET, TARGET_VARIABLE
+from deltapro.finalise_input import MODEL_INPUT_COLUMNS
+from deltapro.out_of_core import iter_feature_chunks
+from deltapro.predict import load_predict_func
+from deltapro.profiling import PROFILER
+from deltapro.resources import ThreadBudget
+
+ABS_ERR_ACCURACY = 0.01
+ABS_ERR_RANGE = (1e-9, 1e3)
+WARMUP_ROWS_PER_BIN = 16
+
+
+class StreamingMetrics:
+    """ Holder for running statistics from which the MAE, R2, Pearson and
+        Spearman correlation of a model are computed without keeping the
+        predictions. Means and co-moments are merged batch by batch, which is
+        numerically stable for large datasets.
+
+    Spearman correlation is either exact, keeping float32 copies of the
+    targets and predictions, or estimated from a sparse 2d histogram of
+    targets and predictions. The first n_bins*WARMUP_ROWS_PER_BIN rows are kept
+    exactly, and if more rows arrive the quantiles of those rows become the bin
+    edges of each axis, so bins hold roughly equal numbers of rows whatever
+    the range of the values. All values within a bin are given its midrank,
+    so the rank of every row is within spearmanRankError*nRows of its exact
+    rank, where spearmanRankError is half the largest fraction of rows sharing
+    a bin of either axis. It is reported with the metrics. Only occupied cells
+    of the histogram are stored, so small groups use little memory.
+
+    The median absolute error is estimated from counts of the absolute errors
+    in logarithmic bins, each spanning a factor of (1 + a)/(1 - a) for
+    a = ABS_ERR_ACCURACY, so it is within a relative error of a of the exact
+    median for errors within ABS_ERR_RANGE.
+    """
+    def __init__(self, spearman_method='sketch', n_bins=512):
+        """ Initialise StreamingMetrics object.
+        """
+        if spearman_method not in ('sketch', 'exact'):
+            raise ValueError(f'Unrecognised spearman method {spearman_method}.')
+        self.spearman_method = spearman_method
+        self.n_bins = n_bins
+        self.n_rows = 0
+        self.sum_abs_err = 0.0
+        self.sum_sq_err = 0.0
+        self.mean_target = 0.0
+        self.mean_pred = 0.0
+        self.m2_target = 0.0
+        self.m2_pred = 0.0
+        self.co_moment = 0.0
+        self._targets = []
+        self._preds = []
+        self.target_edges = None
+        self.pred_edges = None
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.cell_counts = np.zeros(0, dtype=np.int64)
+        self._log_gamma = np.log((1 + ABS_ERR_ACCURACY)/(1 - ABS_ERR_ACCURACY))
+        self._abs_err_offset = int(np.ceil(np.log(ABS_ERR_RANGE[0])/self._log_gamma))
+        self.abs_err_counts = np.zeros(
+            int(np.ceil(np.log(ABS_ERR_RANGE[1])/self._log_gamma)) - self._abs_err_offset + 1,
+            dtype=np.int64,
+        )
+
+    def _add_to_sketch(self, targets, predictions):
+        """ Function to add values to the sparse histogram, whose cells are
+            coded as target bin*number of prediction bins + prediction bin.
+        """
+        codes = (
+            np.searchsorted(self.target_edges, targets, side='right')*(self.pred_edges.size + 1) +
+            np.searchsorted(self.pred_edges, predictions, side='right')
+        )
+        codes = np.concatenate([self.cells, codes])
+        counts = np.concatenate([self.cell_counts, np.ones(codes.size - self.cells.size, np.int64)])
+        self.cells, cell_idx = np.unique(codes, return_inverse=True)
+        self.cell_counts = np.bincount(cell_idx, weights=counts).astype(np.int64)
+
+    def _start_sketch(self):
+        """ Function to set the bin edges from the quantiles of the rows kept
+            so far and move those rows into the histogram.
+        """
+        targets = np.concatenate(self._targets)
+        predictions = np.concatenate(self._preds)
+        quantiles = np.linspace(0, 1, self.n_bins + 1)[1:-1]
+        self.target_edges = np.unique(np.quantile(targets, quantiles))
+        self.pred_edges = np.unique(np.quantile(predictions, quantiles))
+        self._targets = []
+        self._preds = []
+        self._add_to_sketch(targets, predictions)
+
+    def update(self, targets, predictions):
+        """ Function to add a batch of targets and predictions.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        predictions = np.asarray(predictions, dtype=np.float64)
+        n_batch = targets.size
+        if n_batch == 0:
+            return
+
+        errors = predictions - targets
+        abs_errors = np.abs(errors)
+        self.sum_abs_err += abs_errors.sum()
+        self.sum_sq_err += np.square(errors).sum()
+        self.abs_err_counts += np.bincount(
+            np.ceil(
+                np.log(np.clip(abs_errors, *ABS_ERR_RANGE))/self._log_gamma
+            ).astype(np.int64) - self._abs_err_offset,
+            minlength=self.abs_err_counts.size,
+        )
+
+        batch_mean_target = targets.mean()
+        batch_mean_pred = predictions.mean()
+        n_total = self.n_rows + n_batch
+        delta_target = batch_mean_target - self.mean_target
+        delta_pred = batch_mean_pred - self.mean_pred
+        weight = self.n_rows*n_batch/n_total
+        self.m2_target += np.square(targets - batch_mean_target).sum() + delta_target**2*weight
+        self.m2_pred += np.square(predictions - batch_mean_pred).sum() + delta_pred**2*weight
+        self.co_moment += (
+            ((targets - batch_mean_target)*(predictions - batch_mean_pred)).sum() +
+            delta_target*delta_pred*weight
+        )
+        self.mean_target += delta_target*n_batch/n_total
+        self.mean_pred += delta_pred*n_batch/n_total
+        self.n_rows = n_total
+
+        if self.target_edges is not None:
+            self._add_to_sketch(targets, predictions)
+            return
+        self._targets.append(targets.astype(np.float32))
+        self._preds.append(predictions.astype(np.float32))
+        if self.spearman_method == 'sketch' and self.n_rows > self.n_bins*WARMUP_ROWS_PER_BIN:
+            self._start_sketch()
+
+    def _sketch_spearman(self):
+        """ Function to estimate the Spearman correlation from the histogram,
+            using the midrank of each bin.
+
+        Returns
+        -------
+        spearman : float
+            The estimated Spearman correlation.
+        rank_error : float
+            The largest error of the rank of any row, as a fraction of the
+            number of rows.
+        """
+        n_pred_bins = self.pred_edges.size + 1
+        target_bins, pred_bins = np.divmod(self.cells, n_pred_bins)
+        counts = self.cell_counts.astype(np.float64)
+        target_totals = np.bincount(
+            target_bins, weights=counts, minlength=self.target_edges.size + 1
+        )
+        pred_totals = np.bincount(pred_bins, weights=counts, minlength=n_pred_bins)
+        mean_rank = (self.n_rows + 1)/2
+        target_ranks = np.cumsum(target_totals) - target_totals + (target_totals + 1)/2 - mean_rank
+        pred_ranks = np.cumsum(pred_totals) - pred_totals + (pred_totals + 1)/2 - mean_rank
+        covariance = (counts*target_ranks[target_bins]*pred_ranks[pred_bins]).sum()
+        variance = (target_totals*target_ranks**2).sum()*(pred_totals*pred_ranks**2).sum()
+        rank_error = (max(target_totals.max(), pred_totals.max()) - 1)/(2*self.n_rows)
+        return covariance/np.sqrt(variance) if variance > 0 else np.nan, rank_error
+
+    def _median_abs_err(self):
+        """ Function to estimate the median absolute error from the
+            logarithmic bins, each represented by the value of least relative
+            error to all values in it. For an even number of rows the two
+            middle values are averaged, as both lie within the relative error.
+        """
+        middle_ranks = [(self.n_rows - 1)//2, self.n_rows//2]
+        bin_idx = np.searchsorted(np.cumsum(self.abs_err_counts), middle_ranks, side='right')
+        gamma = np.exp(self._log_gamma)
+        return np.mean(2*gamma**(bin_idx + self._abs_err_offset)/(gamma + 1))
+
+    def result(self):
+        """ Function to compute the metrics of all batches added so far.
+
+        Returns
+        -------
+        metrics : dict
+            The number of rows, mean and median absolute error, R2, Pearson
+            and Spearman correlations, and the bound on the rank error of the
+            Spearman sketch.
+        """
+        if self.n_rows == 0:
+            return {'nRows': 0}
+        if self.target_edges is not None:
+            spearman, rank_error = self._sketch_spearman()
+        else:
+            spearman = spearmanr(np.concatenate(self._targets), np.concatenate(self._preds))[0]
+            rank_error = 0.0
+        has_variance = self.m2_target > 0 and self.m2_pred > 0
+        return {
+            'nRows': self.n_rows,
+            'mae': self.sum_abs_err/self.n_rows,
+            'medianAbsErr': self._median_abs_err(),
+            'r2': 1 - self.sum_sq_err/self.m2_target if self.m2_target > 0 else np.nan,
+            'pearson': self.co_moment/np.sqrt(self.m2_target*self.m2_pred) if has_variance else np.nan,
+            'spearmanr': spearman,
+            'spearmanRankError': rank_error,
+        }
+
+
+def evaluate_file(predict_func, csv_path, config):
+    """ Function to stream a finalised csv file through a model, updating the
+        overall and grouped metrics chunk by chunk.
+
+    Returns
+    -------
+    all_metrics : dict
+        The StreamingMetrics of the whole file, keyed by ('all', 'all'), and
+        of each group, keyed by (group column, group value).
+    """
+    new_metrics = lambda : StreamingMetrics(config.spearman_method, config.spearman_bins)
+    all_metrics = {('all', 'all'): new_metrics()}
+    columns = MODEL_INPUT_COLUMNS + [TARGET_VARIABLE] + config.evaluation_groups
+    for chunk_df in iter_feature_chunks(csv_path, config.chunk_size, columns=columns):
+        with PROFILER.stage('evaluateChunk', rows_in=chunk_df.shape[0]):
+            targets = chunk_df[TARGET_VARIABLE].values
+            predictions = predict_func(chunk_df[FEATURE_SET].values)
+            all_metrics[('all', 'all')].update(targets, predictions)
+            for group_col in config.evaluation_groups:
+                group_values, group_idx = np.unique(chunk_df[group_col].values, return_inverse=True)
+                for value_idx, value in enumerate(group_values):
+                    if (group_col, value) not in all_metrics:
+                        all_metrics[(group_col, value)] = new_metrics()
+                    in_group = group_idx == value_idx
+                    all_metrics[(group_col, value)].update(
+                        targets[in_group], predictions[in_group]
+                    )
+    return all_metrics
+
+def evaluate(config):
+    """ Function to evaluate the best model on each evaluation file and write
+        the overall and grouped metrics to evaluation{bestModel}.csv.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    identifier = config.best_model
+    budget = ThreadBudget(config.n_cores)
+    results = []
+    with budget.limit('evaluate') as (_, n_threads):
+        with PROFILER.stage('loadModel', model=identifier):
+            predict_func = load_predict_func(
+                config.output_folder, identifier, config.prediction_backend, n_threads
+            )
+
+        for csv_path in config.evaluation_files:
+            all_metrics = evaluate_file(predict_func, csv_path, config)
+            for (group_col, value), metrics in all_metrics.items():
+                results.append({
+                    'dataset': csv_path,
+                    'group': group_col,
+                    'value': value,
+                    **metrics.result(),
+                })
+
+    results_df = pd.DataFrame(results)
+    results_df.to_csv(f'{config.output_folder}/evaluation{identifier}.csv', index=False)
+    print(results_df[results_df['group'] == 'all'].to_string(index=False))
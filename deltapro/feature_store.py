@@ -0,0 +1,238 @@
+""" Functions for storing the finalised datasets in a typed columnar format and
+    reading only the columns needed.
+
+The store of {tt}Data.csv is the folder {tt}DataColumns. It is written in one
+chunked pass over the csv, each chunk of rows becoming a part folder holding
+one npy file per column. Features are stored as float32, flip positions,
+charges and oxidation flags as int8, and residues, peptides and sources as
+int32 codes into a category list shared by all parts, which are read back as
+pandas categoricals. schema.json records the type of each column and the size
+and modification time of the csv it was built from, so a store is only read
+while it is up to date with its csv. Readers fall back to the csv otherwise.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from deltapro.data_io import iter_csv_chunks
+from deltapro.profiling import PROFILER
+
+SCHEMA_FILE = 'schema.json'
+CATEGORICAL_COLUMNS = ['peptide', 'source', 'nFlip', 'cFlip', 'cNeighbour', 'nNeighbour']
+INT8_COLUMNS = ['flipInd', 'charge', 'cOxidation', 'nOxidation']
+
+
+def get_feature_store_path(csv_path):
+    """ Function to get the folder of the feature store of a finalised csv file.
+    """
+    return f'{csv_path[:-4]}Columns'
+
+def get_csv_stat(csv_path):
+    """ Function to get the size and modification time identifying the
+        version of a csv file.
+    """
+    file_stat = os.stat(csv_path)
+    return {'csvSize': file_stat.st_size, 'csvMtimeNs': file_stat.st_mtime_ns}
+
+def get_column_type(column, values=None):
+    """ Function to get the stored type of a column, from its name and, if
+        given, its values.
+    """
+    if column in CATEGORICAL_COLUMNS or (
+        values is not None and not pd.api.types.is_numeric_dtype(values)
+    ):
+        return 'category'
+    if column in INT8_COLUMNS:
+        return 'int8'
+    return 'float32'
+
+def write_feature_store(csv_path, chunk_size):
+    """ Function to build the feature store of a finalised csv file, replacing
+        any existing store.
+
+    Parameters
+    ----------
+    csv_path : str
+        The finalised csv file.
+    chunk_size : int
+        The number of rows of each part.
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows stored.
+    """
+    store_path = get_feature_store_path(csv_path)
+    tmp_path = f'{store_path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    schema = {**get_csv_stat(csv_path), 'columns': {}, 'nRows': []}
+    categories = {}
+
+    for part_idx, chunk_df in enumerate(iter_csv_chunks(csv_path, chunk_size)):
+        if not schema['columns']:
+            schema['columns'] = {
+                column: get_column_type(column, chunk_df[column]) for column in chunk_df.columns
+            }
+        part_path = f'{tmp_path}/part{part_idx}'
+        os.makedirs(part_path)
+        for column, column_type in schema['columns'].items():
+            if column_type == 'category':
+                # Codes index the categories in order of first appearance.
+                column_categories = categories.setdefault(column, {})
+                values = chunk_df[column].astype(str)
+                for value in values.unique():
+                    column_categories.setdefault(value, len(column_categories))
+                stored = values.map(column_categories).to_numpy(dtype=np.int32)
+            elif column_type == 'int8':
+                # Flags and positions are never missing, readers fill with 0.
+                stored = chunk_df[column].fillna(0).to_numpy(dtype=np.int8)
+            else:
+                stored = chunk_df[column].to_numpy(dtype=np.float32)
+            np.save(f'{part_path}/{column}.npy', stored)
+        schema['nRows'].append(chunk_df.shape[0])
+    if not schema['columns']:
+        schema['columns'] = {
+            column: get_column_type(column) for column in pd.read_csv(csv_path, nrows=0).columns
+        }
+
+    for column, column_type in schema['columns'].items():
+        if column_type == 'category':
+            np.save(
+                f'{tmp_path}/{column}Categories.npy',
+                np.array(list(categories.get(column, {})), dtype=str),
+            )
+    with open(f'{tmp_path}/{SCHEMA_FILE}', 'w', encoding='UTF-8') as schema_file:
+        json.dump(schema, schema_file)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+    return sum(schema['nRows'])
+
+def load_current_schema(csv_path, verbose=True):
+    """ Function to load the schema of the feature store of a csv file if it
+        is up to date with the csv.
+
+    Returns
+    -------
+    schema : dict or None
+        The schema of the store, or None if there is no up to date store.
+    """
+    schema_path = f'{get_feature_store_path(csv_path)}/{SCHEMA_FILE}'
+    if not os.path.exists(schema_path):
+        return None
+    with open(schema_path, 'r', encoding='UTF-8') as schema_file:
+        schema = json.load(schema_file)
+    if os.path.exists(csv_path) and get_csv_stat(csv_path) != {
+        'csvSize': schema['csvSize'], 'csvMtimeNs': schema['csvMtimeNs']
+    }:
+        if verbose:
+            print(f'Feature store of {csv_path} is out of date, reading the csv.')
+        return None
+    return schema
+
+def iter_store_chunks(csv_path, schema, columns=None):
+    """ Function to read the parts of a feature store.
+
+    Parameters
+    ----------
+    csv_path : str
+        The finalised csv file the store was built from.
+    schema : dict
+        The schema of the store.
+    columns : list of str or None
+        The columns to read, columns not present in the store are ignored.
+        If None all columns are read.
+
+    Yields
+    ------
+    chunk_df : pd.DataFrame
+        The rows of the next part.
+    """
+    store_path = get_feature_store_path(csv_path)
+    column_types = {
+        column: column_type for column, column_type in schema['columns'].items()
+        if columns is None or column in columns
+    }
+    categories = {
+        column: pd.Index(np.load(f'{store_path}/{column}Categories.npy'))
+        for column, column_type in column_types.items() if column_type == 'category'
+    }
+    for part_idx in range(len(schema['nRows'])):
+        part_path = f'{store_path}/part{part_idx}'
+        chunk_df = pd.DataFrame({
+            column: np.load(f'{part_path}/{column}.npy') for column in column_types
+        })
+        for column, column_categories in categories.items():
+            chunk_df[column] = pd.Categorical.from_codes(chunk_df[column], column_categories)
+        yield chunk_df
+
+def iter_final_chunks(csv_path, chunk_size, columns=None):
+    """ Function to read a finalised dataset in chunks of rows, from its
+        feature store if it has an up to date one and otherwise from the csv.
+
+    Yields
+    ------
+    chunk_df : pd.DataFrame
+        The next chunk of rows.
+    """
+    schema = load_current_schema(csv_path)
+    if schema is None:
+        yield from iter_csv_chunks(csv_path, chunk_size, columns=columns)
+    else:
+        yield from iter_store_chunks(csv_path, schema, columns=columns)
+
+def read_final_data(csv_path, columns=None):
+    """ Function to read a finalised dataset, from its feature store if it has
+        an up to date one and otherwise from the csv.
+
+    Returns
+    -------
+    data_df : pd.DataFrame
+        The requested columns of every row.
+    """
+    schema = load_current_schema(csv_path)
+    if schema is None:
+        return pd.read_csv(csv_path, usecols=columns)
+    chunks = list(iter_store_chunks(csv_path, schema, columns=columns))
+    if not chunks:
+        return pd.DataFrame(columns=[
+            column for column in schema['columns'] if columns is None or column in columns
+        ])
+    return pd.concat(chunks, ignore_index=True)
+
+def fill_missing(data_df):
+    """ Function to fill the missing values of a finalised dataset with 0.
+        Categorical columns from the feature store have no missing values and
+        are left unchanged.
+    """
+    return data_df.fillna({
+        column: 0 for column, dtype in data_df.dtypes.items()
+        if not isinstance(dtype, pd.CategoricalDtype)
+    })
+
+def write_feature_stores(config):
+    """ Function to build the feature stores of trainData.csv and testData.csv
+        if featureStore is set and they are out of date, or to remove them if
+        featureStore is not set.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    for tt in ('train', 'test'):
+        csv_path = f'{config.output_folder}/{tt}Data.csv'
+        store_path = get_feature_store_path(csv_path)
+        if not config.feature_store:
+            if os.path.exists(store_path):
+                shutil.rmtree(store_path)
+            continue
+        if not os.path.exists(csv_path) or load_current_schema(csv_path, verbose=False) is not None:
+            continue
+        with PROFILER.stage('writeFeatureStore', split=tt) as record:
+            record['rowsOut'] = write_feature_store(csv_path, config.chunk_size)
@@ -1,6 +1,10 @@
 
 import pandas as pd
-from deltapro.constants import BLOSUM6_1_VALUES, RESIDUE_WEIGHTS, RESIDUE_PROPERTIES, OXIDATION_WEIGHT
+from deltapro.constants import (
+    BLOSUM6_1_VALUES, FEATURE_SET, RESIDUE_WEIGHTS, RESIDUE_PROPERTIES, OXIDATION_WEIGHT
+)
+from deltapro.data_io import append_to_csv
+from deltapro.profiling import PROFILER
 
 def calculate_mass_diff(df_row):
     if df_row['cOxidation'] == 1:
@@ -9,90 +13,172 @@ def calculate_mass_diff(df_row):
         return abs(RESIDUE_WEIGHTS[df_row['cFlip']] - OXIDATION_WEIGHT - RESIDUE_WEIGHTS[df_row['nFlip']])
     return abs(RESIDUE_WEIGHTS[df_row['cFlip']] - RESIDUE_WEIGHTS[df_row['nFlip']])
 
-def finalise_input(folder):
+FINAL_COLUMNS = [
+    'peptide',
+    'source',
+    'collisionEnergy',
+    'spectralAngle',
+    'flipInd',
+    'charge',
+    'nFlip',
+    'cFlip',
+    'blosumDiff',
+    'massDiff',
+    'hydroDiff',
+    'pkaDiff',
+    'polaDiff',
+    'cNeighbour',
+    'nNeighbour',
+    'blosumN',
+    'blosumC',
+    'relPos',
+    'yIntesAtC',
+    'bIntesAtC',
+    'cOxidation',
+    'nOxidation',
+    'yIntesAtN',
+    'bIntesAtN',
+    'yIntesAtLoc',
+    'bIntesAtLoc',
+    'yMatchedIntesAtN',
+    'bMatchedIntesAtN',
+    'yMatchedIntesAtC',
+    'bMatchedIntesAtC',
+    'yMatchedIntesAtLoc',
+    'bMatchedIntesAtLoc',
+    'yErrsAtC',
+    'bErrsAtC',
+    'yErrsAtN',
+    'bErrsAtN',
+    'yErrsAtLoc',
+    'bErrsAtLoc',
+    'flipBNewIntensity',
+    'flipYNewIntensity',
+    'matchedCoverage',
+    'nMatchedDivFrags',
+    'specAngleDiff',
+]
+
+# The columns of the final datasets from which the model features are derived.
+MODEL_INPUT_COLUMNS = [
+    feature for feature in FEATURE_SET if feature not in (
+        'nTermDist', 'cTermDist', 'cNeighbourBlosum', 'nNeighbourBlosum',
+    )
+] + ['peptide', 'flipInd', 'cNeighbour', 'nNeighbour']
+
+def finalise_feated_df(feated_df, idx):
+    """ Function to add the residue property features and target variable to
+        the featured data of a single flip.
+
+    Parameters
+    ----------
+    feated_df : pd.DataFrame
+        The featured data for flip idx.
+    idx : int
+        The index of the flip.
+
+    Returns
+    -------
+    final_df : pd.DataFrame
+        The DataFrame with the final input columns.
+    """
+    if feated_df.shape[0] == 0:
+        return pd.DataFrame(columns=FINAL_COLUMNS)
+    feated_df = feated_df.rename(columns={f'flipInd{idx}': 'flipInd'})
+    feated_df['specAngleDiff'] = feated_df[f'flipSpectralAngle{idx}'] - feated_df['spectralAngle']
+
+    feated_df['blosumDiff'] = feated_df.apply(
+        lambda x : abs(BLOSUM6_1_VALUES[x['cFlip']] - BLOSUM6_1_VALUES[x['nFlip']]),
+        axis=1
+    )
+    feated_df['blosumC'] = feated_df.apply(
+        lambda x : BLOSUM6_1_VALUES[x['cFlip']],
+        axis=1
+    )
+    feated_df['blosumN'] = feated_df.apply(
+        lambda x : BLOSUM6_1_VALUES[x['nFlip']],
+        axis=1
+    )
+    feated_df['massDiff'] = feated_df.apply(
+        lambda x : abs(RESIDUE_WEIGHTS[x['cFlip']] - RESIDUE_WEIGHTS[x['nFlip']]),
+        axis=1
+    )
+    feated_df['hydroDiff'] = feated_df.apply(
+        lambda x : abs(RESIDUE_PROPERTIES[x['cFlip']]['hydrophobicity'] - RESIDUE_PROPERTIES[x['nFlip']]['hydrophobicity']),
+        axis=1
+    )
+    feated_df['pkaDiff'] = feated_df.apply(
+        lambda x : abs(RESIDUE_PROPERTIES[x['cFlip']]['pka'] - RESIDUE_PROPERTIES[x['nFlip']]['pka']),
+        axis=1
+    )
+    feated_df['polaDiff'] = feated_df.apply(
+        lambda x : abs(RESIDUE_PROPERTIES[x['cFlip']]['polarity'] - RESIDUE_PROPERTIES[x['nFlip']]['polarity']),
+        axis=1
+    )
+
+    return feated_df[FINAL_COLUMNS]
+
+def finalise_input(folder, incremental=False):
+    """ Function to combine the featured data of all flips into the final
+        train and test datasets.
+
+    Parameters
+    ----------
+    folder : str
+        The output folder.
+    incremental : bool
+        If True only the {tt}FeatedDataIncrement files are finalised. The
+        results are written to {tt}DataIncrement.csv and appended to {tt}Data.csv.
+    """
     for tt in ('test', 'train'):
         all_dfs = []
         for idx in range(1, 6):
-            feated_df = pd.read_csv(f'{folder}/{tt}FeatedData{idx}.csv')
-            feated_df = feated_df.rename(columns={f'flipInd{idx}': 'flipInd'})
-            feated_df['specAngleDiff'] = feated_df[f'flipSpectralAngle{idx}'] - feated_df['spectralAngle']
+            if incremental:
+                feated_df = pd.read_csv(f'{folder}/{tt}FeatedDataIncrement{idx}.csv')
+            else:
+                feated_df = pd.read_csv(f'{folder}/{tt}FeatedData{idx}.csv')
+            with PROFILER.stage(f'finalise{idx}', rows_in=feated_df.shape[0], split=tt) as record:
+                all_dfs.append(finalise_feated_df(feated_df, idx))
+                record['rowsOut'] = all_dfs[-1].shape[0]
+        total_df = pd.concat(all_dfs)
+        with PROFILER.stage('writeFinalData', rows_in=total_df.shape[0], split=tt):
+            if incremental:
+                total_df.to_csv(f'{folder}/{tt}DataIncrement.csv', index=False)
+                append_to_csv(total_df, f'{folder}/{tt}Data.csv')
+            else:
+                total_df.to_csv(
+                    f'{folder}/{tt}Data.csv',
+                    index=False,
+                )
 
-            feated_df['blosumDiff'] = feated_df.apply(
-                lambda x : abs(BLOSUM6_1_VALUES[x['cFlip']] - BLOSUM6_1_VALUES[x['nFlip']]),
-                axis=1
-            )
-            feated_df['blosumC'] = feated_df.apply(
-                lambda x : BLOSUM6_1_VALUES[x['cFlip']],
-                axis=1
-            )
-            feated_df['blosumN'] = feated_df.apply(
-                lambda x : BLOSUM6_1_VALUES[x['nFlip']],
-                axis=1
-            )
-            feated_df['massDiff'] = feated_df.apply(
-                lambda x : abs(RESIDUE_WEIGHTS[x['cFlip']] - RESIDUE_WEIGHTS[x['nFlip']]),
-                axis=1
-            )
-            feated_df['hydroDiff'] = feated_df.apply(
-                lambda x : abs(RESIDUE_PROPERTIES[x['cFlip']]['hydrophobicity'] - RESIDUE_PROPERTIES[x['nFlip']]['hydrophobicity']),
-                axis=1
-            )
-            feated_df['pkaDiff'] = feated_df.apply(
-                lambda x : abs(RESIDUE_PROPERTIES[x['cFlip']]['pka'] - RESIDUE_PROPERTIES[x['nFlip']]['pka']),
-                axis=1
-            )
-            feated_df['polaDiff'] = feated_df.apply(
-                lambda x : abs(RESIDUE_PROPERTIES[x['cFlip']]['polarity'] - RESIDUE_PROPERTIES[x['nFlip']]['polarity']),
-                axis=1
-            )
+def edit_features(working_df):
+    # working_df['flip'] = working_df.apply(
+    #     lambda x : (x['peptide'][:int(x['flipInd']) - 1] +
+    #         x['peptide'][int(x['flipInd'])] +
+    #         x['peptide'][int(x['flipInd']-1)] +
+    #         x['peptide'][int(x['flipInd'])+1:]),
+    #     axis=1
+    # )
 
-            all_dfs.append(feated_df[[
-                'peptide',
-                'source',
-                'collisionEnergy',
-                'spectralAngle',
-                'flipInd',
-                'charge',
-                'nFlip',
-                'cFlip',
-                'blosumDiff',
-                'massDiff',
-                'hydroDiff',
-                'pkaDiff',
-                'polaDiff',
-                'cNeighbour',
-                'nNeighbour',
-                'blosumN',
-                'blosumC',
-                'relPos',
-                'yIntesAtC',
-                'bIntesAtC',
-                'cOxidation',
-                'nOxidation',
-                'yIntesAtN',
-                'bIntesAtN',
-                'yIntesAtLoc',
-                'bIntesAtLoc',
-                'yMatchedIntesAtN',
-                'bMatchedIntesAtN',
-                'yMatchedIntesAtC',
-                'bMatchedIntesAtC',
-                'yMatchedIntesAtLoc',
-                'bMatchedIntesAtLoc',
-                'yErrsAtC',
-                'bErrsAtC',
-                'yErrsAtN',
-                'bErrsAtN',
-                'yErrsAtLoc',
-                'bErrsAtLoc',
-                'flipBNewIntensity',
-                'flipYNewIntensity',
-                'matchedCoverage',
-                'nMatchedDivFrags',
-                'specAngleDiff',
-            ]])
-        total_df = pd.concat(all_dfs)
-        total_df.to_csv(
-            f'{folder}/{tt}Data.csv',
-            index=False,
-        )
+    # Applying functions to the categorical columns of the feature store
+    # returns categoricals, so the derived columns are cast back to numbers.
+    working_df['pepLen'] = working_df['peptide'].apply(len).astype(int)
+    working_df['nTermDist'] = working_df['flipInd'].apply(int)
+    working_df['cTermDist'] = working_df['pepLen'] - working_df['nTermDist']
+
+    if 'intesAtC' in FEATURE_SET:
+        working_df['intesAtC'] = working_df['bIntesAtC'] + working_df['yIntesAtC']
+        working_df['intesAtN'] = working_df['bIntesAtN'] + working_df['yIntesAtN']
+        working_df['intesAtLoc'] = working_df['bIntesAtLoc'] + working_df['yIntesAtLoc']
+    if 'matchedIntesAtC' in FEATURE_SET:
+        working_df['matchedIntesAtC'] = working_df['bMatchedIntesAtC'] + working_df['yMatchedIntesAtC']
+        working_df['matchedIntesAtN'] = working_df['bMatchedIntesAtN'] + working_df['yMatchedIntesAtN']
+        working_df['matchedIntesAtLoc'] = working_df['bMatchedIntesAtLoc'] + working_df['yMatchedIntesAtLoc']
+    if 'errsAtLoc' in FEATURE_SET:
+        working_df['errsAtC'] = working_df['yErrsAtC'] + working_df['bErrsAtC']
+        working_df['errsAtN'] = working_df['yErrsAtN'] + working_df['bErrsAtN']
+        working_df['errsAtLoc'] = working_df['yErrsAtLoc'] + working_df['bErrsAtLoc']
+    if 'cNeighbourBlosum' in FEATURE_SET:
+        working_df['cNeighbourBlosum'] = working_df['cNeighbour'].apply(lambda x : BLOSUM6_1_VALUES.get(x,-5.0)).astype(float)
+        working_df['nNeighbourBlosum'] = working_df['nNeighbour'].apply(lambda x : BLOSUM6_1_VALUES.get(x, -5.0)).astype(float)
+    return working_df
@@ -1,9 +1,11 @@
 import random
 import re
-from tkinter.filedialog import SaveAs
 
 import pandas as pd
 
+from deltapro.data_io import append_to_csv, get_known_sources
+from deltapro.profiling import PROFILER
+
 def flip_n(df_row, n_flips):
     """ Helper function to flip adjacent amino acids at n randomly chosen positions.
 
@@ -38,7 +40,9 @@ def flip_n(df_row, n_flips):
 
     return df_row
 
-def generate_flipped_data(search_files, n_flips, output_folder, collision_energies):
+def generate_flipped_data(
+        search_files, n_flips, output_folder, collision_energies, incremental=False, store=None
+    ):
     """ Function to generate training data with flipped amino acid positions.
 
     Parameters
@@ -52,53 +56,61 @@ def generate_flipped_data(search_files, n_flips, output_folder, collision_energi
         The folder where output will be written.
     collision_energies : dict
         A dictionary mapping source files to the collision energy setting used in the MS.
+    incremental : bool
+        If True only PSMs from sources not already in flippedSeqs.csv are flipped
+        and appended, and the Prosit input files contain only these new PSMs.
+    store : deltapro.prediction_store.PredictionStore or None
+        If given, the Prosit input files contain only the sequences, charges
+        and collision energies without a prediction in the store.
     """
-    all_dfs = []
-    for in_file in search_files:
-        search_df = pd.read_csv(in_file)
-        if '-10lgP' in search_df.columns:
-            search_df = search_df.sort_values(by='-10lgP', ascending=False)
-
-            search_df = search_df.drop_duplicates(subset=['Peptide', 'Z'])
-
-            search_df = search_df[['Source File', 'Scan', 'Peptide', 'Z']].rename(
-                columns={
-                    'Source File': 'source',
-                    'Scan': 'scan',
-                    'Peptide': 'peptide',
-                    'Z': 'charge',
-                }
-            )
-
-
-            search_df['source'] = search_df['source'].apply(
-                lambda x : x.replace('.mzML', '').replace('.mgf', '').replace('.raw', '')
-            )
-            search_df['scan'] = search_df['scan'].apply(lambda x : int(x.split(':')[-1]) if isinstance(x, str) else x)
-
-            search_df['collision_energy'] = search_df['source'].apply(
-                lambda x : collision_energies[x]
-            )
-            search_df = search_df[['source', 'scan', 'peptide', 'charge', 'collision_energy']]
-        else:
-            search_df = pd.read_csv(in_file, sep='\t')
-            search_df = search_df.rename(
-                columns={
-                    'Raw file': 'source',
-                    'Scan number': 'scan',
-                    'Sequence': 'peptide',
-                    'Charge': 'charge',
-                }
-            )
-            search_df['collision_energy'] = search_df['source'].apply(
-                lambda x : collision_energies[x]
-            )
-            search_df['peptide'] = search_df['peptide'].apply(
-                lambda x : x.replace('C', 'c')
-            )
-            search_df = search_df[['source', 'scan', 'peptide', 'charge', 'collision_energy']]
-        all_dfs.append(search_df)
-    search_df = pd.concat(all_dfs)
+    with PROFILER.stage('loadSearchFiles', files=len(search_files)) as record:
+        all_dfs = []
+        for in_file in search_files:
+            search_df = pd.read_csv(in_file)
+            if '-10lgP' in search_df.columns:
+                search_df = search_df.sort_values(by='-10lgP', ascending=False)
+
+                search_df = search_df.drop_duplicates(subset=['Peptide', 'Z'])
+
+                search_df = search_df[['Source File', 'Scan', 'Peptide', 'Z']].rename(
+                    columns={
+                        'Source File': 'source',
+                        'Scan': 'scan',
+                        'Peptide': 'peptide',
+                        'Z': 'charge',
+                    }
+                )
+
+
+                search_df['source'] = search_df['source'].apply(
+                    lambda x : x.replace('.mzML', '').replace('.mgf', '').replace('.raw', '')
+                )
+                search_df['scan'] = search_df['scan'].apply(lambda x : int(x.split(':')[-1]) if isinstance(x, str) else x)
+
+                search_df['collision_energy'] = search_df['source'].apply(
+                    lambda x : collision_energies[x]
+                )
+                search_df = search_df[['source', 'scan', 'peptide', 'charge', 'collision_energy']]
+            else:
+                search_df = pd.read_csv(in_file, sep='\t')
+                search_df = search_df.rename(
+                    columns={
+                        'Raw file': 'source',
+                        'Scan number': 'scan',
+                        'Sequence': 'peptide',
+                        'Charge': 'charge',
+                    }
+                )
+                search_df['collision_energy'] = search_df['source'].apply(
+                    lambda x : collision_energies[x]
+                )
+                search_df['peptide'] = search_df['peptide'].apply(
+                    lambda x : x.replace('C', 'c')
+                )
+                search_df = search_df[['source', 'scan', 'peptide', 'charge', 'collision_energy']]
+            all_dfs.append(search_df)
+        search_df = pd.concat(all_dfs)
+        record['rowsOut'] = search_df.shape[0]
 
     search_df['peptide'] = search_df['peptide'].apply(
         lambda x : x.replace('M(+15.99)', 'm').replace('C(+57.02)', 'c')
@@ -112,7 +124,16 @@ def generate_flipped_data(search_files, n_flips, output_folder, collision_energi
     )
     search_df = search_df[search_df['peptide'].apply(lambda x : isinstance(x, str))]
 
-    search_df = search_df.apply(lambda x : flip_n(x, n_flips), axis=1)
+    if incremental:
+        known_sources = get_known_sources(f'{output_folder}/flippedSeqs.csv')
+        search_df = search_df[~search_df['source'].astype(str).isin(known_sources)]
+        print(f'Found {search_df.shape[0]} PSMs from new sources.')
+        if search_df.shape[0] == 0:
+            return
+
+    with PROFILER.stage('flipResidues', rows_in=search_df.shape[0]) as record:
+        search_df = search_df.apply(lambda x : flip_n(x, n_flips), axis=1)
+        record['rowsOut'] = search_df.shape[0]
 
     flip_cols = []
     for i in range(1, n_flips+1):
@@ -128,13 +149,17 @@ def generate_flipped_data(search_files, n_flips, output_folder, collision_energi
         ] + flip_cols
     ]
 
-    search_df.to_csv(f'{output_folder}/flippedSeqs.csv', index=False)
+    with PROFILER.stage('writeFlippedData', rows_in=search_df.shape[0]):
+        if incremental:
+            append_to_csv(search_df, f'{output_folder}/flippedSeqs.csv')
+        else:
+            search_df.to_csv(f'{output_folder}/flippedSeqs.csv', index=False)
 
-    write_prosit_input(search_df, 'peptide', 'charge', f'{output_folder}/prositInput0.csv')
-    for idx in range(1, n_flips+1):
-        write_prosit_input(search_df, f'flip{idx}', 'charge', f'{output_folder}/prositInput{idx}.csv', )
+        write_prosit_input(search_df, 'peptide', 'charge', f'{output_folder}/prositInput0.csv', store)
+        for idx in range(1, n_flips+1):
+            write_prosit_input(search_df, f'flip{idx}', 'charge', f'{output_folder}/prositInput{idx}.csv', store)
 
-def write_prosit_input(gt_df, pep_key, charge_key, out_key):
+def write_prosit_input(gt_df, pep_key, charge_key, out_key, store=None):
     prosit_df = gt_df[[pep_key, charge_key, 'collision_energy']].rename(
         columns={
             pep_key: 'modified_sequence',
@@ -147,4 +172,11 @@ def write_prosit_input(gt_df, pep_key, charge_key, out_key):
     prosit_df['modified_sequence'] = prosit_df['modified_sequence'].apply(
         lambda x : x.replace('m', 'M(ox)')
     )
+    if store is not None:
+        prosit_df = prosit_df.drop_duplicates()
+        missing = store.find_missing(
+            prosit_df[['modified_sequence', 'precursor_charge', 'collision_energy']]
+        )
+        print(f'{out_key}: {(~missing).sum()} of {missing.shape[0]} predictions found in store.')
+        prosit_df = prosit_df[missing]
     prosit_df.to_csv(out_key, index=False)
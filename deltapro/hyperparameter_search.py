@@ -0,0 +1,181 @@
+""" Functions for tuning the XGBoost hyperparameters by successive halving over
+    peptide grouped cross validation folds.
+
+Candidates are sampled from PARAM_SETS and trained for a small number of
+boosting rounds on every fold. After each rung only the best third of
+candidates is kept and their boosters are trained further, so most of the
+fitting effort is spent on promising candidates. A single binned matrix of all
+training rows is shared by every fold and candidate, each fold training on it
+with its validation rows weighted zero, so the histogram bins are computed
+once and no per fold copies of the data are made. Only the boosters of
+candidates which can still survive the current rung are kept.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import r2_score
+from sklearn.model_selection import GroupKFold, ParameterSampler
+import xgboost as xgb
+
+from deltapro.constants import FEATURE_SET, TARGET_VARIABLE
+from deltapro.profiling import PROFILER
+
+HALVING_FACTOR = 3
+MAX_ROUNDS = 100
+MIN_ROUNDS = 12
+N_FOLDS = 5
+PARAM_SETS = {
+    "learning_rate"    : [0.15, 0.20, 0.30 ] ,
+    "max_depth"        : [ 14, 15, 16, 17, 18],
+    "min_child_weight" : [ 1, 2],
+    "gamma"            : [ 0.0, 0.1, 0.2 ],
+    "colsample_bytree" : [ 0.7, 0.9 ],
+}
+
+
+def get_rung_rounds(min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS, factor=HALVING_FACTOR):
+    """ Function to get the number of boosting rounds of each rung.
+    """
+    rung_rounds = []
+    n_rounds = min_rounds
+    while n_rounds < max_rounds:
+        rung_rounds.append(n_rounds)
+        n_rounds *= factor
+    rung_rounds.append(max_rounds)
+    return rung_rounds
+
+def build_search_matrix(train_df, n_folds, n_threads):
+    """ Function to build the binned matrix of all training rows and split them
+        into folds grouped by peptide.
+
+    Returns
+    -------
+    data_matrix : xgb.QuantileDMatrix
+        The binned features and target of every row.
+    features : np.ndarray
+        The features of every row, from which validation rows are predicted.
+    folds : list of tuple
+        The training row weights, validation row indices and validation
+        targets of each fold.
+    """
+    features = train_df[FEATURE_SET].values.astype(np.float32)
+    targets = train_df[TARGET_VARIABLE].values
+    data_matrix = xgb.QuantileDMatrix(features, label=targets, nthread=n_threads)
+    folds = []
+    for _, valid_idx in GroupKFold(n_splits=n_folds).split(
+        features, targets, groups=train_df['peptide']
+    ):
+        # Rows with zero weight add nothing to the gradients or hessians.
+        train_weights = np.ones(features.shape[0], dtype=np.float32)
+        train_weights[valid_idx] = 0.0
+        folds.append((train_weights, valid_idx, targets[valid_idx]))
+    return data_matrix, features, folds
+
+def successive_halving(train_df, n_candidates, n_threads, time_budget=None, max_fits=None):
+    """ Function to search the hyperparameter space by successive halving.
+
+    Parameters
+    ----------
+    train_df : pd.DataFrame
+        The training data with features, target and peptide columns.
+    n_candidates : int
+        The number of hyperparameter settings sampled from PARAM_SETS.
+    n_threads : int
+        The number of threads used by XGBoost.
+    time_budget : float or None
+        The wall time in seconds after which no further fits are started.
+    max_fits : int or None
+        The maximum number of fits, counting every fold of every rung.
+
+    Returns
+    -------
+    results_df : pd.DataFrame
+        The mean and standard deviation of the validation R2 of every
+        candidate at each rung it reached.
+    best_params : dict
+        The hyperparameters of the best candidate of the highest rung reached,
+        including n_estimators.
+    """
+    start_time = time.time()
+    candidates = list(ParameterSampler(PARAM_SETS, n_iter=n_candidates, random_state=42))
+    with PROFILER.stage('buildSearchMatrix', rows_in=train_df.shape[0]):
+        data_matrix, features, folds = build_search_matrix(train_df, N_FOLDS, n_threads)
+
+    boosters = {}
+    results = []
+    n_fits = 0
+    survivors = list(range(len(candidates)))
+    best_params = None
+    trained_rounds = 0
+    for rung, n_rounds in enumerate(get_rung_rounds()):
+        n_keep = max(1, len(survivors)//HALVING_FACTOR)
+        rung_scores = {}
+        for cand_idx in survivors:
+            if (
+                (time_budget is not None and time.time() - start_time > time_budget) or
+                (max_fits is not None and n_fits + N_FOLDS > max_fits)
+            ):
+                break
+            params = {
+                'objective': 'reg:squarederror',
+                'tree_method': 'hist',
+                'nthread': n_threads,
+                **candidates[cand_idx],
+            }
+            fit_start = time.time()
+            scores = []
+            for fold_idx, (train_weights, valid_idx, valid_targets) in enumerate(folds):
+                data_matrix.set_weight(train_weights)
+                # Boosters are trained further from the previous rung.
+                boosters[(cand_idx, fold_idx)] = xgb.train(
+                    params,
+                    data_matrix,
+                    num_boost_round=n_rounds - trained_rounds,
+                    xgb_model=boosters.get((cand_idx, fold_idx)),
+                )
+                scores.append(r2_score(
+                    valid_targets,
+                    boosters[(cand_idx, fold_idx)].inplace_predict(features[valid_idx]),
+                ))
+            n_fits += N_FOLDS
+            rung_scores[cand_idx] = np.mean(scores)
+            results.append({
+                'candidate': cand_idx,
+                'rung': rung,
+                'nRounds': n_rounds,
+                'meanR2': np.mean(scores),
+                'stdR2': np.std(scores),
+                'fitSeconds': time.time() - fit_start,
+                **candidates[cand_idx],
+            })
+            # Boosters of candidates outside the best n_keep so far can no
+            # longer survive the rung and are freed straight away.
+            leaders = sorted(rung_scores, key=rung_scores.get, reverse=True)[:n_keep]
+            for key in [key for key in boosters if key[0] in rung_scores and key[0] not in leaders]:
+                del boosters[key]
+
+        if not rung_scores:
+            break
+        best_idx = max(rung_scores, key=rung_scores.get)
+        best_params = {**candidates[best_idx], 'n_estimators': n_rounds}
+        print(
+            f'Rung {rung}: {len(rung_scores)} candidates at {n_rounds} rounds, '
+            f'best R2 {rung_scores[best_idx]:.4f}'
+        )
+        if len(rung_scores) < len(survivors):
+            print('Search budget exhausted.')
+            break
+
+        survivors = sorted(rung_scores, key=rung_scores.get, reverse=True)[:n_keep]
+        for key in [key for key in boosters if key[0] not in survivors]:
+            del boosters[key]
+        trained_rounds = n_rounds
+
+    del boosters, data_matrix
+    if best_params is None:
+        raise ValueError(
+            'No hyperparameter candidate was scored within the search budget, '
+            f'increase hptTimeBudget or hptMaxFits (at least {N_FOLDS} fits are needed).'
+        )
+    return pd.DataFrame(results), best_params
@@ -0,0 +1,220 @@
+""" Functions for saving and loading trained models and predicting with them.
+
+Models are saved in XGBoost's native UBJSON format next to a metadata file
+recording the feature order, hyperparameters and a hash of the training data.
+The pickle format is still supported for loading older models.
+"""
+import json
+import os
+import pickle
+
+import numpy as np
+import xgboost as xgb
+
+from deltapro.constants import FEATURE_SET
+from deltapro.tree_eval import get_arrays_path
+
+IDENTITY_OBJECTIVES = ('reg:squarederror', 'reg:pseudohubererror', 'reg:absoluteerror')
+MODEL_FORMATS = ('native', 'pickle')
+
+
+def get_model_path(folder, identifier, model_format='native'):
+    """ Function to get the file a model is saved to.
+    """
+    extension = 'ubj' if model_format == 'native' else 'pkl'
+    return f'{folder}/model/reg{identifier}.{extension}'
+
+def get_metadata_path(folder, identifier):
+    """ Function to get the file the metadata of a model is saved to.
+    """
+    return f'{folder}/model/reg{identifier}.meta.json'
+
+def save_model(model, folder, identifier, model_format='native', metadata=None):
+    """ Function to save a trained model and its metadata.
+
+    Parameters
+    ----------
+    model : xgb.XGBRegressor or xgb.Booster
+        The trained model.
+    folder : str
+        The output folder.
+    identifier : str
+        The identifier of the model.
+    model_format : str
+        Either native or pickle.
+    metadata : dict or None
+        Any further JSON serialisable information about the model, such as the
+        hyperparameters and training data hash.
+
+    Returns
+    -------
+    model_size : int
+        The size of the saved model in bytes.
+    """
+    if model_format not in MODEL_FORMATS:
+        raise ValueError(f'Unrecognised model format {model_format}.')
+
+    file_name = get_model_path(folder, identifier, model_format)
+    if model_format == 'native':
+        model.save_model(file_name)
+    else:
+        with open(file_name, 'wb') as model_file:
+            pickle.dump(model, model_file)
+
+    with open(get_metadata_path(folder, identifier), 'w', encoding='UTF-8') as meta_file:
+        json.dump(
+            {
+                'identifier': identifier,
+                'format': model_format,
+                'featureSet': FEATURE_SET,
+                'xgboostVersion': xgb.__version__,
+                **(metadata or {}),
+            },
+            meta_file,
+            indent=2,
+            default=str,
+        )
+
+    return os.path.getsize(file_name)
+
+def load_metadata(folder, identifier):
+    """ Function to load the metadata of a model, or None if it has none.
+    """
+    meta_path = get_metadata_path(folder, identifier)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='UTF-8') as meta_file:
+        return json.load(meta_file)
+
+def get_saved_format(folder, identifier, metadata=None):
+    """ Function to get the format a model was saved in, as recorded in its
+        metadata. Models without metadata are taken to be in the native
+        format if that file is present and otherwise in the pickle format.
+    """
+    if metadata is not None:
+        model_format = metadata.get('format', 'native')
+    elif os.path.exists(get_model_path(folder, identifier, 'native')):
+        model_format = 'native'
+    else:
+        model_format = 'pickle'
+    if model_format not in MODEL_FORMATS:
+        raise ValueError(f'Unrecognised model format {model_format} of model {identifier}.')
+    return model_format
+
+def load_booster(folder, identifier):
+    """ Function to load a saved model as an XGBoost Booster, in the format
+        recorded in its metadata. Models without metadata are loaded from the
+        native format if present and otherwise from the pickle format.
+
+    Parameters
+    ----------
+    folder : str
+        The output folder.
+    identifier : str
+        The identifier of the model.
+
+    Returns
+    -------
+    booster : xgb.Booster
+        The loaded model.
+    """
+    metadata = load_metadata(folder, identifier)
+    if metadata is not None and metadata['featureSet'] != FEATURE_SET:
+        raise ValueError(
+            f'Model {identifier} was trained on features {metadata["featureSet"]} '
+            'which do not match the current FEATURE_SET.'
+        )
+
+    model_format = get_saved_format(folder, identifier, metadata)
+    if model_format == 'native':
+        return xgb.Booster(model_file=get_model_path(folder, identifier, 'native'))
+
+    with open(get_model_path(folder, identifier, 'pickle'), 'rb') as model_file:
+        model = pickle.load(model_file)
+    if isinstance(model, xgb.Booster):
+        return model
+    return model.get_booster()
+
+def predict_features(booster, features):
+    """ Function to predict with a Booster on a contiguous float32 array
+        without conversion to a DMatrix.
+
+    Parameters
+    ----------
+    booster : xgb.Booster
+        The model.
+    features : np.array
+        A 2d array of features in FEATURE_SET order.
+
+    Returns
+    -------
+    predictions : np.array
+        The predicted spectral angle deltas.
+    """
+    return booster.inplace_predict(np.ascontiguousarray(features, dtype=np.float32))
+
+def export_tree_arrays(booster, folder, identifier):
+    """ Function to export the trees of a Booster to flat numpy arrays which
+        can be evaluated by deltapro.tree_eval without xgboost.
+
+    Parameters
+    ----------
+    booster : xgb.Booster
+        The model.
+    folder : str
+        The output folder.
+    identifier : str
+        The identifier of the model.
+
+    Returns
+    -------
+    arrays_path : str
+        The npz file the arrays are saved to.
+    """
+    model_json = json.loads(booster.save_raw(raw_format='json'))['learner']
+    objective = model_json['objective']['name']
+    if objective not in IDENTITY_OBJECTIVES:
+        raise ValueError(f'Cannot export model with objective {objective}.')
+
+    features, thresholds, lefts, rights, default_lefts, leaf_values = [], [], [], [], [], []
+    roots = []
+    max_depth = 0
+    offset = 0
+    for tree in model_json['gradient_booster']['model']['trees']:
+        left = np.array(tree['left_children'], dtype=np.int32)
+        right = np.array(tree['right_children'], dtype=np.int32)
+        node_idx = np.arange(left.size, dtype=np.int32)
+        is_leaf = left == -1
+
+        # Leaves point to themselves so that rows stay at a leaf once reached.
+        lefts.append(np.where(is_leaf, node_idx, left) + offset)
+        rights.append(np.where(is_leaf, node_idx, right) + offset)
+        features.append(np.where(is_leaf, 0, tree['split_indices']).astype(np.int32))
+        thresholds.append(np.array(tree['split_conditions'], dtype=np.float32))
+        default_lefts.append(np.array(tree['default_left'], dtype=bool))
+        leaf_values.append(np.where(is_leaf, tree['split_conditions'], 0.0).astype(np.float32))
+
+        depths = np.zeros(left.size, dtype=np.int32)
+        for node in node_idx:
+            if not is_leaf[node]:
+                depths[left[node]] = depths[right[node]] = depths[node] + 1
+        max_depth = max(max_depth, int(depths.max()))
+
+        roots.append(offset)
+        offset += left.size
+
+    arrays_path = get_arrays_path(folder, identifier)
+    np.savez(
+        arrays_path,
+        feature=np.concatenate(features),
+        threshold=np.concatenate(thresholds),
+        left=np.concatenate(lefts),
+        right=np.concatenate(rights),
+        defaultLeft=np.concatenate(default_lefts),
+        leafValue=np.concatenate(leaf_values),
+        roots=np.array(roots, dtype=np.int32),
+        maxDepth=np.array(max_depth),
+        baseScore=np.array(float(model_json['learner_model_param']['base_score'])),
+        featureSet=np.array(FEATURE_SET),
+    )
+    return arrays_path
@@ -1,5 +1,6 @@
 """ Functions for reading in Prosit predicted spectra in msp format.
 """
+import io
 import re
 
 import numpy as np
@@ -128,6 +129,66 @@ def get_mods_from_msp_comment(line, sequence):
 
     return sequence, collision_energy
 
+def msp_process_entry(line, msp_file):
+    """ Function to extract a single predicted spectrum from the lines of an
+        msp file starting at its Name line.
+
+    Parameters
+    ----------
+    line : str
+        The Name line of the entry.
+    msp_file : file
+        The msp file, positioned after the Name line.
+
+    Returns
+    -------
+    sequence : str
+        The peptide sequence.
+    charge : int
+        The charge of the sequence.
+    modified_sequence : str
+        The sequence with any modifications added.
+    collision_energy : int
+        The collision energy of the prediction.
+    normed_intensities : dict
+        A dictionary of ion names mapped to their normed intensity.
+    """
+    sequence, charge = msp_process_sequence_and_charge(line)
+
+    line = msp_file.readline()
+    assert line.startswith('MW: ')
+
+    line = msp_file.readline()
+    assert line.startswith('Comment: ')
+    modified_sequence, collision_energy = get_mods_from_msp_comment(line, sequence)
+
+    line = msp_file.readline()
+    assert line.startswith('Num peaks: ')
+
+    normed_intensities = msp_process_peaks(line, msp_file)
+    return sequence, charge, modified_sequence, collision_energy, normed_intensities
+
+def iter_msp_entries(msp_filename):
+    """ Function to read the entries of an msp file one at a time.
+
+    Parameters
+    ----------
+    msp_filename : str
+        The location where the msp file is written.
+
+    Yields
+    ------
+    entry : tuple
+        The sequence, charge, modified sequence, collision energy and normed
+        intensities of the next entry, as returned by msp_process_entry.
+    """
+    with open(msp_filename, 'r', encoding='UTF-8') as msp_file:
+        line = msp_file.readline()
+        while line:
+            if line.startswith('Name: '):
+                yield msp_process_entry(line, msp_file)
+            line = msp_file.readline()
+
 def msp_to_df(msp_filename, with_ce=False):
     """ Function to process an msp file and extract relevant information
         for training into csv format (tab separated).
@@ -142,49 +203,123 @@ def msp_to_df(msp_filename, with_ce=False):
     ion_df : pd.DataFrame
         The DataFrame with the spectra found in the msp file.
     """
-    with open(msp_filename, 'r', encoding='UTF-8') as msp_file:
-        line = msp_file.readline()
-
-        peptides = []
-        charges = []
-        ion_intensities = []
-        modified_sequences = []
+    peptides = []
+    charges = []
+    ion_intensities = []
+    modified_sequences = []
+    if with_ce:
+        ces = []
+
+    for sequence, charge, modified_sequence, ce, normed_intensities in iter_msp_entries(
+        msp_filename
+    ):
+        ion_intensities.append(normed_intensities)
+        peptides.append(sequence)
+        charges.append(charge)
+        modified_sequences.append(modified_sequence)
         if with_ce:
-            ces = []
-
-        while line:
-            if line.startswith('Name: '):
-                sequence, charge = msp_process_sequence_and_charge(line)
-
-                line = msp_file.readline()
-                assert line.startswith('MW: ')
+           ces.append(ce)
+
+    ion_df = pd.DataFrame(
+        {
+            PROSIT_SEQ_KEY: modified_sequences,
+            CHARGE_KEY: charges,
+            PROSIT_IONS_KEY: ion_intensities,
+        }
+    )
+    if with_ce:
+        ion_df['collisionEnergy'] = pd.Series(ces)
 
-                line = msp_file.readline()
-                assert line.startswith('Comment: ')
-                modified_sequence, ce = get_mods_from_msp_comment(line, sequence)
+    return ion_df
 
-                line = msp_file.readline()
-                assert line.startswith('Num peaks: ')
+def index_msp_file(msp_filename):
+    """ Function to record the position of every entry of an msp file without
+        parsing the spectra, so that entries can later be read individually.
 
-                normed_intensities = msp_process_peaks(line, msp_file)
+    Parameters
+    ----------
+    msp_filename : str
+        The location where the msp file is written.
 
-                ion_intensities.append(normed_intensities)
-                peptides.append(sequence)
+    Returns
+    -------
+    index_df : pd.DataFrame
+        The modified sequence, charge, byte offset and byte length of each
+        entry, in the order found in the file.
+    """
+    modified_sequences = []
+    charges = []
+    offsets = []
+    offset = 0
+    sequence = None
+    with open(msp_filename, 'rb') as msp_file:
+        for raw_line in msp_file:
+            if raw_line.startswith(b'Name: '):
+                sequence, charge = msp_process_sequence_and_charge(_decode_line(raw_line))
                 charges.append(charge)
+                offsets.append(offset)
+            elif raw_line.startswith(b'Comment: ') and sequence is not None:
+                modified_sequence, _ = get_mods_from_msp_comment(_decode_line(raw_line), sequence)
                 modified_sequences.append(modified_sequence)
-                if with_ce:
-                   ces.append(ce)
+                sequence = None
+            offset += len(raw_line)
+
+    return pd.DataFrame(
+        {
+            PROSIT_SEQ_KEY: modified_sequences,
+            CHARGE_KEY: charges,
+            'offset': offsets,
+            'length': np.diff(offsets + [offset]),
+        }
+    )
 
-            line = msp_file.readline()
+def _decode_line(raw_line):
+    """ Function to decode a line read in binary mode as it would be read in
+        text mode.
+    """
+    return raw_line.decode('UTF-8').replace('\r\n', '\n')
 
-        ion_df = pd.DataFrame(
-            {
-                PROSIT_SEQ_KEY: modified_sequences,
-                CHARGE_KEY: charges,
-                PROSIT_IONS_KEY: ion_intensities,
-            }
-        )
-        if with_ce:
-            ion_df['collisionEnergy'] = pd.Series(ces)
+def read_msp_entries(msp_filename, index_df, with_ce=False):
+    """ Function to read selected entries of an msp file, located by
+        index_msp_file.
+
+    Parameters
+    ----------
+    msp_filename : str
+        The location where the msp file is written.
+    index_df : pd.DataFrame
+        The rows of the file's index for the entries to be read.
 
+    Returns
+    -------
+    ion_df : pd.DataFrame
+        The DataFrame with the spectra of the entries, in the format of
+        msp_to_df and in file order.
+    """
+    modified_sequences = []
+    charges = []
+    ion_intensities = []
+    ces = []
+    index_df = index_df.sort_values('offset')
+    with open(msp_filename, 'rb') as msp_file:
+        for offset, length in zip(index_df['offset'], index_df['length']):
+            msp_file.seek(offset)
+            entry_file = io.StringIO(msp_file.read(length).decode('UTF-8'), newline=None)
+            _, charge, modified_sequence, ce, normed_intensities = msp_process_entry(
+                entry_file.readline(), entry_file
+            )
+            modified_sequences.append(modified_sequence)
+            charges.append(charge)
+            ion_intensities.append(normed_intensities)
+            ces.append(ce)
+
+    ion_df = pd.DataFrame(
+        {
+            PROSIT_SEQ_KEY: pd.Series(modified_sequences, dtype=object),
+            CHARGE_KEY: pd.Series(charges, dtype=np.int64),
+            PROSIT_IONS_KEY: pd.Series(ion_intensities, dtype=object),
+        }
+    )
+    if with_ce:
+        ion_df['collisionEnergy'] = pd.Series(ces, dtype=np.int64)
     return ion_df
@@ -0,0 +1,154 @@
+""" Functions for training and predicting on datasets larger than memory.
+
+The finalised datasets are streamed in chunks of rows through an XGBoost
+DataIter into a QuantileDMatrix, which stores only the histogram bin of each
+feature value. Peak memory is then bounded by one chunk of rows plus the
+compressed matrix rather than the full dataset as floats.
+"""
+import zlib
+
+import numpy as np
+import xgboost as xgb
+
+from deltapro.constants import FEATURE_SET, TARGET_VARIABLE
+from deltapro.feature_store import fill_missing, iter_final_chunks
+from deltapro.finalise_input import MODEL_INPUT_COLUMNS, edit_features
+
+DEFAULT_N_ESTIMATORS = 100
+
+
+def get_validation_mask(peptides, validation_fraction):
+    """ Function to deterministically assign peptides to the validation split
+        used for early stopping, so that all rows of a peptide fall on the
+        same side whether the data is read at once or in chunks.
+
+    Parameters
+    ----------
+    peptides : pd.Series
+        The peptide of each row.
+    validation_fraction : float
+        The fraction of peptides assigned to the validation split.
+
+    Returns
+    -------
+    mask : np.array
+        True for rows in the validation split.
+    """
+    # The hash is salted so the split is independent of the train/test split.
+    return np.array([
+        zlib.crc32(f'validation:{peptide}'.encode('UTF-8')) % 1000 < validation_fraction*1000
+        for peptide in peptides
+    ], dtype=bool)
+
+def iter_feature_chunks(csv_path, chunk_size, columns=None):
+    """ Function to stream a finalised dataset in chunks with the derived
+        model features added, reading its feature store if it is up to date.
+
+    Yields
+    ------
+    chunk_df : pd.DataFrame
+        The next chunk of rows, with missing values filled.
+    """
+    for chunk_df in iter_final_chunks(csv_path, chunk_size, columns=columns):
+        yield edit_features(fill_missing(chunk_df))
+
+
+class FeatureBatchIter(xgb.DataIter):
+    """ Iterator passing the features and target of a finalised csv file to
+        XGBoost one chunk of rows at a time. If a validation fraction is given
+        only the rows of the training or validation split are passed.
+    """
+    def __init__(self, csv_path, chunk_size, validation_fraction=None, validation=False):
+        """ Initialise FeatureBatchIter object.
+        """
+        self.csv_path = csv_path
+        self.chunk_size = chunk_size
+        self.validation_fraction = validation_fraction
+        self.validation = validation
+        self.n_rows = 0
+        self._chunks = None
+        super().__init__()
+
+    def next(self, input_data):
+        """ Function to pass the next chunk to XGBoost, returning 0 once the
+            file is exhausted.
+        """
+        if self._chunks is None:
+            self._chunks = iter_feature_chunks(
+                self.csv_path, self.chunk_size, columns=MODEL_INPUT_COLUMNS + [TARGET_VARIABLE]
+            )
+            self.n_rows = 0
+        chunk_df = next(self._chunks, None)
+        if chunk_df is None:
+            return 0
+        if self.validation_fraction is not None:
+            chunk_df = chunk_df[
+                get_validation_mask(chunk_df['peptide'], self.validation_fraction) == self.validation
+            ]
+        self.n_rows += chunk_df.shape[0]
+        input_data(
+            data=chunk_df[FEATURE_SET].values.astype(np.float32),
+            label=chunk_df[TARGET_VARIABLE].values,
+            feature_names=FEATURE_SET,
+        )
+        return 1
+
+    def reset(self):
+        """ Function to restart reading from the start of the file.
+        """
+        self._chunks = None
+
+
+def build_quantile_matrix(
+    csv_path, chunk_size, n_threads, validation_fraction=None, validation=False, ref=None
+):
+    """ Function to build a QuantileDMatrix from a finalised csv file.
+
+    Parameters
+    ----------
+    csv_path : str
+        The finalised csv file.
+    chunk_size : int
+        The number of rows read at a time.
+    n_threads : int
+        The number of threads used by XGBoost.
+    validation_fraction : float or None
+        If given, only the rows of one split of get_validation_mask are used.
+    validation : bool
+        Whether the validation rather than the training split is used.
+    ref : xgb.QuantileDMatrix or None
+        The matrix whose bins are reused, required for validation matrices.
+
+    Returns
+    -------
+    data_matrix : xgb.QuantileDMatrix
+        The binned features and target.
+    n_rows : int
+        The number of rows used.
+    """
+    batch_iter = FeatureBatchIter(csv_path, chunk_size, validation_fraction, validation)
+    data_matrix = xgb.QuantileDMatrix(batch_iter, nthread=n_threads, ref=ref)
+    return data_matrix, batch_iter.n_rows
+
+def settings_to_params(settings, n_threads):
+    """ Function to convert an entry of optimisedSettings, given as XGBRegressor
+        arguments, to the parameters and number of rounds of xgb.train.
+    """
+    params = {
+        'objective': 'reg:squarederror',
+        'tree_method': 'hist',
+        **settings,
+        'nthread': n_threads,
+    }
+    params.pop('n_jobs', None)
+    n_rounds = params.pop('n_estimators', DEFAULT_N_ESTIMATORS)
+    return params, n_rounds
+
+def get_importances(booster):
+    """ Function to get the normalised gain importance of each feature, as
+        reported by XGBRegressor.feature_importances_.
+    """
+    scores = booster.get_score(importance_type='gain')
+    importances = np.array([scores.get(feature, 0.0) for feature in FEATURE_SET])
+    total = importances.sum()
+    return importances/total if total > 0 else importances
@@ -0,0 +1,236 @@
+""" Functions for running the preprocess pipeline on partitions of the PSMs so
+    that peak memory depends on the partition size rather than the corpus.
+
+The PSMs of flippedSeqs.csv are grouped by source file and the sources are
+packed into partitions of at most partitionSize PSMs, with any larger source
+split further by scan number. Each partition is written to its own file in a
+single chunked pass. The partitions are then processed one at a time through
+scan loading, matching, feature calculation and finalisation, and the output
+of each is appended to spectralData.csv, the featured data and the final train
+and test datasets. The Prosit predictions are indexed by byte offset once, or
+added to the prediction store, so that only the predictions needed by a
+partition are parsed. With a spectrumPredictor, the predictions missing from
+the store are requested as each partition is matched. The train/test
+split is assigned by a hash of the peptide, keeping it grouped by peptide
+across partitions.
+"""
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from deltapro.calculate_features import PEPTIDE_SPLIT_FILE, featurise, split_by_peptide, stratify
+from deltapro.data_io import append_to_csv, iter_csv_chunks
+from deltapro.finalise_input import FINAL_COLUMNS, finalise_feated_df
+from deltapro.mgf import process_mgf_file
+from deltapro.profiling import PROFILER
+from deltapro.spectral_data import (
+    SPECTRAL_DATA_COLUMNS, match_with_predictor, prepare_prosit_predictions, process_chunk
+)
+
+PARTITION_FOLDER = 'preprocessPartitions'
+
+
+def parse_scan(scan):
+    """ Function to convert the scan of a PSM to an integer scan number.
+    """
+    return int(scan.split(':')[-1]) if isinstance(scan, str) else scan
+
+def plan_partitions(flipped_path, partition_size, chunk_size):
+    """ Function to pack the source files of the PSMs into partitions.
+
+    Parameters
+    ----------
+    flipped_path : str
+        The flippedSeqs.csv file.
+    partition_size : int
+        The maximum number of PSMs of a partition.
+    chunk_size : int
+        The number of rows read at a time.
+
+    Returns
+    -------
+    plan : dict
+        The first partition and number of partitions of each source.
+    n_partitions : int
+        The total number of partitions.
+    """
+    source_counts = pd.Series(dtype='int64')
+    for chunk_df in iter_csv_chunks(flipped_path, chunk_size, columns=['source']):
+        source_counts = source_counts.add(
+            chunk_df['source'].astype(str).value_counts(), fill_value=0
+        )
+
+    plan = {}
+    n_partitions = 0
+    current_size = 0
+    for source, n_psms in source_counts.sort_index().items():
+        n_psms = int(n_psms)
+        if n_psms > partition_size:
+            # Sources larger than a partition are split by scan number.
+            n_parts = -(-n_psms//partition_size)
+            plan[source] = (n_partitions, n_parts)
+            n_partitions += n_parts
+            current_size = 0
+            continue
+        if current_size == 0 or current_size + n_psms > partition_size:
+            n_partitions += 1
+            current_size = 0
+        plan[source] = (n_partitions - 1, 1)
+        current_size += n_psms
+    return plan, n_partitions
+
+def get_partition_ids(chunk_df, plan):
+    """ Function to get the partition of each PSM.
+    """
+    first_partitions, n_parts = zip(*[plan[source] for source in chunk_df['source'].astype(str)])
+    return [
+        first + scan % n_part
+        for first, n_part, scan in zip(first_partitions, n_parts, chunk_df['scan'])
+    ]
+
+def split_into_partitions(flipped_path, plan, partition_folder, chunk_size):
+    """ Function to write the PSMs of each partition to its own file,
+        reading flippedSeqs.csv once in chunks.
+
+    Returns
+    -------
+    partition_files : dict
+        The file of each non-empty partition.
+    """
+    partition_files = {}
+    for chunk_df in iter_csv_chunks(flipped_path, chunk_size):
+        chunk_df['scan'] = chunk_df['scan'].apply(parse_scan)
+        for partition_idx, part_df in chunk_df.groupby(get_partition_ids(chunk_df, plan)):
+            partition_files[partition_idx] = f'{partition_folder}/flippedSeqs{partition_idx}.csv'
+            append_to_csv(part_df, partition_files[partition_idx])
+    return partition_files
+
+def match_partition(flip_df, chunk_id, folder, config, msp_indices, read_only_store=False):
+    """ Function to load the scans of a partition and match the Prosit
+        predictions to them. Shards pass read_only_store, reading the
+        predictions added to the store by planShards without requesting any.
+
+    Returns
+    -------
+    spec_df : pd.DataFrame
+        The spectral data of the partition, as written to spectralData.csv.
+    """
+    sources = set(flip_df['source'].astype(str))
+    all_scans = []
+    for scan_file in config.scan_files:
+        if os.path.basename(scan_file)[:-4] not in sources:
+            continue
+        with PROFILER.stage('loadScans', file=scan_file) as record:
+            scans_df = process_mgf_file(scan_file, set(flip_df['scan'].tolist()))
+            record['rowsOut'] = scans_df.shape[0]
+        all_scans.append(scans_df)
+    if not all_scans:
+        return None
+
+    flip_df = pd.merge(flip_df, pd.concat(all_scans), how='inner', on=['source', 'scan'])
+    if flip_df.shape[0] == 0:
+        return None
+    if config.spectrum_predictor is not None and not read_only_store:
+        spectral_files = match_with_predictor(flip_df, chunk_id, folder, config)
+    else:
+        spectral_files = [
+            process_chunk(flip_df, chunk_id, folder, config, msp_indices, read_only_store)
+        ]
+    spec_df = pd.concat([pd.read_csv(spectral_file) for spectral_file in spectral_files])
+    for spectral_file in spectral_files:
+        os.remove(spectral_file)
+    return spec_df
+
+def featurise_partition(spec_df, folder, split_df):
+    """ Function to split the spectral data of a partition into train and test
+        sets, compute the features of each flip and append the featured and
+        finalised data to the output files.
+
+    Returns
+    -------
+    split_df : pd.DataFrame
+        The updated peptide assignments.
+    """
+    spec_df['prositIons'] = spec_df['prositIons'].apply(json.loads)
+    spec_df['prositMatchedIons'] = spec_df['prositMatchedIons'].apply(json.loads)
+    spec_df['saStrata'] = spec_df['spectralAngle'].apply(stratify)
+    train, test, split_df = split_by_peptide(spec_df, split_df)
+
+    for idx in range(1, 6):
+        for tt, tt_df in (('train', train), ('test', test)):
+            with PROFILER.stage(f'features{idx}', rows_in=tt_df.shape[0], split=tt) as record:
+                feated_df = featurise(tt_df, idx)
+                record['rowsOut'] = feated_df.shape[0]
+            if feated_df.shape[0] > 0:
+                append_to_csv(feated_df, f'{folder}/{tt}FeatedData{idx}.csv')
+            with PROFILER.stage(f'finalise{idx}', rows_in=feated_df.shape[0], split=tt):
+                append_to_csv(finalise_feated_df(feated_df, idx), f'{folder}/{tt}Data.csv')
+    return split_df
+
+def write_missing_outputs(folder):
+    """ Function to write a header only file for each output which no
+        partition appended to, with the header the non-partitioned pipeline
+        writes for data without rows, so that every output exists.
+    """
+    empty_spec_df = pd.DataFrame(columns=SPECTRAL_DATA_COLUMNS + ['saStrata'])
+    headers = {f'{folder}/spectralData.csv': SPECTRAL_DATA_COLUMNS}
+    for tt in ('train', 'test'):
+        for idx in range(1, 6):
+            headers[f'{folder}/{tt}FeatedData{idx}.csv'] = featurise(empty_spec_df, idx).columns
+        headers[f'{folder}/{tt}Data.csv'] = FINAL_COLUMNS
+    for csv_path, columns in headers.items():
+        if not os.path.exists(csv_path):
+            pd.DataFrame(columns=columns).to_csv(csv_path, index=False)
+
+def run_partitioned_preprocess(config, output_files):
+    """ Function to run scan loading and matching, feature calculation and
+        finalisation one partition of PSMs at a time.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    output_files : list of str
+        The files written by the pipeline, removed before the first partition
+        is appended to them.
+    """
+    folder = config.output_folder
+    partition_folder = f'{folder}/{PARTITION_FOLDER}'
+    if os.path.exists(partition_folder):
+        shutil.rmtree(partition_folder)
+    os.makedirs(partition_folder)
+    for out_file in output_files:
+        if os.path.exists(out_file):
+            os.remove(out_file)
+
+    with PROFILER.stage('planPartitions') as record:
+        plan, n_partitions = plan_partitions(
+            f'{folder}/flippedSeqs.csv', config.partition_size, config.chunk_size
+        )
+        record['partitions'] = n_partitions
+    with PROFILER.stage('splitPartitions'):
+        partition_files = split_into_partitions(
+            f'{folder}/flippedSeqs.csv', plan, partition_folder, config.chunk_size
+        )
+    msp_indices = prepare_prosit_predictions(config)
+
+    split_df = pd.DataFrame({'peptide': pd.Series(dtype=str), 'split': pd.Series(dtype=str)})
+    for partition_idx, partition_file in sorted(partition_files.items()):
+        flip_df = pd.read_csv(partition_file)
+        os.remove(partition_file)
+        print(f'Running partition {partition_idx + 1} of {n_partitions}, size {flip_df.shape[0]}')
+        with PROFILER.stage('partition', rows_in=flip_df.shape[0], partition=partition_idx) as record:
+            spec_df = match_partition(
+                flip_df, f'Partition{partition_idx}', folder, config, msp_indices
+            )
+            if spec_df is None or spec_df.shape[0] == 0:
+                continue
+            append_to_csv(spec_df, f'{folder}/spectralData.csv')
+            split_df = featurise_partition(spec_df, folder, split_df)
+            record['rowsOut'] = spec_df.shape[0]
+
+    write_missing_outputs(folder)
+    split_df.to_csv(f'{folder}/{PEPTIDE_SPLIT_FILE}', index=False)
+    shutil.rmtree(partition_folder)
@@ -0,0 +1,96 @@
+""" Functions for scoring PSMs in batch with a trained model.
+"""
+import os
+import time
+
+from deltapro.constants import FEATURE_SET, TARGET_VARIABLE
+from deltapro.data_io import iter_csv_chunks
+from deltapro.finalise_input import MODEL_INPUT_COLUMNS, edit_features
+from deltapro.profiling import PROFILER
+from deltapro.resources import ThreadBudget
+from deltapro.tree_eval import load_tree_arrays, predict_tree_arrays
+
+ID_COLUMNS = ['peptide', 'source', 'charge', 'collisionEnergy', 'flipInd']
+PREDICTION_BACKENDS = ('xgboost', 'numpy')
+
+
+def load_predict_func(folder, identifier, backend, n_threads=None):
+    """ Function to load a model and return a function predicting from a 2d
+        feature array. The numpy backend uses the exported tree arrays so that
+        xgboost is never imported.
+
+    Parameters
+    ----------
+    folder : str
+        The folder the model was saved in.
+    identifier : str
+        The identifier of the model.
+    backend : str
+        The prediction backend, xgboost or numpy.
+    n_threads : int or None
+        The number of threads XGBoost predicts with, by default all cores.
+
+    Returns
+    -------
+    predict_func : function
+        A function mapping a 2d feature array to the predicted values.
+    """
+    if backend == 'numpy':
+        tree_arrays = load_tree_arrays(folder, identifier, FEATURE_SET)
+        return lambda features : predict_tree_arrays(tree_arrays, features)
+    if backend != 'xgboost':
+        raise ValueError(f'Unrecognised prediction backend {backend}.')
+
+    from deltapro.model_io import load_booster, predict_features
+    booster = load_booster(folder, identifier)
+    if n_threads is not None:
+        booster.set_param('nthread', n_threads)
+    return lambda features : predict_features(booster, features)
+
+
+def predict(config):
+    """ Function to predict the spectral angle delta of every row of the
+        prediction file with the best model. The file is streamed in chunks
+        and the predictions are written as each chunk is scored, so memory
+        use is bounded by the chunk size.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    identifier = config.best_model
+    budget = ThreadBudget(config.n_cores)
+    with budget.limit('predict') as (_, n_threads):
+        with PROFILER.stage('loadModel', model=identifier):
+            predict_func = load_predict_func(
+                config.output_folder, identifier, config.prediction_backend, n_threads
+            )
+
+        out_file = f'{config.output_folder}/predictions{identifier}.csv'
+        if os.path.exists(out_file):
+            os.remove(out_file)
+
+        n_rows = 0
+        start_time = time.time()
+        for chunk_df in iter_csv_chunks(
+            config.prediction_file,
+            config.chunk_size,
+            columns=MODEL_INPUT_COLUMNS + ID_COLUMNS + [TARGET_VARIABLE],
+        ):
+            with PROFILER.stage('predictChunk', rows_in=chunk_df.shape[0]):
+                chunk_df = edit_features(chunk_df.fillna(0))
+                chunk_df[f'predictedDiff{identifier}'] = predict_func(chunk_df[FEATURE_SET].values)
+                out_columns = [
+                    col for col in ID_COLUMNS + [TARGET_VARIABLE] if col in chunk_df.columns
+                ] + [f'predictedDiff{identifier}']
+                chunk_df[out_columns].to_csv(
+                    out_file, mode='a', header=(n_rows == 0), index=False
+                )
+            n_rows += chunk_df.shape[0]
+
+    total_time = time.time() - start_time
+    print(
+        f'Predicted {n_rows} rows in {total_time:.1f}s '
+        f'({n_rows/max(total_time, 1e-9):.1f} rows/s), written to {out_file}'
+    )
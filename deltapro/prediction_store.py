@@ -0,0 +1,464 @@
+""" Persistent store of Prosit predictions shared between projects.
+
+Predictions are kept in an SQLite database keyed by the model which produced
+them and the Prosit modified sequence, charge and collision energy.
+Predictions imported from msp files are recorded under the model msp, and
+those of a spectrumPredictor under its backend and model, so that predictions
+of different models are never mixed. Each spectrum is stored as a single
+blob of uint16 ion codes followed by float32 normed intensities, six bytes per
+peak. Every lookup records the time the prediction was last used, and when the
+spectra exceed the size limit the least recently used predictions are evicted,
+except those used since the process started, so a run never evicts the
+predictions it is about to read. Each prediction imported from an msp file
+records the hash of the file, and a file is no longer marked as imported once
+any of its predictions are evicted, so importing it again restores them.
+"""
+import os
+import re
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+import numpy as np
+import pandas as pd
+
+from deltapro.cache import hash_file
+from deltapro.msp import CHARGE_KEY, PROSIT_IONS_KEY, PROSIT_SEQ_KEY, iter_msp_entries
+from deltapro.profiling import PROFILER
+
+ION_TYPES = ('b', 'y')
+INSERT_BATCH_SIZE = 10_000
+STORE_TIMEOUT = 60
+PROCESS_START_TIME = time.time()
+MSP_MODEL = 'msp'
+
+_SCHEMA = [
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    '''CREATE TABLE IF NOT EXISTS predictions (
+        model TEXT NOT NULL,
+        sequence TEXT NOT NULL,
+        charge INTEGER NOT NULL,
+        collision_energy INTEGER NOT NULL,
+        spectrum BLOB NOT NULL,
+        last_used REAL NOT NULL,
+        file_hash TEXT,
+        PRIMARY KEY (model, sequence, charge, collision_energy)
+    )''',
+    'CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)',
+    '''CREATE TABLE IF NOT EXISTS imported_files (
+        file_hash TEXT PRIMARY KEY,
+        file_path TEXT NOT NULL,
+        n_predictions INTEGER NOT NULL
+    )''',
+]
+
+
+def encode_spectrum(ion_intensities):
+    """ Function to encode a predicted spectrum as a compact binary blob.
+
+    Parameters
+    ----------
+    ion_intensities : dict
+        A dictionary of b and y ion names, e.g. y3 or b5^2, mapped to their
+        normed intensity.
+
+    Returns
+    -------
+    spectrum : bytes
+        The uint16 ion codes followed by the float32 intensities.
+    """
+    codes = []
+    for ion in ion_intensities:
+        regex_match = re.fullmatch(r'([by])(\d+)(?:\^(\d))?', ion)
+        if regex_match is None:
+            raise ValueError(f'Unrecognised ion {ion} cannot be stored.')
+        ion_charge = int(regex_match.group(3) or 1)
+        codes.append(
+            (ION_TYPES.index(regex_match.group(1))*4 + ion_charge)*64 + int(regex_match.group(2))
+        )
+    return (
+        np.array(codes, dtype='<u2').tobytes() +
+        np.array(list(ion_intensities.values()), dtype='<f4').tobytes()
+    )
+
+def decode_spectrum(spectrum):
+    """ Function to decode a blob written by encode_spectrum.
+
+    Returns
+    -------
+    ion_intensities : dict
+        A dictionary of ion names mapped to their normed intensity.
+    """
+    n_peaks = len(spectrum)//6
+    codes = np.frombuffer(spectrum, dtype='<u2', count=n_peaks)
+    intensities = np.frombuffer(spectrum, dtype='<f4', offset=2*n_peaks)
+    ion_intensities = {}
+    for code, intensity in zip(codes.tolist(), intensities.tolist()):
+        ion_type, ion_charge = divmod(code//64, 4)
+        name = f'{ION_TYPES[ion_type]}{code % 64}'
+        if ion_charge > 1:
+            name += f'^{ion_charge}'
+        ion_intensities[name] = intensity
+    return ion_intensities
+
+
+class PredictionStore:
+    """ Holder for the connection to a persistent store of Prosit predictions,
+        reading and adding the predictions of a single model.
+    """
+    def __init__(self, store_path, max_mb=None, model=MSP_MODEL, read_only=False):
+        """ Initialise PredictionStore object.
+
+        Parameters
+        ----------
+        store_path : str
+            The SQLite database of the store.
+        max_mb : float or None
+            The size limit of the stored spectra in MB, or None for no limit.
+        model : str
+            The model whose predictions are read and added.
+        read_only : bool
+            Whether the store is opened read only, as by shards running
+            concurrently on machines sharing a filesystem, in which case
+            predictions are neither added nor marked as used nor evicted.
+        """
+        self.store_path = store_path
+        self.max_bytes = None if max_mb is None else int(max_mb*1024*1024)
+        self.model = model
+        self.read_only = read_only
+        if read_only:
+            self.connection = sqlite3.connect(
+                f'file:{pathname2url(os.path.abspath(store_path))}?mode=ro',
+                uri=True,
+                timeout=STORE_TIMEOUT,
+            )
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(predictions)')]
+            if 'model' not in columns:
+                self.connection.close()
+                raise ValueError(
+                    f'{store_path} is not a current prediction store, run planShards to update it.'
+                )
+            return
+        self.connection = sqlite3.connect(store_path, timeout=STORE_TIMEOUT)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(predictions)')]
+        if columns and 'model' not in columns:
+            self.connection.execute('ALTER TABLE predictions RENAME TO old_predictions')
+            self.connection.execute('DROP INDEX IF EXISTS predictions_last_used')
+        for statement in _SCHEMA:
+            self.connection.execute(statement)
+        if columns and 'model' not in columns:
+            self._migrate(columns)
+        self.connection.commit()
+
+    def _migrate(self, columns):
+        """ Function to move the predictions of a store without models into
+            the current table. Only predictions recorded as imported from an
+            msp file are known to be Prosit's and are kept, the files of any
+            others are imported again.
+        """
+        if 'file_hash' in columns:
+            self.connection.execute(
+                'INSERT INTO predictions SELECT ?, sequence, charge, collision_energy, spectrum, '
+                'last_used, file_hash FROM old_predictions WHERE file_hash IS NOT NULL',
+                (MSP_MODEL,),
+            )
+        else:
+            self.connection.execute('DELETE FROM imported_files')
+        self.connection.execute('DROP TABLE old_predictions')
+        print(f'Moved the predictions of {self.store_path} to the current format.')
+
+    def close(self):
+        """ Function to close the connection to the store.
+        """
+        self.connection.close()
+
+    def _load_keys(self, keys_df):
+        """ Function to write a set of keys to a temporary table of the
+            connection, from which they can be joined to the predictions.
+        """
+        self.connection.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS lookup_keys '
+            '(sequence TEXT, charge INTEGER, collision_energy INTEGER)'
+        )
+        self.connection.execute('DELETE FROM lookup_keys')
+        self.connection.executemany(
+            'INSERT INTO lookup_keys VALUES (?, ?, ?)',
+            keys_df.drop_duplicates().itertuples(index=False, name=None),
+        )
+
+    def _mark_used(self):
+        """ Function to record the current time as the last use of the stored
+            predictions of the keys in the temporary table.
+        """
+        if self.read_only:
+            return
+        self.connection.execute(
+            'UPDATE predictions SET last_used = ? WHERE model = ? AND '
+            '(sequence, charge, collision_energy) IN '
+            '(SELECT sequence, charge, collision_energy FROM lookup_keys)',
+            (time.time(), self.model),
+        )
+        self.connection.commit()
+
+    def find_missing(self, keys_df):
+        """ Function to find the keys without a stored prediction, marking the
+            stored ones as used.
+
+        Parameters
+        ----------
+        keys_df : pd.DataFrame
+            The modified sequence, charge and collision energy of each key,
+            in that column order.
+
+        Returns
+        -------
+        missing : pd.Series
+            True for rows of keys_df without a stored prediction.
+        """
+        keys_df = keys_df.astype({keys_df.columns[1]: int, keys_df.columns[2]: int})
+        self._load_keys(keys_df)
+        stored = set(self.connection.execute(
+            'SELECT k.sequence, k.charge, k.collision_energy FROM lookup_keys k '
+            'JOIN predictions p USING (sequence, charge, collision_energy) WHERE p.model = ?',
+            (self.model,),
+        ).fetchall())
+        self._mark_used()
+        return pd.Series(
+            [key not in stored for key in keys_df.itertuples(index=False, name=None)],
+            index=keys_df.index,
+        )
+
+    def get_predictions(self, keys_df):
+        """ Function to get the stored predictions of a set of keys, marking
+            them as used.
+
+        Parameters
+        ----------
+        keys_df : pd.DataFrame
+            The modified sequence, charge and collision energy of each key,
+            in that column order.
+
+        Returns
+        -------
+        ion_df : pd.DataFrame
+            The predictions found, in the format of msp_to_df with collision
+            energies.
+        """
+        keys_df = keys_df.dropna().astype({keys_df.columns[1]: int, keys_df.columns[2]: int})
+        self._load_keys(keys_df)
+        rows = self.connection.execute(
+            'SELECT p.sequence, p.charge, p.collision_energy, p.spectrum FROM lookup_keys k '
+            'JOIN predictions p USING (sequence, charge, collision_energy) WHERE p.model = ?',
+            (self.model,),
+        ).fetchall()
+        self._mark_used()
+        # Only sequences of 7 to 30 residues are ever predicted by Prosit.
+        missing = [
+            key for (key,) in self.connection.execute(
+                'SELECT k.sequence FROM lookup_keys k LEFT JOIN predictions p '
+                'ON p.model = ? AND p.sequence = k.sequence AND p.charge = k.charge '
+                'AND p.collision_energy = k.collision_energy WHERE p.spectrum IS NULL',
+                (self.model,),
+            ) if 6 < len(key.replace('M(ox)', 'M')) < 31
+        ]
+        if missing:
+            print(
+                f'Warning: {len(missing)} required predictions are missing from '
+                f'{self.store_path}, the PSMs needing them will not be matched.'
+            )
+        return pd.DataFrame(
+            {
+                PROSIT_SEQ_KEY: pd.Series([row[0] for row in rows], dtype=object),
+                CHARGE_KEY: pd.Series([row[1] for row in rows], dtype=np.int64),
+                PROSIT_IONS_KEY: pd.Series(
+                    [decode_spectrum(row[3]) for row in rows], dtype=object
+                ),
+                'collisionEnergy': pd.Series([row[2] for row in rows], dtype=np.int64),
+            }
+        )
+
+    def import_msp(self, msp_filename):
+        """ Function to add the predictions of an msp file to the store under
+            the model msp, skipping files whose content has already been
+            imported.
+
+        Returns
+        -------
+        n_predictions : int
+            The number of predictions added.
+        """
+        file_hash = hash_file(msp_filename)
+        if self.connection.execute(
+            'SELECT 1 FROM imported_files WHERE file_hash = ?', (file_hash,)
+        ).fetchone() is not None:
+            return 0
+
+        n_predictions = 0
+        batch = []
+        for _, charge, modified_sequence, ce, normed_intensities in iter_msp_entries(msp_filename):
+            batch.append((
+                MSP_MODEL,
+                modified_sequence,
+                charge,
+                ce,
+                encode_spectrum(normed_intensities),
+                time.time(),
+                file_hash,
+            ))
+            if len(batch) == INSERT_BATCH_SIZE:
+                n_predictions += self._insert(batch)
+                batch = []
+        n_predictions += self._insert(batch)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO imported_files VALUES (?, ?, ?)',
+            (file_hash, msp_filename, n_predictions),
+        )
+        self.connection.commit()
+        self.evict()
+        return n_predictions
+
+    def add_predictions(self, keys_df, spectra):
+        """ Function to add predicted spectra to the store.
+
+        Parameters
+        ----------
+        keys_df : pd.DataFrame
+            The modified sequence, charge and collision energy of each key,
+            in that column order.
+        spectra : list of dict
+            The normed ion intensities predicted for each key.
+
+        Returns
+        -------
+        n_predictions : int
+            The number of predictions added.
+        """
+        used_time = time.time()
+        n_predictions = self._insert([
+            (
+                self.model,
+                sequence,
+                int(charge),
+                int(collision_energy),
+                encode_spectrum(spectrum),
+                used_time,
+                None,
+            )
+            for (sequence, charge, collision_energy), spectrum in zip(
+                keys_df.itertuples(index=False, name=None), spectra
+            )
+        ])
+        self.evict()
+        return n_predictions
+
+    def _insert(self, batch):
+        """ Function to insert or replace a batch of predictions.
+        """
+        if self.read_only:
+            raise ValueError(f'Predictions cannot be added to {self.store_path} opened read only.')
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?)', batch
+        )
+        self.connection.commit()
+        return len(batch)
+
+    def get_size(self):
+        """ Function to get the total size in bytes of the stored spectra.
+        """
+        return self.connection.execute(
+            'SELECT COALESCE(SUM(LENGTH(spectrum)), 0) FROM predictions'
+        ).fetchone()[0]
+
+    def evict(self):
+        """ Function to delete the least recently used predictions until the
+            stored spectra fit within the size limit. Predictions used since
+            the process started are kept, and the files whose predictions are
+            deleted are no longer marked as imported.
+
+        Returns
+        -------
+        n_evicted : int
+            The number of predictions deleted.
+        """
+        if self.max_bytes is None or self.read_only:
+            return 0
+        excess = self.get_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+
+        evicted = []
+        file_hashes = set()
+        cursor = self.connection.execute(
+            'SELECT rowid, LENGTH(spectrum), file_hash FROM predictions '
+            'WHERE last_used < ? ORDER BY last_used',
+            (PROCESS_START_TIME,),
+        )
+        for rowid, n_bytes, file_hash in cursor:
+            evicted.append((rowid,))
+            if file_hash is not None:
+                file_hashes.add(file_hash)
+            excess -= n_bytes
+            if excess <= 0:
+                break
+        cursor.close()
+        self.connection.executemany('DELETE FROM predictions WHERE rowid = ?', evicted)
+        self.connection.executemany(
+            'DELETE FROM imported_files WHERE file_hash = ?',
+            [(file_hash,) for file_hash in file_hashes],
+        )
+        self.connection.commit()
+        self.connection.execute('PRAGMA incremental_vacuum')
+        print(f'Evicted {len(evicted)} predictions from {self.store_path}.')
+        if excess > 0:
+            print(
+                f'Warning: {self.store_path} exceeds its size limit by {excess/1024/1024:.1f} MB, '
+                'as the remaining predictions have been used by this run.'
+            )
+        return len(evicted)
+
+
+def get_store_model(config):
+    """ Function to get the model under which the predictions of the config
+        are stored, msp for the prositPredictions files or the backend and
+        model of the spectrumPredictor.
+    """
+    if config.spectrum_predictor is None:
+        return MSP_MODEL
+    if config.spectrum_predictor == 'koina':
+        return f'koina:{config.predictor_model}'
+    return config.spectrum_predictor
+
+def open_prediction_store(config, read_only=False):
+    """ Function to open the prediction store of the config, if one is set.
+        Shards open it read only, see PredictionStore.
+
+    Returns
+    -------
+    store : PredictionStore or None
+        The open store, or None if predictionStore is not set.
+    """
+    if config.prediction_store is None:
+        return None
+    return PredictionStore(
+        config.prediction_store,
+        config.prediction_store_max_mb,
+        get_store_model(config),
+        read_only,
+    )
+
+def import_prosit_predictions(config, n_files):
+    """ Function to add the prositPredictions msp files of the output folder
+        to the prediction store. With a spectrumPredictor they are not used,
+        as they may not have been predicted by its model.
+    """
+    if config.spectrum_predictor is not None:
+        print('prositPredictions files are not imported when a spectrumPredictor is set.')
+        return
+    store = open_prediction_store(config)
+    try:
+        for idx in range(n_files):
+            msp_path = f'{config.output_folder}/prositPredictions{idx}.msp'
+            with PROFILER.stage('importPredictions', file=msp_path) as record:
+                record['rowsOut'] = store.import_msp(msp_path) if os.path.exists(msp_path) else 0
+    finally:
+        store.close()
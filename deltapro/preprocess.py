@@ -0,0 +1,113 @@
+""" Functions to orchestrate the stages of the preprocess pipeline.
+"""
+from deltapro.cache import run_cached_stage, write_cache_report
+from deltapro.calculate_features import PEPTIDE_SPLIT_FILE, calculate_features
+from deltapro.feature_store import write_feature_stores
+from deltapro.finalise_input import finalise_input
+from deltapro.partitioned_preprocess import run_partitioned_preprocess
+from deltapro.spectral_data import process_spectral_data
+
+N_PROSIT_FILES = 6
+N_FEATURE_FILES = 5
+
+
+def run_preprocess(config):
+    """ Function to run scan loading and matching, feature calculation and
+        finalisation, skipping any stage whose inputs are unchanged. If
+        partitionSize is set the stages are run one partition of PSMs at a
+        time and cached as a single stage.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    folder = config.output_folder
+    feated_files = [
+        f'{folder}/{tt}FeatedData{idx}.csv'
+        for tt in ('train', 'test') for idx in range(1, N_FEATURE_FILES+1)
+    ]
+    final_files = [f'{folder}/trainData.csv', f'{folder}/testData.csv']
+    prosit_files = [f'{folder}/prositPredictions{idx}.msp' for idx in range(N_PROSIT_FILES)]
+    spectral_settings = {'scanFiles': config.scan_files}
+    if config.prediction_store is not None:
+        spectral_settings['predictionStore'] = config.prediction_store
+    if config.spectrum_predictor is not None:
+        spectral_settings['spectrumPredictor'] = config.spectrum_predictor
+        spectral_settings['predictorModel'] = config.predictor_model
+    if config.partition_size is not None:
+        output_files = (
+            [f'{folder}/spectralData.csv'] + feated_files +
+            [f'{folder}/{PEPTIDE_SPLIT_FILE}'] + final_files
+        )
+        report = run_cached_stage(
+            config,
+            'partitionedPreprocess',
+            lambda: run_partitioned_preprocess(config, output_files),
+            input_files=[f'{folder}/flippedSeqs.csv'] + config.scan_files + prosit_files,
+            output_files=output_files,
+            settings={**spectral_settings, 'partitionSize': config.partition_size},
+        )
+        write_cache_report(folder, [report])
+        write_feature_stores(config)
+        return
+
+    if config.incremental:
+        # Incremental stages read only the increments written by the previous
+        # stage but also append to the full intermediate files. The full files
+        # are hashed before they are appended to, so that an increment is only
+        # reused on top of the same cumulative state it was appended to.
+        spectral_files = [f'{folder}/spectralData.csv', f'{folder}/spectralDataIncrement.csv']
+        feated_increments = [
+            f'{folder}/{tt}FeatedDataIncrement{idx}.csv'
+            for tt in ('train', 'test') for idx in range(1, N_FEATURE_FILES+1)
+        ]
+        spectral_inputs = [f'{folder}/spectralData.csv']
+        feature_inputs = (
+            [f'{folder}/spectralDataIncrement.csv', f'{folder}/{PEPTIDE_SPLIT_FILE}'] +
+            feated_files
+        )
+        feature_outputs = feated_files + feated_increments
+        finalise_inputs = feated_increments + final_files
+        final_outputs = final_files + [
+            f'{folder}/trainDataIncrement.csv', f'{folder}/testDataIncrement.csv'
+        ]
+    else:
+        spectral_files = [f'{folder}/spectralData.csv']
+        spectral_inputs = []
+        feature_inputs = [f'{folder}/spectralData.csv']
+        feature_outputs = feated_files
+        finalise_inputs = feated_files
+        final_outputs = final_files
+    settings = {'incremental': config.incremental}
+    reports = []
+
+    reports.append(run_cached_stage(
+        config,
+        'spectralData',
+        lambda: process_spectral_data(config),
+        input_files=(
+            [f'{folder}/flippedSeqs.csv'] + config.scan_files + prosit_files + spectral_inputs
+        ),
+        output_files=spectral_files,
+        settings={**settings, **spectral_settings},
+    ))
+    reports.append(run_cached_stage(
+        config,
+        'features',
+        lambda: calculate_features(folder, config),
+        input_files=feature_inputs,
+        output_files=feature_outputs + [f'{folder}/{PEPTIDE_SPLIT_FILE}'],
+        settings=settings,
+    ))
+    reports.append(run_cached_stage(
+        config,
+        'finalise',
+        lambda: finalise_input(folder, config.incremental),
+        input_files=finalise_inputs,
+        output_files=final_outputs,
+        settings=settings,
+    ))
+
+    write_cache_report(folder, reports)
+    write_feature_stores(config)
@@ -0,0 +1,194 @@
+""" Definition of the Profiler class for recording the resource usage of each
+    pipeline stage and its major sub-steps.
+"""
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def _cpu_seconds():
+    """ Function to get the CPU time used by this process and its children.
+    """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        self_usage.ru_utime + self_usage.ru_stime +
+        child_usage.ru_utime + child_usage.ru_stime
+    )
+
+def _current_rss_mb():
+    """ Function to get the current resident set size of this process in MB,
+        or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r', encoding='UTF-8') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages*os.sysconf('SC_PAGE_SIZE')/1_048_576
+
+def _peak_rss_mb():
+    """ Function to get the peak resident set size of this process over its
+        lifetime in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*RSS_UNIT/1_048_576
+
+
+class Profiler:
+    """ Holder for the resource usage records of a pipeline run. While
+        disabled, stages are not timed. The current RSS is sampled by a
+        background thread while stages run, giving the RSS at the start of
+        each stage and its peak within the stage. tracemalloc, which slows
+        allocation heavy code, is only started if requested.
+    """
+    def __init__(self):
+        """ Initialise Profiler object.
+        """
+        self.enabled = False
+        self.trace_memory = False
+        self.records = []
+        self._stack = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def enable(self, trace_memory=False):
+        """ Function to start recording stages.
+
+        Parameters
+        ----------
+        trace_memory : bool
+            Whether the tracemalloc peak of Python allocations of each stage
+            is also recorded.
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._sampler is None and _current_rss_mb() is not None:
+            self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+            self._sampler.start()
+
+    def _sample_rss(self):
+        """ Function run by the sampling thread to update the RSS peak of
+            every running stage.
+        """
+        while True:
+            rss_mb = _current_rss_mb()
+            with self._lock:
+                for record in self._stack:
+                    record['_rssPeak'] = max(record['_rssPeak'], rss_mb)
+            time.sleep(RSS_SAMPLE_SECONDS)
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **details):
+        """ Context manager to record the wall time, CPU time, RSS change and
+            peak, and optionally the tracemalloc peak, of a stage. The yielded
+            dictionary may be updated by the caller, for example with rowsOut.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        rows_in : int or None
+            The number of rows input to the stage.
+        **details
+            Any further JSON serialisable information about the stage.
+        """
+        record = {
+            'stage': name,
+            'parent': self._stack[-1]['stage'] if self._stack else None,
+            'depth': len(self._stack),
+            'rowsIn': rows_in,
+            'rowsOut': None,
+            **details,
+        }
+        if not self.enabled:
+            yield record
+            return
+
+        # The tracemalloc peak is reset for each stage, so the peak seen so far
+        # is passed up to the enclosing stage first.
+        if self.trace_memory:
+            if self._stack:
+                parent = self._stack[-1]
+                parent['_tracedPeak'] = max(
+                    parent['_tracedPeak'], tracemalloc.get_traced_memory()[1]
+                )
+            tracemalloc.reset_peak()
+            record['_tracedPeak'] = 0
+        start_rss = _current_rss_mb()
+        record['_rssPeak'] = start_rss
+        with self._lock:
+            self._stack.append(record)
+        self.records.append(record)
+
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_seconds()
+        try:
+            yield record
+        finally:
+            record['wallSeconds'] = time.perf_counter() - start_wall
+            record['cpuSeconds'] = _cpu_seconds() - start_cpu
+            end_rss = _current_rss_mb()
+            with self._lock:
+                self._stack.pop()
+                rss_peak = record.pop('_rssPeak')
+            if start_rss is None:
+                # Without /proc only the lifetime peak is known.
+                record['processPeakRssMb'] = _peak_rss_mb()
+            else:
+                record['rssStartMb'] = start_rss
+                record['rssEndMb'] = end_rss
+                record['rssDeltaMb'] = end_rss - start_rss
+                record['rssPeakMb'] = max(rss_peak, end_rss)
+                record['rssPeakDeltaMb'] = record['rssPeakMb'] - start_rss
+            if self.trace_memory:
+                traced_peak = max(record.pop('_tracedPeak'), tracemalloc.get_traced_memory()[1])
+                record['tracemallocPeakMb'] = traced_peak/1_048_576
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent['_tracedPeak'] = max(parent['_tracedPeak'], traced_peak)
+                tracemalloc.reset_peak()
+
+    def write(self, output_folder, pipeline):
+        """ Function to write all records to a json file in the profiles folder.
+
+        Parameters
+        ----------
+        output_folder : str
+            The folder where all output is written.
+        pipeline : str
+            The pipeline which was run.
+
+        Returns
+        -------
+        profile_file : str
+            The file written.
+        """
+        os.makedirs(f'{output_folder}/profiles', exist_ok=True)
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+        profile_file = f'{output_folder}/profiles/{pipeline}-{timestamp}.json'
+        with open(profile_file, 'w', encoding='UTF-8') as out_file:
+            json.dump(
+                {
+                    'pipeline': pipeline,
+                    'timestamp': timestamp,
+                    'stages': self.records,
+                },
+                out_file,
+                indent=2,
+                default=str,
+            )
+        return profile_file
+
+
+PROFILER = Profiler()
@@ -0,0 +1,97 @@
+""" Definition of the ThreadBudget class for sharing the nCores of a run between
+    outer parallelism, such as cross validation workers, and the inner threads
+    of XGBoost and the BLAS/OpenMP libraries.
+"""
+from contextlib import contextmanager
+import os
+
+from threadpoolctl import threadpool_limits
+
+
+def get_available_cores():
+    """ Function to get the number of cores this process may run on. On shared
+        nodes the scheduler usually restricts the CPU affinity of a job, which
+        is respected here.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ThreadBudget:
+    """ Holder for the number of cores available to a run, which are split
+        between outer workers and inner threads so that their product never
+        exceeds the budget.
+    """
+    def __init__(self, n_cores):
+        """ Initialise ThreadBudget object.
+
+        Parameters
+        ----------
+        n_cores : int or None
+            The nCores value of the config, capped at the available cores.
+            If None all available cores are used.
+        """
+        self.available_cores = get_available_cores()
+        if n_cores is None:
+            n_cores = self.available_cores
+        self.n_cores = max(1, min(n_cores, self.available_cores))
+        if n_cores > self.available_cores:
+            print(
+                f'nCores is {n_cores} but only {self.available_cores} cores are '
+                f'available, using {self.n_cores}.'
+            )
+        self.allocations = []
+
+    def split(self, n_tasks):
+        """ Function to split the budget between outer workers and inner threads.
+
+        Parameters
+        ----------
+        n_tasks : int
+            The number of independent tasks which may run in parallel.
+
+        Returns
+        -------
+        n_workers : int
+            The number of outer workers.
+        n_threads : int
+            The number of threads of each worker.
+        """
+        n_workers = max(1, min(n_tasks, self.n_cores))
+        return n_workers, max(1, self.n_cores // n_workers)
+
+    @contextmanager
+    def limit(self, name, n_tasks=1):
+        """ Context manager to allocate the budget to a step and limit the
+            BLAS/OpenMP thread pools of this process to the inner threads.
+
+        Parameters
+        ----------
+        name : str
+            The name of the step, used in the report.
+        n_tasks : int
+            The number of independent tasks of the step.
+
+        Yields
+        ------
+        n_workers : int
+            The number of outer workers.
+        n_threads : int
+            The number of threads of each worker.
+        """
+        n_workers, n_threads = self.split(n_tasks)
+        self.allocations.append({
+            'step': name,
+            'tasks': n_tasks,
+            'workers': n_workers,
+            'threadsPerWorker': n_threads,
+            'nCores': self.n_cores,
+            'availableCores': self.available_cores,
+        })
+        print(
+            f'{name}: {n_workers} worker(s) x {n_threads} thread(s) '
+            f'of {self.n_cores} cores ({self.available_cores} available)'
+        )
+        with threadpool_limits(limits=n_threads):
+            yield n_workers, n_threads
@@ -2,14 +2,9 @@ from argparse import ArgumentParser
 import random
 
 import numpy as np
-from deltapro.analyse import analyse
 
 from deltapro.config import Config
-from deltapro.calculate_features import calculate_features
-from deltapro.finalise_input import finalise_input
-from deltapro.flip_residues import generate_flipped_data
-from deltapro.spectral_data import process_spectral_data
-from deltapro.train_model import train_model
+from deltapro.profiling import PROFILER
 
 
 random.seed(42)
@@ -20,6 +15,14 @@ PIPELINE_OPTIONS = [
     'preprocess',
     'train',
     'analyse',
+    'predict',
+    'serve',
+    'updateModel',
+    'compact',
+    'evaluate',
+    'planShards',
+    'mergeShards',
+    'runShards',
 ]
 
 def get_arguments():
@@ -42,44 +45,145 @@ def get_arguments():
         choices=PIPELINE_OPTIONS,
         help='What pipeline do you want to run?',
     )
+    parser.add_argument(
+        '--shard',
+        type=int,
+        help='With the preprocess pipeline, run only this shard of the shard manifest.',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Record the resource usage of each stage to a json file.',
+    )
+    parser.add_argument(
+        '--profile-memory',
+        action='store_true',
+        help='With --profile, also record the tracemalloc peak of each stage, which slows it down.',
+    )
 
     return parser.parse_args()
 
-def main():
-    """ Function to orchestrate running of each spi-screen pipeline.
+def run_pipeline(pipeline, config, shard=None):
+    """ Function to run a single pipeline.
+
+    Parameters
+    ----------
+    pipeline : str
+        The pipeline to be run, one of PIPELINE_OPTIONS.
+    config : deltapro.config.Config
+        The Config object for the run.
+    shard : int or None
+        The shard run by the preprocess pipeline, if sharded.
     """
-    args = get_arguments()
-    config = Config(args.config_file)
-    config.validate(args.pipeline)
-
-    if args.pipeline == 'flipSequences':
-        generate_flipped_data(
-            config.search_files,
-            config.n_flips,
-            config.output_folder,
-            config.collision_energies,
-        )
+    # Pipelines are imported only when run, so that short jobs do not pay for
+    # importing the plotting and machine learning libraries of the others.
+    if pipeline == 'flipSequences':
+        from deltapro.flip_residues import generate_flipped_data
+        from deltapro.prediction_store import open_prediction_store
+        store = open_prediction_store(config)
+        try:
+            generate_flipped_data(
+                config.search_files,
+                config.n_flips,
+                config.output_folder,
+                config.collision_energies,
+                config.incremental,
+                store,
+            )
+        finally:
+            if store is not None:
+                store.close()
 
-    if args.pipeline == 'preprocess':
-        process_spectral_data(
+    if pipeline == 'preprocess' and shard is not None:
+        from deltapro.shards import run_shard
+        run_shard(
             config,
+            shard,
         )
-        calculate_features(
-            config.output_folder, config
-        )
-        finalise_input(
-            config.output_folder,
+
+    if pipeline == 'preprocess' and shard is None:
+        from deltapro.preprocess import run_preprocess
+        run_preprocess(
+            config,
         )
 
-    if args.pipeline == 'train':
+    if pipeline == 'train':
+        from deltapro.train_model import train_model
         train_model(
             config,
         )
 
-    if args.pipeline == 'analyse':
+    if pipeline == 'analyse':
+        from deltapro.analyse import analyse
         analyse(
             config,
         )
 
+    if pipeline == 'predict':
+        from deltapro.predict import predict
+        predict(
+            config,
+        )
+
+    if pipeline == 'serve':
+        from deltapro.server import serve
+        serve(
+            config,
+        )
+
+    if pipeline == 'updateModel':
+        from deltapro.update_model import update_model
+        update_model(
+            config,
+        )
+
+    if pipeline == 'compact':
+        from deltapro.compact_model import compact_model
+        compact_model(
+            config,
+        )
+
+    if pipeline == 'evaluate':
+        from deltapro.evaluate_model import evaluate
+        evaluate(
+            config,
+        )
+
+    if pipeline == 'planShards':
+        from deltapro.shards import plan_shards
+        plan_shards(
+            config,
+        )
+
+    if pipeline == 'mergeShards':
+        from deltapro.shards import merge_shards
+        merge_shards(
+            config,
+        )
+
+    if pipeline == 'runShards':
+        from deltapro.shards import run_shards_locally
+        run_shards_locally(
+            config,
+        )
+
+def main():
+    """ Function to orchestrate running of each spi-screen pipeline.
+    """
+    args = get_arguments()
+    config = Config(args.config_file)
+    config.validate(args.pipeline, args.shard)
+
+    if args.profile:
+        PROFILER.enable(trace_memory=args.profile_memory)
+
+    with PROFILER.stage(args.pipeline):
+        run_pipeline(args.pipeline, config, args.shard)
+
+    if args.profile:
+        profile_name = args.pipeline if args.shard is None else f'{args.pipeline}Shard{args.shard}'
+        profile_file = PROFILER.write(config.output_folder, profile_name)
+        print(f'Profile written to {profile_file}')
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,273 @@
+""" Functions and classes for a local prediction server which keeps the best
+    model loaded and micro-batches concurrent requests into single predict
+    calls.
+"""
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import threading
+import time
+from urllib import request as url_request
+
+import numpy as np
+import pandas as pd
+
+from deltapro.constants import FEATURE_SET
+from deltapro.finalise_input import edit_features
+from deltapro.predict import load_predict_func
+from deltapro.resources import ThreadBudget
+
+LATENCY_WINDOW = 10_000
+SERVER_HOST = '127.0.0.1'
+
+
+class PredictionBatcher:
+    """ Holder for a prediction function and the queue of pending requests,
+        which are combined into batches by a single worker thread.
+    """
+    def __init__(self, predict_func, max_batch_rows, max_wait_ms):
+        """ Initialise PredictionBatcher object.
+        """
+        self.predict_func = predict_func
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms/1000
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_rows = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, features):
+        """ Function to queue a feature matrix for prediction.
+
+        Parameters
+        ----------
+        features : np.array
+            A 2d array of features in FEATURE_SET order.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            A future resolving to the array of predictions.
+        """
+        future = Future()
+        self._queue.put((features, future, time.perf_counter()))
+        return future
+
+    def _collect_batch(self):
+        """ Function to wait for a request then collect further requests until
+            the batch is full or the maximum wait has passed.
+        """
+        batch = [self._queue.get()]
+        n_rows = batch[0][0].shape[0]
+        deadline = time.perf_counter() + self.max_wait
+        while n_rows < self.max_batch_rows:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            n_rows += batch[-1][0].shape[0]
+        return batch
+
+    def _run(self):
+        """ Function run by the worker thread to predict each batch.
+        """
+        while True:
+            batch = self._collect_batch()
+            try:
+                predictions = self.predict_func(np.vstack([entry[0] for entry in batch]))
+            except Exception as err:
+                for _, future, _ in batch:
+                    future.set_exception(err)
+                continue
+
+            offset = 0
+            finish_time = time.perf_counter()
+            with self._lock:
+                self.n_batches += 1
+                for features, future, submit_time in batch:
+                    future.set_result(predictions[offset:offset+features.shape[0]])
+                    offset += features.shape[0]
+                    self.n_requests += 1
+                    self.n_rows += features.shape[0]
+                    self._latencies.append((finish_time - submit_time)*1000)
+
+    def stats(self):
+        """ Function to summarise the requests served so far.
+
+        Returns
+        -------
+        stats : dict
+            Request, batch and row counts and latency percentiles in ms.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies)
+            stats = {
+                'requests': self.n_requests,
+                'batches': self.n_batches,
+                'rows': self.n_rows,
+                'meanBatchRows': self.n_rows/self.n_batches if self.n_batches else 0.0,
+            }
+        if latencies.size:
+            stats['latencyMs'] = {
+                f'p{pct}': float(np.percentile(latencies, pct)) for pct in (50, 90, 99)
+            }
+        return stats
+
+
+def rows_to_features(rows):
+    """ Function to convert request rows to a feature matrix. Rows may contain
+        the model features directly or the columns of the finalised datasets
+        from which they are derived.
+
+    Parameters
+    ----------
+    rows : list of dict
+        The rows to be scored.
+
+    Returns
+    -------
+    features : np.array
+        A 2d array of features in FEATURE_SET order.
+    """
+    rows_df = pd.DataFrame(rows)
+    if not all(feature in rows_df.columns for feature in FEATURE_SET):
+        rows_df = edit_features(rows_df.fillna(0))
+    return rows_df[FEATURE_SET].values.astype(np.float32)
+
+
+def create_handler(batcher):
+    """ Function to create the request handler class for a batcher.
+    """
+    class PredictionHandler(BaseHTTPRequestHandler):
+        """ Handler for prediction and stats requests.
+        """
+        def _send_json(self, status, body):
+            content = json.dumps(body).encode('UTF-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, batcher.stats())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                rows = json.loads(self.rfile.read(content_length))['rows']
+                features = rows_to_features(rows)
+            except (KeyError, ValueError, TypeError) as err:
+                self._send_json(400, {'error': str(err)})
+                return
+            try:
+                predictions = batcher.submit(features).result()
+            except Exception as err:
+                self._send_json(500, {'error': str(err)})
+                return
+            self._send_json(200, {'predictions': predictions.tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictionHandler
+
+
+def create_server(predict_func, port, max_batch_rows, max_wait_ms):
+    """ Function to create a prediction server on localhost.
+
+    Parameters
+    ----------
+    predict_func : function
+        A function mapping a 2d feature array to an array of predictions.
+    port : int
+        The port to bind. Use 0 to bind any free port, available from
+        server.server_address.
+    max_batch_rows : int
+        The maximum number of rows predicted in one batch.
+    max_wait_ms : float
+        The maximum time to wait for further requests to join a batch.
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        The server, which is started with serve_forever.
+    """
+    batcher = PredictionBatcher(predict_func, max_batch_rows, max_wait_ms)
+    server = ThreadingHTTPServer((SERVER_HOST, port), create_handler(batcher))
+    server.batcher = batcher
+    return server
+
+
+def serve(config):
+    """ Function to load the best model and serve predictions until interrupted.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    budget = ThreadBudget(config.n_cores)
+    # Batches are predicted one at a time, so each gets the whole budget.
+    with budget.limit('serve') as (_, n_threads):
+        predict_func = load_predict_func(
+            config.output_folder, config.best_model, config.prediction_backend, n_threads
+        )
+        server = create_server(
+            predict_func,
+            config.server_port, config.server_max_batch_rows, config.server_max_wait_ms
+        )
+        print(
+            f'Serving model {config.best_model} on http://{SERVER_HOST}:{server.server_address[1]} '
+            '(POST /predict, GET /stats)'
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(json.dumps(server.batcher.stats(), indent=2))
+
+
+def request_predictions(rows, port, host=SERVER_HOST):
+    """ Function to request predictions from a running server.
+
+    Parameters
+    ----------
+    rows : list of dict
+        The rows to be scored.
+    port : int
+        The port of the server.
+    host : str
+        The host of the server.
+
+    Returns
+    -------
+    predictions : list of float
+        The predicted spectral angle delta of each row.
+    """
+    req = url_request.Request(
+        f'http://{host}:{port}/predict',
+        data=json.dumps({'rows': rows}).encode('UTF-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    with url_request.urlopen(req) as response:
+        return json.loads(response.read())['predictions']
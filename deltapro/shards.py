@@ -0,0 +1,283 @@
+""" Functions for running the preprocess pipeline as independent shards, for
+    example on several machines sharing a filesystem, and merging their
+    outputs.
+
+planShards assigns the source files of flippedSeqs.csv to nShards shards and
+records the assignment in shards/shardManifest.json. Each shard, run with
+--pipeline preprocess --shard i, matches, featurises and finalises the PSMs of
+its sources into its own folder, shards/shard{i}, without assigning them to
+the train or test set. mergeShards then assigns the peptides of all shards
+with the same GroupShuffleSplit as an unsharded run and writes the combined
+outputs in shard order, so the result does not depend on which shard finished
+first. runShards runs all three steps locally, with each shard in a separate
+process.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from deltapro.cache import hash_file
+from deltapro.calculate_features import PEPTIDE_SPLIT_FILE, assign_grouped_split, featurise
+from deltapro.data_io import append_to_csv, iter_csv_chunks
+from deltapro.feature_store import write_feature_stores
+from deltapro.finalise_input import finalise_feated_df
+from deltapro.partitioned_preprocess import match_partition, parse_scan, write_missing_outputs
+from deltapro.prediction_store import import_prosit_predictions
+from deltapro.profiling import PROFILER
+from deltapro.resources import ThreadBudget
+from deltapro.spectral_data import (
+    N_PROSIT_FILES, predict_missing_predictions, prepare_prosit_predictions
+)
+
+SHARD_FOLDER = 'shards'
+SHARD_MANIFEST_FILE = 'shardManifest.json'
+SHARD_COMPLETE_FILE = 'complete.json'
+
+
+def get_shard_folder(output_folder, shard_idx):
+    """ Function to get the folder of a shard's outputs.
+    """
+    return f'{output_folder}/{SHARD_FOLDER}/shard{shard_idx}'
+
+def plan_shards(config):
+    """ Function to assign the source files of flippedSeqs.csv to shards,
+        balancing the number of PSMs of each shard, and write the manifest.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+
+    Returns
+    -------
+    manifest : dict
+        The inputs of the shards.
+    """
+    flipped_path = f'{config.output_folder}/flippedSeqs.csv'
+    source_counts = pd.Series(dtype='int64')
+    for chunk_df in iter_csv_chunks(flipped_path, config.chunk_size, columns=['source']):
+        source_counts = source_counts.add(
+            chunk_df['source'].astype(str).value_counts(), fill_value=0
+        )
+
+    shards = [
+        {'shard': shard_idx, 'sources': [], 'scanFiles': [], 'nPsms': 0}
+        for shard_idx in range(config.n_shards)
+    ]
+    # Largest sources first, each to the shard with fewest PSMs so far.
+    for source, n_psms in sorted(source_counts.items(), key=lambda item: (-item[1], item[0])):
+        shard = min(shards, key=lambda shard: (shard['nPsms'], shard['shard']))
+        shard['sources'].append(source)
+        shard['nPsms'] += int(n_psms)
+    for shard in shards:
+        shard['sources'].sort()
+        shard['scanFiles'] = [
+            scan_file for scan_file in config.scan_files
+            if os.path.basename(scan_file)[:-4] in shard['sources']
+        ]
+
+    # Predictions are added to the store once rather than by every shard, as
+    # shards may run on several machines and only read the store.
+    if config.prediction_store is not None:
+        import_prosit_predictions(config, N_PROSIT_FILES)
+        if config.spectrum_predictor is not None:
+            predict_missing_predictions(config)
+
+    manifest = {
+        'nShards': config.n_shards,
+        'flippedSeqsHash': hash_file(flipped_path),
+        'shards': shards,
+    }
+    os.makedirs(f'{config.output_folder}/{SHARD_FOLDER}', exist_ok=True)
+    with open(
+        f'{config.output_folder}/{SHARD_FOLDER}/{SHARD_MANIFEST_FILE}', 'w', encoding='UTF-8'
+    ) as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    for shard in shards:
+        print(f'Shard {shard["shard"]}: {len(shard["sources"])} sources, {shard["nPsms"]} PSMs')
+    return manifest
+
+def load_shard_manifest(output_folder):
+    """ Function to load the manifest written by plan_shards, checking that
+        flippedSeqs.csv has not changed since.
+    """
+    manifest_path = f'{output_folder}/{SHARD_FOLDER}/{SHARD_MANIFEST_FILE}'
+    if not os.path.exists(manifest_path):
+        raise ValueError(f'No shard manifest found at {manifest_path}, run planShards first.')
+    with open(manifest_path, 'r', encoding='UTF-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    if hash_file(f'{output_folder}/flippedSeqs.csv') != manifest['flippedSeqsHash']:
+        raise ValueError('flippedSeqs.csv has changed since the shards were planned.')
+    return manifest
+
+def run_shard(config, shard_idx):
+    """ Function to match, featurise and finalise the PSMs of one shard,
+        writing spectralData.csv, featedData{idx}.csv and finalData.csv to the
+        shard's folder.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    shard_idx : int
+        The index of the shard in the manifest.
+    """
+    folder = config.output_folder
+    manifest = load_shard_manifest(folder)
+    shard = manifest['shards'][shard_idx]
+    shard_folder = get_shard_folder(folder, shard_idx)
+    os.makedirs(shard_folder, exist_ok=True)
+    for file_name in os.listdir(shard_folder):
+        os.remove(f'{shard_folder}/{file_name}')
+
+    sources = set(shard['sources'])
+    with PROFILER.stage('loadShardPsms', shard=shard_idx) as record:
+        flip_df = pd.concat([
+            chunk_df[chunk_df['source'].astype(str).isin(sources)]
+            for chunk_df in iter_csv_chunks(f'{folder}/flippedSeqs.csv', config.chunk_size)
+        ])
+        flip_df['scan'] = flip_df['scan'].apply(parse_scan)
+        record['rowsOut'] = flip_df.shape[0]
+    msp_indices = None
+    if config.prediction_store is None:
+        msp_indices = prepare_prosit_predictions(config)
+
+    spec_df = None
+    if flip_df.shape[0] > 0:
+        spec_df = match_partition(
+            flip_df, f'Shard{shard_idx}', folder, config, msp_indices, read_only_store=True
+        )
+    n_rows = 0 if spec_df is None else spec_df.shape[0]
+    if n_rows > 0:
+        spec_df.to_csv(f'{shard_folder}/spectralData.csv', index=False)
+        spec_df['prositIons'] = spec_df['prositIons'].apply(json.loads)
+        spec_df['prositMatchedIons'] = spec_df['prositMatchedIons'].apply(json.loads)
+        for idx in range(1, 6):
+            with PROFILER.stage(f'features{idx}', rows_in=n_rows) as record:
+                feated_df = featurise(spec_df, idx)
+                record['rowsOut'] = feated_df.shape[0]
+            feated_df.to_csv(f'{shard_folder}/featedData{idx}.csv', index=False)
+            with PROFILER.stage(f'finalise{idx}', rows_in=feated_df.shape[0]):
+                append_to_csv(finalise_feated_df(feated_df, idx), f'{shard_folder}/finalData.csv')
+
+    # Written last, so the merge only reads shards which ran to completion.
+    with open(f'{shard_folder}/{SHARD_COMPLETE_FILE}', 'w', encoding='UTF-8') as complete_file:
+        json.dump(
+            {'shard': shard_idx, 'flippedSeqsHash': manifest['flippedSeqsHash'], 'nRows': n_rows},
+            complete_file,
+        )
+    print(f'Shard {shard_idx} complete, {n_rows} PSMs matched.')
+
+def route_by_split(csv_paths, split_map, out_paths, chunk_size):
+    """ Function to append the rows of several csv files to the train or test
+        output file according to the split of their peptide.
+    """
+    for csv_path in csv_paths:
+        if not os.path.exists(csv_path):
+            continue
+        for chunk_df in iter_csv_chunks(csv_path, chunk_size):
+            splits = chunk_df['peptide'].astype(str).map(split_map)
+            for tt, out_path in out_paths.items():
+                append_to_csv(chunk_df[splits == tt], out_path)
+
+def merge_shards(config):
+    """ Function to combine the outputs of all shards into spectralData.csv,
+        peptideSplit.csv, the featured data and the final train and test
+        datasets.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    folder = config.output_folder
+    manifest = load_shard_manifest(folder)
+    shard_folders = [
+        get_shard_folder(folder, shard['shard']) for shard in manifest['shards']
+    ]
+    missing = [
+        shard_folder for shard_folder in shard_folders
+        if not os.path.exists(f'{shard_folder}/{SHARD_COMPLETE_FILE}')
+    ]
+    if missing:
+        raise ValueError(f'Shards have not completed: {", ".join(missing)}')
+
+    output_files = [f'{folder}/spectralData.csv', f'{folder}/{PEPTIDE_SPLIT_FILE}'] + [
+        f'{folder}/{tt}{name}.csv'
+        for tt in ('train', 'test')
+        for name in ['Data'] + [f'FeatedData{idx}' for idx in range(1, 6)]
+    ]
+    for out_file in output_files:
+        if os.path.exists(out_file):
+            os.remove(out_file)
+
+    with PROFILER.stage('mergeSpectralData') as record:
+        peptides = set()
+        for shard_folder in shard_folders:
+            if not os.path.exists(f'{shard_folder}/spectralData.csv'):
+                continue
+            for chunk_df in iter_csv_chunks(f'{shard_folder}/spectralData.csv', config.chunk_size):
+                peptides.update(chunk_df['peptide'].astype(str))
+                append_to_csv(chunk_df, f'{folder}/spectralData.csv')
+        record['peptides'] = len(peptides)
+
+    split_df = assign_grouped_split(pd.Series(sorted(peptides), dtype=str))
+    split_df.to_csv(f'{folder}/{PEPTIDE_SPLIT_FILE}', index=False)
+    split_map = dict(zip(split_df['peptide'], split_df['split']))
+
+    with PROFILER.stage('mergeFeatures'):
+        for idx in range(1, 6):
+            route_by_split(
+                [f'{shard_folder}/featedData{idx}.csv' for shard_folder in shard_folders],
+                split_map,
+                {tt: f'{folder}/{tt}FeatedData{idx}.csv' for tt in ('train', 'test')},
+                config.chunk_size,
+            )
+    with PROFILER.stage('mergeFinalData'):
+        route_by_split(
+            [f'{shard_folder}/finalData.csv' for shard_folder in shard_folders],
+            split_map,
+            {tt: f'{folder}/{tt}Data.csv' for tt in ('train', 'test')},
+            config.chunk_size,
+        )
+    write_missing_outputs(folder)
+    write_feature_stores(config)
+    print(f'Merged {len(shard_folders)} shards, {len(peptides)} peptides.')
+
+def run_shards_locally(config):
+    """ Function to plan the shards, run each in a separate process with at
+        most nCores running at once, and merge their outputs.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    plan_shards(config)
+    max_running = ThreadBudget(config.n_cores).n_cores
+    pending = list(range(config.n_shards))
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < max_running:
+            shard_idx = pending.pop(0)
+            running[shard_idx] = subprocess.Popen([
+                sys.executable, '-m', 'deltapro.run',
+                '--config_file', config.config_file,
+                '--pipeline', 'preprocess',
+                '--shard', str(shard_idx),
+            ])
+        for shard_idx, process in list(running.items()):
+            if process.poll() is not None:
+                del running[shard_idx]
+                if process.returncode != 0:
+                    failed.append(shard_idx)
+        time.sleep(0.1)
+
+    if failed:
+        raise RuntimeError(f'Shards {failed} failed.')
+    merge_shards(config)
@@ -7,11 +7,54 @@ import os
 import numpy as np
 import pandas as pd
 
+from deltapro.data_io import append_to_csv, get_known_sources, iter_csv_chunks, write_empty_like
 from deltapro.mgf import process_mgf_file
-from deltapro.msp import msp_to_df
+from deltapro.msp import CHARGE_KEY, PROSIT_SEQ_KEY, index_msp_file, msp_to_df, read_msp_entries
+from deltapro.prediction_store import import_prosit_predictions, open_prediction_store
+from deltapro.profiling import PROFILER
+from deltapro.spectrum_predictor import SpectrumPredictor, get_predictor_backend
 # from deltapro.mzml import process_mzml_file
 from deltapro.spectral_match import match_prosit_to_observed
 
+N_PROSIT_FILES = 6
+SPECTRAL_DATA_COLUMNS = [
+    'peptide',
+    'charge',
+    'spectralAngle',
+    'collisionEnergy',
+    'matchedCoverage',
+    'nMatchedDivFrags',
+    'source',
+    'scan',
+    'flip1',
+    'flipInd1',
+    'flipYNewIntensity1',
+    'flipBNewIntensity1',
+    'flipSpectralAngle1',
+    'flip2',
+    'flipInd2',
+    'flipYNewIntensity2',
+    'flipBNewIntensity2',
+    'flipSpectralAngle2',
+    'flip3',
+    'flipInd3',
+    'flipYNewIntensity3',
+    'flipBNewIntensity3',
+    'flipSpectralAngle3',
+    'flip4',
+    'flipInd4',
+    'flipYNewIntensity4',
+    'flipBNewIntensity4',
+    'flipSpectralAngle4',
+    'flip5',
+    'flipInd5',
+    'flipYNewIntensity5',
+    'flipBNewIntensity5',
+    'flipSpectralAngle5',
+    'prositIons',
+    'prositMatchedIons',
+]
+
 def normed_dot_product(true, predicted):
     """ Function to calculate the normalised dot product between the
         true and predicted spectra.
@@ -55,12 +98,44 @@ def calculate_spectral_angle(true, predicted, limit=None):
 
 
 def process_spectral_data(config):
-    flip_df = pd.read_csv(f'{config.output_folder}/flippedSeqs.csv')
+    """ Function to match the Prosit predictions for each PSM and its flipped
+        sequences to the observed spectra and calculate spectral angles.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run. If config.incremental is set, only PSMs
+        from sources not already in spectralData.csv are processed. These are
+        written to spectralDataIncrement.csv and appended to spectralData.csv.
+    """
+    folder = config.output_folder
+    flip_df = pd.read_csv(f'{folder}/flippedSeqs.csv')
     flip_df['scan'] = flip_df['scan'].apply(lambda x : int(x.split(':')[-1]) if isinstance(x, str) else x)
 
+    scan_files = config.scan_files
+    if config.incremental:
+        known_sources = get_known_sources(f'{folder}/spectralData.csv')
+        flip_df = flip_df[~flip_df['source'].astype(str).isin(known_sources)]
+        new_sources = set(flip_df['source'].astype(str))
+        scan_files = [
+            scan_file for scan_file in scan_files
+            if os.path.basename(scan_file)[:-4] in new_sources
+        ]
+        print(f'Processing {flip_df.shape[0]} PSMs from {len(scan_files)} new scan files.')
+        if flip_df.shape[0] == 0 or not scan_files:
+            write_empty_like(
+                f'{folder}/spectralData.csv', f'{folder}/spectralDataIncrement.csv'
+            )
+            return
+
+    if config.prediction_store is not None:
+        import_prosit_predictions(config, N_PROSIT_FILES)
+
     all_scans = []
-    for scan_file in config.scan_files:
-        scans_df = process_mgf_file(scan_file, set(flip_df['scan'].tolist()))
+    for scan_file in scan_files:
+        with PROFILER.stage('loadScans', file=scan_file) as record:
+            scans_df = process_mgf_file(scan_file, set(flip_df['scan'].tolist()))
+            record['rowsOut'] = scans_df.shape[0]
         all_scans.append(scans_df)
     total_scans_df = pd.concat(all_scans)
 
@@ -70,32 +145,233 @@ def process_spectral_data(config):
         how='inner',
         on=['source', 'scan']
     )
-    list_df = np.array_split(flip_df, 2)
+    if config.spectrum_predictor is not None:
+        results = match_with_predictor(flip_df, 0, folder, config)
+    else:
+        results = []
+        for chunk_idx, chunk_df in enumerate(np.array_split(flip_df, 2)):
+            results.append(process_chunk(chunk_df, chunk_idx, folder, config))
+
+    with PROFILER.stage('writeSpectralData') as record:
+        all_dfs = []
+        for entry in results:
+            all_dfs.append(pd.read_csv(entry))
+        total_flip_df = pd.concat(all_dfs)
+        record['rowsOut'] = total_flip_df.shape[0]
+        if config.incremental:
+            total_flip_df.to_csv(f'{folder}/spectralDataIncrement.csv', index=False)
+            append_to_csv(total_flip_df, f'{folder}/spectralData.csv')
+        else:
+            total_flip_df.to_csv(f'{folder}/spectralData.csv', index=False)
+        for entry in results:
+            os.remove(entry)
+
+def prepare_prosit_predictions(config):
+    """ Function to prepare the Prosit predictions for reading by partition,
+        either by adding the msp files to the prediction store or, without a
+        store, by indexing the msp files.
+
+    Returns
+    -------
+    msp_indices : dict or None
+        The index of each msp file, or None if predictions are read from the
+        prediction store.
+    """
+    if config.prediction_store is not None:
+        import_prosit_predictions(config, N_PROSIT_FILES)
+        return None
+    with PROFILER.stage('indexMsp'):
+        return {
+            idx: index_msp_file(f'{config.output_folder}/prositPredictions{idx}.msp')
+            for idx in range(N_PROSIT_FILES)
+        }
+
+def load_prosit_predictions(
+        folder, idx, with_ce=False, msp_index=None, required_df=None, store=None
+    ):
+    """ Function to load the Prosit predictions of prositPredictions{idx}.msp.
+
+    Parameters
+    ----------
+    folder : str
+        The output folder.
+    idx : int
+        The index of the msp file.
+    with_ce : bool
+        Whether the collision energy of each prediction is read.
+    msp_index : pd.DataFrame or None
+        The index of the msp file from index_msp_file. If given, only the
+        entries whose sequence and charge appear in required_df are parsed,
+        otherwise the whole file is parsed.
+    required_df : pd.DataFrame or None
+        The sequence, with oxidised methionines written as m, charge and
+        collision energy of the predictions required.
+    store : deltapro.prediction_store.PredictionStore or None
+        If given, the required predictions are read from the store instead
+        of the msp file.
+
+    Returns
+    -------
+    msp_df : pd.DataFrame
+        The DataFrame of predicted spectra in the format of msp_to_df.
+    """
+    msp_path = f'{folder}/prositPredictions{idx}.msp'
+    if store is not None:
+        msp_df = store.get_predictions(required_df.assign(
+            sequence=required_df['sequence'].str.replace('m', 'M(ox)', regex=False)
+        ))
+        return msp_df if with_ce else msp_df.drop(columns='collisionEnergy')
+    if msp_index is None:
+        return msp_to_df(msp_path, with_ce=with_ce)
+    entries_df = msp_index.assign(
+        sequence=msp_index[PROSIT_SEQ_KEY].str.replace('M(ox)', 'm', regex=False)
+    ).merge(required_df[['sequence', CHARGE_KEY]].drop_duplicates(), on=['sequence', CHARGE_KEY])
+    return read_msp_entries(msp_path, entries_df, with_ce=with_ce)
+
+def get_prediction_keys(flip_df):
+    """ Function to get the Prosit keys of the peptide and flipped sequences
+        of each PSM.
+
+    Returns
+    -------
+    keys_df : pd.DataFrame
+        The Prosit modified sequence, charge and collision energy of each key,
+        with the index of the PSM it belongs to.
+    """
+    keys_df = pd.concat([
+        flip_df[[pep_key, 'charge', 'collision_energy']].set_axis(
+            ['sequence', 'charge', 'collision_energy'], axis=1
+        )
+        for pep_key in ['peptide'] + [f'flip{idx}' for idx in range(1, 6)]
+    ]).dropna()
+    lengths = keys_df['sequence'].str.len()
+    keys_df = keys_df[(lengths > 6) & (lengths < 31)]
+    return keys_df.assign(
+        sequence=keys_df['sequence'].str.replace('m', 'M(ox)', regex=False),
+        charge=keys_df['charge'].astype(int),
+        collision_energy=keys_df['collision_energy'].astype(int),
+    )
+
+def predict_missing_predictions(config):
+    """ Function to request the predictions of every key of flippedSeqs.csv
+        missing from the prediction store from the spectrum predictor and add
+        them to the store, so that shards only need to read the store.
+
+    Returns
+    -------
+    n_predictions : int
+        The number of predictions added.
+    """
+    store = open_prediction_store(config)
+    predictor = SpectrumPredictor(
+        get_predictor_backend(config),
+        config.predictor_batch_size,
+        config.predictor_max_concurrency,
+    )
+    n_predictions = 0
+    try:
+        for chunk_df in iter_csv_chunks(
+            f'{config.output_folder}/flippedSeqs.csv', config.chunk_size
+        ):
+            with PROFILER.stage('predictMissing', rows_in=chunk_df.shape[0]) as record:
+                keys_df = get_prediction_keys(chunk_df)
+                missing_keys_df = keys_df[store.find_missing(keys_df).to_numpy()].drop_duplicates()
+                for batch_df, future in predictor.submit(missing_keys_df):
+                    n_predictions += store.add_predictions(batch_df, future.result())
+                record['rowsOut'] = missing_keys_df.shape[0]
+    finally:
+        predictor.close()
+        store.close()
+    print(f'Added {n_predictions} predictions to {config.prediction_store}.')
+    return n_predictions
+
+def match_with_predictor(flip_df, chunk_id, folder, config):
+    """ Function to match PSMs using the prediction store, requesting the
+        missing predictions from the spectrum predictor. PSMs whose
+        predictions are all stored are matched while the requests are in
+        flight, and the remaining PSMs once their predictions have been added
+        to the store.
+
+    Parameters
+    ----------
+    flip_df : pd.DataFrame
+        The PSMs and flipped sequences merged with their observed spectra.
+    chunk_id : int or str
+        The identifier of the chunk, used in the names of the files written.
+    folder : str
+        The output folder.
+    config : deltapro.config.Config
+        The Config object for the run.
+
+    Returns
+    -------
+    spectral_files : list of str
+        The spectral data files written.
+    """
+    flip_df = flip_df.reset_index(drop=True)
+    keys_df = get_prediction_keys(flip_df)
+    store = open_prediction_store(config)
+    predictor = SpectrumPredictor(
+        get_predictor_backend(config),
+        config.predictor_batch_size,
+        config.predictor_max_concurrency,
+    )
+    spectral_files = []
+    try:
+        with PROFILER.stage('findMissingPredictions', rows_in=keys_df.shape[0]) as record:
+            missing = store.find_missing(keys_df).to_numpy()
+            missing_keys_df = keys_df[missing].drop_duplicates()
+            record['rowsOut'] = missing_keys_df.shape[0]
+        pending = flip_df.index.isin(keys_df.index[missing])
 
-    n_cores = min(config.n_cores, 2)
+        requests = predictor.submit(missing_keys_df)
+        print(
+            f'Requested {missing_keys_df.shape[0]} predictions in {len(requests)} batches '
+            f'for {pending.sum()} of {flip_df.shape[0]} PSMs.'
+        )
+        if not pending.all():
+            spectral_files.append(
+                process_chunk(flip_df[~pending], f'{chunk_id}Stored', folder, config)
+            )
 
-    results = []
-    for chunk_idx, flip_df in enumerate(list_df):
-        results.append(process_chunk(flip_df, chunk_idx, config.output_folder, config))
+        with PROFILER.stage('awaitPredictions', rows_in=missing_keys_df.shape[0]) as record:
+            n_predictions = 0
+            for batch_df, future in requests:
+                n_predictions += store.add_predictions(batch_df, future.result())
+            record['rowsOut'] = n_predictions
+    finally:
+        predictor.close()
+        store.close()
 
-    all_dfs = []
-    for entry in results:
-        all_dfs.append(pd.read_csv(entry))
-    total_flip_df = pd.concat(all_dfs)
-    total_flip_df.to_csv(f'{config.output_folder}/spectralData.csv', index=False)
-    for entry in results:
-        os.remove(entry)
+    if pending.any():
+        spectral_files.append(
+            process_chunk(flip_df[pending], f'{chunk_id}Predicted', folder, config)
+        )
+    return spectral_files
 
-def process_chunk(flip_df, chunk_id, folder, config):
+def process_chunk(flip_df, chunk_id, folder, config, msp_indices=None, read_only_store=False):
     print(f'Running chunk {chunk_id}, size {flip_df.shape[0]}')
+    if msp_indices is None:
+        msp_indices = {}
+    store = open_prediction_store(config, read_only=read_only_store)
     for idx in range(1, 6):
-        msp_df = msp_to_df(f'{folder}/prositPredictions{idx}.msp').rename(
-            columns={
-                'modified_sequence': f'flip{idx}',
-                'Z': 'charge',
-                'prositIons': f'flip{idx}PrositIons',
-            }
-        )
+        with PROFILER.stage('parseMsp', file=f'prositPredictions{idx}.msp') as record:
+            msp_df = load_prosit_predictions(
+                folder,
+                idx,
+                msp_index=msp_indices.get(idx),
+                required_df=flip_df[[f'flip{idx}', 'charge', 'collision_energy']].set_axis(
+                    ['sequence', 'charge', 'collision_energy'], axis=1
+                ),
+                store=store,
+            ).rename(
+                columns={
+                    'modified_sequence': f'flip{idx}',
+                    'Z': 'charge',
+                    'prositIons': f'flip{idx}PrositIons',
+                }
+            )
+            record['rowsOut'] = msp_df.shape[0]
         msp_df[f'flip{idx}'] = msp_df[f'flip{idx}'].apply(lambda x : x.replace('M(ox)', 'm'))
 
         msp_df = msp_df.drop_duplicates(subset=[f'flip{idx}', 'charge'])
@@ -106,26 +382,41 @@ def process_chunk(flip_df, chunk_id, folder, config):
             on=[f'flip{idx}', 'charge']
         )
 
-        flip_df = flip_df.apply(
-            lambda x : match_prosit_to_observed(x, f'flip{idx}', f'flip{idx}PrositIons', 0.03, 'Da'),
-            axis=1
-        )
+        with PROFILER.stage(f'matchFlip{idx}', rows_in=flip_df.shape[0]) as record:
+            flip_df = flip_df.apply(
+                lambda x : match_prosit_to_observed(x, f'flip{idx}', f'flip{idx}PrositIons', 0.03, 'Da'),
+                axis=1
+            )
 
-        flip_df[f'flipSpectralAngle{idx}'] = flip_df.apply(
-            lambda x : calculate_spectral_angle(x['prositMatchedIons'], x[f'flip{idx}PrositIons']),
-            axis=1
-        )
+            flip_df[f'flipSpectralAngle{idx}'] = flip_df.apply(
+                lambda x : calculate_spectral_angle(x['prositMatchedIons'], x[f'flip{idx}PrositIons']),
+                axis=1
+            )
+            record['rowsOut'] = flip_df.shape[0]
 
         flip_df = flip_df.drop([f'flip{idx}PrositIons', 'prositMatchedIons'], axis=1)
 
 
 
-    msp_df = msp_to_df(f'{folder}/prositPredictions0.msp', with_ce=True).rename(
-        columns={
-            'modified_sequence': 'peptide',
-            'Z': 'charge',
-        }
-    )
+    with PROFILER.stage('parseMsp', file='prositPredictions0.msp') as record:
+        msp_df = load_prosit_predictions(
+            folder,
+            0,
+            with_ce=True,
+            msp_index=msp_indices.get(0),
+            required_df=flip_df[['peptide', 'charge', 'collision_energy']].set_axis(
+                ['sequence', 'charge', 'collision_energy'], axis=1
+            ),
+            store=store,
+        ).rename(
+            columns={
+                'modified_sequence': 'peptide',
+                'Z': 'charge',
+            }
+        )
+        record['rowsOut'] = msp_df.shape[0]
+    if store is not None:
+        store.close()
     msp_df = msp_df.drop_duplicates(subset=['peptide', 'charge'])
     msp_df['peptide'] = msp_df['peptide'].apply(lambda x : x.replace('M(ox)', 'm'))
 
@@ -135,55 +426,26 @@ def process_chunk(flip_df, chunk_id, folder, config):
         how='inner',
         on=['peptide', 'charge']
     )
+    if flip_df.shape[0] == 0:
+        pd.DataFrame(columns=SPECTRAL_DATA_COLUMNS).to_csv(
+            f'{folder}/spectralData{chunk_id}.csv', index=False
+        )
+        return f'{folder}/spectralData{chunk_id}.csv'
 
-    flip_df = flip_df.apply(
-        lambda x : match_prosit_to_observed(x, 'peptide', 'prositIons', 0.03, 'Da'),
-        axis=1
-    )
-    flip_df['spectralAngle'] = flip_df.apply(
-        lambda x : calculate_spectral_angle(x['prositMatchedIons'], x['prositIons']),
-        axis=1,
-    )
-    flip_df = flip_df[flip_df['spectralAngle'] > 0.0]
+    with PROFILER.stage('matchPeptide', rows_in=flip_df.shape[0]) as record:
+        flip_df = flip_df.apply(
+            lambda x : match_prosit_to_observed(x, 'peptide', 'prositIons', 0.03, 'Da'),
+            axis=1
+        )
+        flip_df['spectralAngle'] = flip_df.apply(
+            lambda x : calculate_spectral_angle(x['prositMatchedIons'], x['prositIons']),
+            axis=1,
+        )
+        flip_df = flip_df[flip_df['spectralAngle'] > 0.0]
+        record['rowsOut'] = flip_df.shape[0]
 
     flip_df['prositIons'] = flip_df['prositIons'].apply(json.dumps)
     flip_df['prositMatchedIons'] = flip_df['prositMatchedIons'].apply(json.dumps)
-    flip_df = flip_df[[
-        'peptide',
-        'charge',
-        'spectralAngle',
-        'collisionEnergy',
-        'matchedCoverage',
-        'nMatchedDivFrags',
-        'source',
-        'scan',
-        'flip1',
-        'flipInd1',
-        'flipYNewIntensity1',
-        'flipBNewIntensity1',
-        'flipSpectralAngle1',
-        'flip2',
-        'flipInd2',
-        'flipYNewIntensity2',
-        'flipBNewIntensity2',
-        'flipSpectralAngle2',
-        'flip3',
-        'flipInd3',
-        'flipYNewIntensity3',
-        'flipBNewIntensity3',
-        'flipSpectralAngle3',
-        'flip4',
-        'flipInd4',
-        'flipYNewIntensity4',
-        'flipBNewIntensity4',
-        'flipSpectralAngle4',
-        'flip5',
-        'flipInd5',
-        'flipYNewIntensity5',
-        'flipBNewIntensity5',
-        'flipSpectralAngle5',
-        'prositIons',
-        'prositMatchedIons',
-    ]]
+    flip_df = flip_df[SPECTRAL_DATA_COLUMNS]
     flip_df.to_csv(f'{folder}/spectralData{chunk_id}.csv', index=False)
     return f'{folder}/spectralData{chunk_id}.csv'
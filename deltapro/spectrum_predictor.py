@@ -0,0 +1,209 @@
+""" Pluggable backends for predicting the spectra of peptides on demand, and a
+    client sending them batched, concurrency limited requests asynchronously.
+
+A backend is any object with a predict_batch method taking lists of Prosit
+modified sequences, charges and collision energies and returning the normed
+ion intensities of each, in the format of msp_to_df. The stub backend
+generates deterministic spectra locally for tests and benchmarks, while the
+koina backend calls a Koina (KServe v2 protocol) server hosting Prosit.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import re
+import time
+from urllib import request as url_request
+from urllib.error import HTTPError, URLError
+import zlib
+
+import numpy as np
+
+from deltapro.msp import process_intensities
+
+N_RETRIES = 3
+REQUEST_TIMEOUT = 300
+
+
+class StubPredictor:
+    """ Backend generating deterministic synthetic spectra from a hash of each
+        key, without any external service.
+    """
+    def __init__(self, delay_seconds=0.0):
+        """ Initialise StubPredictor object.
+        """
+        self.delay_seconds = delay_seconds
+
+    def predict_batch(self, sequences, charges, collision_energies):
+        """ Function to predict the spectra of a batch of keys.
+
+        Returns
+        -------
+        spectra : list of dict
+            The normed intensity of each b and y ion of each key.
+        """
+        time.sleep(self.delay_seconds)
+        spectra = []
+        for sequence, charge, collision_energy in zip(sequences, charges, collision_energies):
+            rng = np.random.default_rng(
+                zlib.crc32(f'{sequence}/{charge}/{collision_energy}'.encode('UTF-8'))
+            )
+            pep_len = len(sequence.replace('(ox)', ''))
+            ions = [
+                f'{letter}{loc}' + ('' if ion_charge == 1 else f'^{ion_charge}')
+                for ion_charge in range(1, min(charge, 3) + 1)
+                for letter in ('y', 'b')
+                for loc in range(1, pep_len)
+            ]
+            spectra.append(process_intensities(ions, rng.random(len(ions)).tolist()))
+        return spectra
+
+
+class KoinaPredictor:
+    """ Backend requesting spectra from a Koina server over the KServe v2
+        inference protocol.
+    """
+    def __init__(self, url, model):
+        """ Initialise KoinaPredictor object.
+        """
+        self.url = f'{url.rstrip("/")}/v2/models/{model}/infer'
+
+    def predict_batch(self, sequences, charges, collision_energies):
+        """ Function to predict the spectra of a batch of keys.
+
+        Returns
+        -------
+        spectra : list of dict
+            The normed intensity of each b and y ion without neutral losses
+            predicted above zero for each key.
+        """
+        n_keys = len(sequences)
+        body = {
+            'id': '0',
+            'inputs': [
+                {
+                    'name': 'peptide_sequences',
+                    'shape': [n_keys, 1],
+                    'datatype': 'BYTES',
+                    'data': [seq.replace('M(ox)', 'M[UNIMOD:35]') for seq in sequences],
+                },
+                {
+                    'name': 'precursor_charges',
+                    'shape': [n_keys, 1],
+                    'datatype': 'INT32',
+                    'data': [int(charge) for charge in charges],
+                },
+                {
+                    'name': 'collision_energies',
+                    'shape': [n_keys, 1],
+                    'datatype': 'FP32',
+                    'data': [float(ce) for ce in collision_energies],
+                },
+            ],
+        }
+        outputs = {
+            output['name']: output for output in self._post(body)['outputs']
+        }
+        n_ions = len(outputs['intensities']['data'])//n_keys
+        spectra = []
+        for key_idx in range(n_keys):
+            ions = []
+            intensities = []
+            for annotation, intensity in zip(
+                outputs['annotation']['data'][key_idx*n_ions:(key_idx+1)*n_ions],
+                outputs['intensities']['data'][key_idx*n_ions:(key_idx+1)*n_ions],
+            ):
+                ion = koina_to_ion_name(annotation)
+                # Ions with neutral losses, returned by some models, are not stored.
+                if ion is not None and intensity > 0:
+                    ions.append(ion)
+                    intensities.append(intensity)
+            spectra.append(process_intensities(ions, intensities) if ions else {})
+        return spectra
+
+    def _post(self, body):
+        """ Function to send a request, retrying with exponential backoff if
+            the server cannot be reached or returns a server error.
+        """
+        req = url_request.Request(
+            self.url,
+            data=json.dumps(body).encode('UTF-8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        for attempt in range(N_RETRIES):
+            try:
+                with url_request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+                    return json.loads(response.read())
+            except HTTPError as error:
+                # Client errors, such as an unknown model, will not succeed on retry.
+                if error.code < 500 or attempt == N_RETRIES - 1:
+                    raise
+            except URLError:
+                if attempt == N_RETRIES - 1:
+                    raise
+            time.sleep(2**attempt)
+
+
+def koina_to_ion_name(annotation):
+    """ Function to convert a Koina ion annotation, e.g. y3+2, to the ion name
+        used in msp files, e.g. y3^2, or None for other ions such as those with
+        neutral losses, e.g. y3-H2O+1.
+    """
+    regex_match = re.fullmatch(r'([by]\d+)\+(\d)', annotation)
+    if regex_match is None:
+        return None
+    if regex_match.group(2) == '1':
+        return regex_match.group(1)
+    return f'{regex_match.group(1)}^{regex_match.group(2)}'
+
+def get_predictor_backend(config):
+    """ Function to create the spectrum predictor backend of the config.
+    """
+    if config.spectrum_predictor == 'stub':
+        return StubPredictor()
+    if config.spectrum_predictor == 'koina':
+        return KoinaPredictor(config.predictor_url, config.predictor_model)
+    raise ValueError(f'Unrecognised spectrum predictor {config.spectrum_predictor}.')
+
+
+class SpectrumPredictor:
+    """ Client splitting keys into batches and sending them to a backend from a
+        pool of threads, so that at most max_concurrency requests are in
+        flight while the caller carries on with other work.
+    """
+    def __init__(self, backend, batch_size, max_concurrency):
+        """ Initialise SpectrumPredictor object.
+        """
+        self.backend = backend
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def submit(self, keys_df):
+        """ Function to request the spectra of a set of keys without waiting
+            for them.
+
+        Parameters
+        ----------
+        keys_df : pd.DataFrame
+            The Prosit modified sequence, charge and collision energy of each
+            key, in that column order.
+
+        Returns
+        -------
+        requests : list of tuple
+            The keys of each batch and a Future resolving to their spectra.
+        """
+        requests = []
+        for start in range(0, keys_df.shape[0], self.batch_size):
+            batch_df = keys_df.iloc[start:start + self.batch_size]
+            requests.append((
+                batch_df,
+                self.executor.submit(
+                    self.backend.predict_batch,
+                    *[batch_df[column].tolist() for column in batch_df.columns],
+                ),
+            ))
+        return requests
+
+    def close(self):
+        """ Function to wait for outstanding requests and stop the threads.
+        """
+        self.executor.shutdown(wait=True)
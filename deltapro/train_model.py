@@ -1,168 +1,322 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
 
-import os
-import pickle
-from tkinter.font import families
-
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.stats import pearsonr, spearmanr
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import median_absolute_error, r2_score
-import sklearn
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.model_selection import GroupKFold, RandomizedSearchCV
 import xgboost as xgb
-from deltapro.constants import BLOSUM6_1_VALUES
-
-
-FEATURE_SET = [
-    'spectralAngle',
-    'blosumC',
-    'blosumN',
-    'nTermDist',
-    'cTermDist',
-    'charge',
-    'cNeighbourBlosum',
-    'nNeighbourBlosum',
-    'yErrsAtLoc',
-    'bErrsAtLoc',
-    'collisionEnergy',
-    'bIntesAtC',
-    'yIntesAtN',
-    'yIntesAtLoc',
-    'bIntesAtLoc',
-    'yMatchedIntesAtN',
-    'bMatchedIntesAtC',
-    'yMatchedIntesAtLoc',
-    'bMatchedIntesAtLoc',
-    'cOxidation',
-    'nOxidation',
-    'flipYNewIntensity',
-    'flipBNewIntensity',
-    'matchedCoverage',
-]
-TARGET_VARIABLE = 'specAngleDiff'
+from deltapro.cache import hash_file
+from deltapro.constants import FEATURE_SET, TARGET_VARIABLE
+from deltapro.evaluate_model import StreamingMetrics
+from deltapro.feature_store import fill_missing, read_final_data
+from deltapro.finalise_input import MODEL_INPUT_COLUMNS, edit_features
+from deltapro.hyperparameter_search import N_FOLDS, PARAM_SETS, successive_halving
+from deltapro.model_io import export_tree_arrays, predict_features, save_model
+from deltapro.out_of_core import (
+    build_quantile_matrix,
+    get_importances,
+    get_validation_mask,
+    iter_feature_chunks,
+    settings_to_params,
+)
+from deltapro.profiling import PROFILER
+from deltapro.resources import ThreadBudget
 
 METHOD = 'xgb'
-PARAM_SETS = {
-    "learning_rate"    : [0.15, 0.20, 0.30 ] ,
-    "max_depth"        : [ 14, 15, 16, 17, 18],
-    "min_child_weight" : [ 1, 2],
-    "gamma"            : [ 0.0, 0.1, 0.2 ],
-    "colsample_bytree" : [ 0.7, 0.9 ],
-}
 
 
-def run_training(train_df, entry, optimised_settings):
-    reg = xgb.XGBRegressor(n_jobs=25, **optimised_settings[entry])
+def run_training(train_df, entry, optimised_settings, n_threads=None):
+    reg = xgb.XGBRegressor(n_jobs=n_threads, **optimised_settings[entry])
     
     reg.fit(train_df[FEATURE_SET].values, train_df[TARGET_VARIABLE])
     return reg
 
-def assess_model(model, dataset, title, identifier):
-    dataset[f'predictedDiff{identifier}'] = model.predict(dataset[FEATURE_SET].values)
-
-    model_stats = {
-        f'{title}mae': median_absolute_error(dataset[TARGET_VARIABLE], dataset[f'predictedDiff{identifier}']),
-        f'{title}r2': r2_score(dataset[TARGET_VARIABLE], dataset[f'predictedDiff{identifier}']),
-        f'{title}pearson': pearsonr(dataset[TARGET_VARIABLE], dataset[f'predictedDiff{identifier}'])[0],
-        f'{title}spearmanr': spearmanr(dataset[TARGET_VARIABLE], dataset[f'predictedDiff{identifier}'])[0],
+def compute_stats(metrics, title):
+    """ Function to get the performance statistics of a model from its
+        StreamingMetrics, which are NaN if the dataset had no rows.
+    """
+    result = metrics.result()
+    return {
+        f'{title}mae': result.get('medianAbsErr', np.nan),
+        f'{title}r2': result.get('r2', np.nan),
+        f'{title}pearson': result.get('pearson', np.nan),
+        f'{title}spearmanr': result.get('spearmanr', np.nan),
     }
-    return dataset, model_stats
 
-def save_importances(model, output_folder, identifier):
+def save_importances(importances, output_folder, identifier):
     importance_df = pd.DataFrame({
         'feature': pd.Series(FEATURE_SET),
-        'importances': pd.Series(model.feature_importances_)
+        'importances': pd.Series(importances)
     })
     importance_df.to_csv(
         f'{output_folder}/importances/model{identifier}.csv',
         index=False,
     )
 
-def save_model(model, folder, identifier):
-    file_name = f'{folder}/model/reg{identifier}.pkl'
-    pickle.dump(model, open(file_name, 'wb'))
-    model_size = os.path.getsize(file_name)
-    return model_size
-
-def edit_features(working_df):
-    # working_df['flip'] = working_df.apply(
-    #     lambda x : (x['peptide'][:int(x['flipInd']) - 1] +
-    #         x['peptide'][int(x['flipInd'])] +
-    #         x['peptide'][int(x['flipInd']-1)] +
-    #         x['peptide'][int(x['flipInd'])+1:]),
-    #     axis=1
-    # )
-
-    working_df['pepLen'] = working_df['peptide'].apply(len)
-    working_df['nTermDist'] = working_df['flipInd'].apply(int)
-    working_df['cTermDist'] = working_df['pepLen'] - working_df['nTermDist']
-
-    if 'intesAtC' in FEATURE_SET:
-        working_df['intesAtC'] = working_df['bIntesAtC'] + working_df['yIntesAtC']
-        working_df['intesAtN'] = working_df['bIntesAtN'] + working_df['yIntesAtN']
-        working_df['intesAtLoc'] = working_df['bIntesAtLoc'] + working_df['yIntesAtLoc']
-    if 'matchedIntesAtC' in FEATURE_SET:
-        working_df['matchedIntesAtC'] = working_df['bMatchedIntesAtC'] + working_df['yMatchedIntesAtC']
-        working_df['matchedIntesAtN'] = working_df['bMatchedIntesAtN'] + working_df['yMatchedIntesAtN']
-        working_df['matchedIntesAtLoc'] = working_df['bMatchedIntesAtLoc'] + working_df['yMatchedIntesAtLoc']
-    if 'errsAtLoc' in FEATURE_SET:
-        working_df['errsAtC'] = working_df['yErrsAtC'] + working_df['bErrsAtC']
-        working_df['errsAtN'] = working_df['yErrsAtN'] + working_df['bErrsAtN']
-        working_df['errsAtLoc'] = working_df['yErrsAtLoc'] + working_df['bErrsAtLoc']
-    if 'cNeighbourBlosum' in FEATURE_SET:
-        working_df['cNeighbourBlosum'] = working_df['cNeighbour'].apply(lambda x : BLOSUM6_1_VALUES.get(x,-5.0))
-        working_df['nNeighbourBlosum'] = working_df['nNeighbour'].apply(lambda x : BLOSUM6_1_VALUES.get(x, -5.0))
-    return working_df
-
-
-def hpt_job(train_df):
-    reg = xgb.XGBRegressor()
-    cv = RandomizedSearchCV(
-        reg, param_distributions=PARAM_SETS, n_iter=50, scoring='r2', n_jobs=15, cv=5, random_state=42, verbose=3,
-    )
-    searched_cv = cv.fit(train_df[FEATURE_SET].values, train_df[TARGET_VARIABLE].values)
+def hpt_job(train_df, budget, n_iter):
+    with budget.limit('tuneHyperparameters', n_tasks=n_iter*N_FOLDS) as (n_workers, n_threads):
+        reg = xgb.XGBRegressor(n_jobs=n_threads)
+        cv = RandomizedSearchCV(
+            reg, param_distributions=PARAM_SETS, n_iter=n_iter, scoring='r2', n_jobs=n_workers, cv=GroupKFold(N_FOLDS), random_state=42, verbose=3,
+        )
+        searched_cv = cv.fit(
+            train_df[FEATURE_SET].values, train_df[TARGET_VARIABLE].values, groups=train_df['peptide']
+        )
     return searched_cv
 
-def train_model(config):
-    train_df = pd.read_csv(f'{config.output_folder}/trainData.csv')
-    train_df = train_df.fillna(0)
-    test_df = pd.read_csv(f'{config.output_folder}/testData.csv')
-    test_df = test_df.fillna(0)
+def tune_hyperparameters(train_df, budget, config):
+    """ Function to run the configured hyperparameter search and save the
+        results to the output folder.
+    """
+    if config.hpt_search == 'random':
+        searched_cv = hpt_job(train_df, budget, config.hpt_candidates)
+        results = pd.DataFrame(searched_cv.cv_results_)
+        best_params = searched_cv.best_params_
+    elif config.hpt_search == 'halving':
+        with budget.limit('tuneHyperparameters') as (_, n_threads):
+            results, best_params = successive_halving(
+                train_df,
+                config.hpt_candidates,
+                n_threads,
+                time_budget=config.hpt_time_budget,
+                max_fits=config.hpt_max_fits,
+            )
+    else:
+        raise ValueError(f'Unrecognised hyperparameter search {config.hpt_search}.')
+
+    results.to_csv(f'{config.output_folder}/hyperparameterSearch.csv', index=False)
+    print('\n Best hyperparameters:')
+    print(best_params)
+
+def get_preds_path(folder, title, identifier):
+    """ Function to get the file the predictions of a model on the train or
+        test data are written to. Rows align with those of {title}Data.csv.
+    """
+    return f'{folder}/{title}Preds{identifier}.csv'
+
+def load_model_inputs(csv_path):
+    """ Function to load the features and target of a finalised dataset,
+        reading only the columns the model needs.
+    """
+    data_df = edit_features(
+        fill_missing(read_final_data(csv_path, columns=MODEL_INPUT_COLUMNS + [TARGET_VARIABLE]))
+    )
+    return data_df[FEATURE_SET].values.astype(np.float32), data_df[TARGET_VARIABLE].values
+
+def iter_model_inputs(csv_path, chunk_size):
+    """ Function to stream the features and target of a finalised csv file.
+    """
+    for chunk_df in iter_feature_chunks(
+        csv_path, chunk_size, columns=MODEL_INPUT_COLUMNS + [TARGET_VARIABLE]
+    ):
+        yield chunk_df[FEATURE_SET].values.astype(np.float32), chunk_df[TARGET_VARIABLE].values
+
+def train_boosters(
+    train_matrix, n_train, optimised_settings, budget, valid_matrix=None, early_stopping_rounds=None
+):
+    """ Function to train every optimisedSettings model on a shared binned
+        training matrix, with independent models trained concurrently. If a
+        validation matrix is given, training of each model stops once the
+        validation RMSE has not improved for early_stopping_rounds rounds and
+        the model is truncated to its best iteration.
 
-    train_df = edit_features(train_df)
-    test_df = edit_features(test_df)
-    all_performances_stats = []
+    Returns
+    -------
+    boosters : dict
+        The trained Booster of each entry.
+    all_params : dict
+        The training parameters of each entry.
+    best_iterations : dict
+        The best iteration of each entry.
+    """
+    entries = list(optimised_settings.keys())
+    with budget.limit('training', n_tasks=len(entries)) as (n_workers, n_threads):
+        def train_entry(entry):
+            params, n_rounds = settings_to_params(optimised_settings[entry], n_threads)
+            start_time = time.time()
+            if valid_matrix is None:
+                booster = xgb.train(params, train_matrix, num_boost_round=n_rounds)
+                best_iteration = n_rounds - 1
+            else:
+                booster = xgb.train(
+                    params,
+                    train_matrix,
+                    num_boost_round=n_rounds,
+                    evals=[(valid_matrix, 'validation')],
+                    early_stopping_rounds=early_stopping_rounds,
+                    verbose_eval=False,
+                )
+                best_iteration = booster.best_iteration
+                booster = booster[:best_iteration + 1]
+            print(
+                f'Trained model {entry} in {time.time() - start_time:.1f}s, '
+                f'best iteration {best_iteration}'
+            )
+            return booster, {**params, 'n_estimators': n_rounds}, best_iteration
 
+        with PROFILER.stage(
+            'training', rows_in=n_train, models=entries, nWorkers=n_workers, nThreads=n_threads
+        ):
+            with ThreadPoolExecutor(n_workers) as executor:
+                results = dict(zip(entries, executor.map(train_entry, entries)))
+
+    return (
+        {entry: result[0] for entry, result in results.items()},
+        {entry: result[1] for entry, result in results.items()},
+        {entry: result[2] for entry, result in results.items()},
+    )
+
+def write_predictions(
+    boosters, model_inputs, folder, title, spearman_method='sketch', n_bins=512
+):
+    """ Function to predict each chunk of model inputs with every model,
+        append the predictions to a separate file per model and update the
+        performance metrics of each model, so that no predictions are kept.
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows predicted.
+    metrics : dict
+        The StreamingMetrics of each model.
+    """
+    n_rows = 0
+    metrics = {entry: StreamingMetrics(spearman_method, n_bins) for entry in boosters}
+    for features, targets in model_inputs:
+        for entry, booster in boosters.items():
+            entry_preds = predict_features(booster, features)
+            metrics[entry].update(targets, entry_preds)
+            pd.DataFrame({f'predictedDiff{entry}': entry_preds}).to_csv(
+                get_preds_path(folder, title, entry),
+                mode='a' if n_rows else 'w',
+                header=(n_rows == 0),
+                index=False,
+            )
+        n_rows += targets.size
+
+    if n_rows == 0:
+        for entry in boosters:
+            pd.DataFrame(columns=[f'predictedDiff{entry}']).to_csv(
+                get_preds_path(folder, title, entry), index=False
+            )
+    return n_rows, metrics
+
+def train_model(config):
+    budget = ThreadBudget(config.n_cores)
     if config.tune_hyperparameters:
-        searched_cv = hpt_job(train_df)
-        print('\n All results:')
-        print(searched_cv.cv_results_)
-        print('\n Best estimator:')
-        print(searched_cv.best_estimator_)
-        print('\n Best hyperparameters:')
-        print(searched_cv.best_params_)
-        results = pd.DataFrame(searched_cv.cv_results_)
-        results.to_csv('xgb-random-grid-search-results-03q.csv', index=False)
-    else:
-        for entry in config.optimised_settings.keys():
-            print(f'\nFor entry {entry}:\n')
+        with PROFILER.stage('loadTrainingData') as record:
+            train_df = read_final_data(
+                f'{config.output_folder}/trainData.csv',
+                columns=MODEL_INPUT_COLUMNS + [TARGET_VARIABLE],
+            )
+            train_df = edit_features(fill_missing(train_df))
+            record['rowsOut'] = train_df.shape[0]
+        with PROFILER.stage('tuneHyperparameters', rows_in=train_df.shape[0]):
+            tune_hyperparameters(train_df, budget, config)
+        pd.DataFrame(budget.allocations).to_csv(
+            f'{config.output_folder}/threadAllocation.csv', index=False
+        )
+        return
 
-            model_stats = {}
+    # The training data is binned once into a QuantileDMatrix shared by all
+    # models. With outOfCore it is streamed from disk in chunks.
+    train_file = f'{config.output_folder}/trainData.csv'
+    training_data_hash = hash_file(train_file)
+    validation_fraction = None
+    if config.early_stopping_rounds is not None:
+        validation_fraction = config.validation_fraction
+    valid_matrix = None
+    with budget.limit('buildTrainingMatrix') as (_, n_threads):
+        with PROFILER.stage('buildTrainingMatrix') as record:
+            if config.out_of_core:
+                train_matrix, n_train = build_quantile_matrix(
+                    train_file, config.chunk_size, n_threads, validation_fraction
+                )
+                if validation_fraction is not None:
+                    valid_matrix, _ = build_quantile_matrix(
+                        train_file, config.chunk_size, n_threads, validation_fraction,
+                        validation=True, ref=train_matrix,
+                    )
+            else:
+                train_inputs = load_model_inputs(train_file)
+                fit_mask = np.ones(train_inputs[1].size, dtype=bool)
+                if validation_fraction is not None:
+                    fit_mask = ~get_validation_mask(
+                        read_final_data(train_file, columns=['peptide'])['peptide'],
+                        validation_fraction,
+                    )
+                train_matrix = xgb.QuantileDMatrix(
+                    train_inputs[0][fit_mask],
+                    label=train_inputs[1][fit_mask],
+                    feature_names=FEATURE_SET,
+                    nthread=n_threads,
+                )
+                if validation_fraction is not None:
+                    valid_matrix = xgb.QuantileDMatrix(
+                        train_inputs[0][~fit_mask],
+                        label=train_inputs[1][~fit_mask],
+                        feature_names=FEATURE_SET,
+                        nthread=n_threads,
+                        ref=train_matrix,
+                    )
+                n_train = int(fit_mask.sum())
+            record['rowsOut'] = n_train
 
-            model = run_training(train_df, entry, config.optimised_settings)
-            train_df, train_stats = assess_model(model, train_df, 'train', entry)
-            test_df, test_stats = assess_model(model, test_df, 'test', entry)
-            model_stats = {**train_stats, **test_stats}
+    boosters, all_params, best_iterations = train_boosters(
+        train_matrix,
+        n_train,
+        config.optimised_settings,
+        budget,
+        valid_matrix=valid_matrix,
+        early_stopping_rounds=config.early_stopping_rounds,
+    )
+    del train_matrix, valid_matrix
 
-            model_size = save_model(model, config.output_folder, entry)
-            save_importances(model, config.output_folder, entry)
-            model_stats['modelSize'] = model_size
-            model_stats['identifier'] = entry
+    model_sizes = {}
+    for entry, booster in boosters.items():
+        with PROFILER.stage('saveModel', model=entry):
+            model_sizes[entry] = save_model(
+                booster,
+                config.output_folder,
+                entry,
+                config.model_format,
+                metadata={
+                    'params': all_params[entry],
+                    'bestIteration': best_iterations[entry],
+                    'trainingDataHash': training_data_hash,
+                },
+            )
+            export_tree_arrays(booster, config.output_folder, entry)
+            save_importances(get_importances(booster), config.output_folder, entry)
 
-            all_performances_stats.append(model_stats)
+    all_performances_stats = {entry: {} for entry in boosters}
+    for title in ('train', 'test'):
+        csv_path = f'{config.output_folder}/{title}Data.csv'
+        if config.out_of_core:
+            model_inputs = iter_model_inputs(csv_path, config.chunk_size)
+        elif title == 'train':
+            model_inputs = [train_inputs]
+        else:
+            model_inputs = [load_model_inputs(csv_path)]
+        with PROFILER.stage('prediction', dataset=title) as record:
+            record['rowsOut'], metrics = write_predictions(
+                boosters,
+                model_inputs,
+                config.output_folder,
+                title,
+                config.spearman_method,
+                config.spearman_bins,
+            )
+        for entry, entry_metrics in metrics.items():
+            all_performances_stats[entry].update(compute_stats(entry_metrics, title))
 
-        perf_df = pd.DataFrame(all_performances_stats)
-        perf_df.to_csv(f'{config.output_folder}/modelPerformance.csv', index=False)
-        train_df.to_csv(f'{config.output_folder}/trainPreds.csv', index=False)
-        test_df.to_csv(f'{config.output_folder}/testPreds.csv', index=False)
+    for entry in boosters:
+        all_performances_stats[entry]['bestIteration'] = best_iterations[entry]
+        all_performances_stats[entry]['modelSize'] = model_sizes[entry]
+        all_performances_stats[entry]['identifier'] = entry
+    pd.DataFrame(list(all_performances_stats.values())).to_csv(
+        f'{config.output_folder}/modelPerformance.csv', index=False
+    )
+    pd.DataFrame(budget.allocations).to_csv(
+        f'{config.output_folder}/threadAllocation.csv', index=False
+    )
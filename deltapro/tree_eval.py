@@ -0,0 +1,88 @@
+""" Functions for predicting with a tree ensemble exported to flat numpy arrays
+    by deltapro.model_io.export_tree_arrays.
+
+This module only depends on numpy so that lightweight worker processes can
+score rows without importing xgboost. The nodes of all trees are stored in
+single arrays, with leaves pointing to themselves so that every row can be
+walked through all trees for a fixed number of levels.
+"""
+import numpy as np
+
+BLOCK_ROWS = 4096
+
+
+def get_arrays_path(folder, identifier):
+    """ Function to get the file the exported arrays of a model are saved to.
+    """
+    return f'{folder}/model/reg{identifier}.npz'
+
+def load_tree_arrays(folder, identifier, feature_set=None):
+    """ Function to load the exported arrays of a model.
+
+    Parameters
+    ----------
+    folder : str
+        The output folder.
+    identifier : str
+        The identifier of the model.
+    feature_set : list of str or None
+        If given, the features the model must have been trained on.
+
+    Returns
+    -------
+    tree_arrays : dict
+        The node and tree arrays, the base score and the maximum depth.
+    """
+    with np.load(get_arrays_path(folder, identifier)) as npz_file:
+        tree_arrays = {key: npz_file[key] for key in npz_file.files}
+
+    if feature_set is not None and list(tree_arrays['featureSet']) != list(feature_set):
+        raise ValueError(
+            f'Model {identifier} was trained on features {list(tree_arrays["featureSet"])} '
+            'which do not match the current FEATURE_SET.'
+        )
+    return tree_arrays
+
+def _predict_block(tree_arrays, features):
+    """ Function to walk a block of rows through all trees level by level.
+    """
+    row_idx = np.arange(features.shape[0])[:, np.newaxis]
+    nodes = np.broadcast_to(
+        tree_arrays['roots'], (features.shape[0], tree_arrays['roots'].size)
+    )
+    for _ in range(int(tree_arrays['maxDepth'])):
+        values = features[row_idx, tree_arrays['feature'][nodes]]
+        go_left = np.where(
+            np.isnan(values),
+            tree_arrays['defaultLeft'][nodes],
+            values < tree_arrays['threshold'][nodes],
+        )
+        nodes = np.where(go_left, tree_arrays['left'][nodes], tree_arrays['right'][nodes])
+
+    return tree_arrays['leafValue'][nodes].sum(axis=1, dtype=np.float64) + tree_arrays['baseScore']
+
+def predict_tree_arrays(tree_arrays, features, block_rows=BLOCK_ROWS):
+    """ Function to predict with an exported model.
+
+    Parameters
+    ----------
+    tree_arrays : dict
+        The arrays loaded by load_tree_arrays.
+    features : np.array
+        A 2d array of features in FEATURE_SET order.
+    block_rows : int
+        The number of rows walked through the trees at once, bounding the
+        memory used for the node indices of each row and tree.
+
+    Returns
+    -------
+    predictions : np.array
+        The predicted spectral angle deltas.
+    """
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    predictions = np.empty(features.shape[0], dtype=np.float32)
+    for start in range(0, features.shape[0], block_rows):
+        predictions[start:start+block_rows] = _predict_block(
+            tree_arrays, features[start:start+block_rows]
+        )
+    return predictions
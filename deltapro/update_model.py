@@ -0,0 +1,149 @@
+""" Functions for continuing the training of an existing model on new rows,
+    saving the result as a new version of the model.
+"""
+import os
+import re
+import time
+
+import pandas as pd
+import xgboost as xgb
+
+from deltapro.cache import hash_file
+from deltapro.data_io import append_to_csv
+from deltapro.evaluate_model import StreamingMetrics
+from deltapro.model_io import (
+    export_tree_arrays, load_booster, load_metadata, predict_features, save_model
+)
+from deltapro.out_of_core import build_quantile_matrix
+from deltapro.profiling import PROFILER
+from deltapro.resources import ThreadBudget
+from deltapro.train_model import compute_stats, iter_model_inputs
+
+
+def get_next_version(folder, identifier):
+    """ Function to get the identifier of the next unused version of a model,
+        of the form {identifier}_v{n}.
+    """
+    base_identifier = re.sub(r'_v\d+$', '', identifier)
+    version = 1
+    while os.path.exists(f'{folder}/model/reg{base_identifier}_v{version}.meta.json'):
+        version += 1
+    return f'{base_identifier}_v{version}'
+
+def evaluate_boosters(boosters, csv_path, chunk_size, title, spearman_method='sketch', n_bins=512):
+    """ Function to compute the performance statistics of several models on a
+        finalised csv file, streamed in chunks and accumulated without keeping
+        the predictions.
+
+    Returns
+    -------
+    all_stats : dict
+        The statistics of each model.
+    """
+    metrics = {name: StreamingMetrics(spearman_method, n_bins) for name in boosters}
+    for features, targets in iter_model_inputs(csv_path, chunk_size):
+        for name, booster in boosters.items():
+            metrics[name].update(targets, predict_features(booster, features))
+    return {name: compute_stats(name_metrics, title) for name, name_metrics in metrics.items()}
+
+def update_model(config):
+    """ Function to load an existing model, add boosting rounds trained on the
+        new rows of updateDataFile only and save the result as a new version,
+        recording the test performance before and after the update.
+
+    Parameters
+    ----------
+    config : deltapro.config.Config
+        The Config object for the run.
+    """
+    base_identifier = config.base_model
+    with PROFILER.stage('loadModel', model=base_identifier):
+        base_booster = load_booster(config.output_folder, base_identifier)
+        base_metadata = load_metadata(config.output_folder, base_identifier) or {}
+
+    budget = ThreadBudget(config.n_cores)
+    with budget.limit('updateModel') as (_, n_threads):
+        with PROFILER.stage('buildUpdateMatrix') as record:
+            update_matrix, n_rows = build_quantile_matrix(
+                config.update_data_file, config.chunk_size, n_threads
+            )
+            record['rowsOut'] = n_rows
+        if n_rows == 0:
+            print(f'No rows found in {config.update_data_file}, model not updated.')
+            return
+
+        params = {
+            key: value for key, value in base_metadata.get('params', {}).items()
+            if value is not None and key not in ('n_estimators', 'n_jobs')
+        }
+        # Models saved without metadata, such as pickled models, have no params.
+        params.setdefault('objective', 'reg:squarederror')
+        params['tree_method'] = 'hist'
+        params['nthread'] = n_threads
+        with PROFILER.stage('continueTraining', rows_in=n_rows, model=base_identifier):
+            start_time = time.time()
+            # xgb.train copies the model passed as xgb_model before adding trees.
+            updated_booster = xgb.train(
+                params,
+                update_matrix,
+                num_boost_round=config.additional_rounds,
+                xgb_model=base_booster,
+            )
+        print(
+            f'Added {config.additional_rounds} rounds on {n_rows} rows '
+            f'in {time.time() - start_time:.1f}s'
+        )
+    del update_matrix
+
+    identifier = get_next_version(config.output_folder, base_identifier)
+    with PROFILER.stage('saveModel', model=identifier):
+        model_size = save_model(
+            updated_booster,
+            config.output_folder,
+            identifier,
+            config.model_format,
+            metadata={
+                'params': params,
+                'baseModel': base_identifier,
+                'additionalRounds': config.additional_rounds,
+                'bestIteration': updated_booster.num_boosted_rounds() - 1,
+                'trainingDataHash': base_metadata.get('trainingDataHash'),
+                'updateDataHash': hash_file(config.update_data_file),
+            },
+        )
+        export_tree_arrays(updated_booster, config.output_folder, identifier)
+
+    with budget.limit('evaluateUpdate') as (_, n_threads), PROFILER.stage('evaluateUpdate'):
+        for booster in (base_booster, updated_booster):
+            booster.set_param('nthread', n_threads)
+        test_stats = evaluate_boosters(
+            {'before': base_booster, 'after': updated_booster},
+            f'{config.output_folder}/testData.csv',
+            config.chunk_size,
+            'test',
+            config.spearman_method,
+            config.spearman_bins,
+        )
+        update_stats = evaluate_boosters(
+            {'before': base_booster, 'after': updated_booster},
+            config.update_data_file,
+            config.chunk_size,
+            'update',
+            config.spearman_method,
+            config.spearman_bins,
+        )
+
+    update_df = pd.DataFrame([{
+        'identifier': identifier,
+        'baseModel': base_identifier,
+        'additionalRounds': config.additional_rounds,
+        'updateRows': n_rows,
+        'modelSize': model_size,
+        **{f'{key}Before': value for key, value in test_stats['before'].items()},
+        **{f'{key}After': value for key, value in test_stats['after'].items()},
+        **{f'{key}Before': value for key, value in update_stats['before'].items()},
+        **{f'{key}After': value for key, value in update_stats['after'].items()},
+    }])
+    append_to_csv(update_df, f'{config.output_folder}/modelUpdates.csv')
+    print(f'Model {identifier} saved, performance:')
+    print(update_df.T.to_string(header=False))
@@ -39,6 +39,6 @@ setup(
         'six==1.16.0',
         'tenacity==8.0.1',
         'threadpoolctl==3.1.0',
-        'xgboost==1.6.2',
+        'xgboost==1.7.6',
     ],
 )
\ No newline at end of file